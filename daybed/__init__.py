@@ -1,5 +1,6 @@
 """Main entry point
 """
+import atexit
 import os
 import logging
 import pkg_resources
@@ -15,7 +16,7 @@ from cornice import Service
 from pyramid import httpexceptions
 from pyramid.config import Configurator
 from pyramid.events import NewRequest
-from pyramid.renderers import JSONP
+from pyramid.settings import asbool
 from pyramid.authentication import BasicAuthAuthenticationPolicy
 
 from pyramid_hawkauth import HawkAuthenticationPolicy
@@ -25,8 +26,12 @@ from daybed.permissions import (
     RootFactory, DaybedAuthorizationPolicy, get_credentials, check_credentials
 )
 from daybed.views.errors import forbidden_view
-from daybed.renderers import GeoJSON
-from daybed import indexer, events
+from daybed.renderers import GeoJSON, NDJSON, StreamingJSONP
+from daybed import events
+from daybed.backends.request_cache import RequestCache
+from daybed.cache import (CredentialsCache, LRUCache, PermissionsCache,
+                          SearchCache, backend_redis)
+from daybed.schemas.validators import invalidate_record_schemas
 
 
 API_VERSION = 'v%s' % __version__.split('.')[0]
@@ -71,9 +76,13 @@ def main(global_config, **settings):
 
     # Permission management
 
+    nonce_cache_class = config.maybe_dotted(
+        settings.get('daybed.hawk_nonce_cache', 'daybed.cache.NonceCache'))
     policies = [
         BasicAuthAuthenticationPolicy(check_credentials),
-        HawkAuthenticationPolicy(decode_hawk_id=get_credentials),
+        HawkAuthenticationPolicy(
+            decode_hawk_id=get_credentials,
+            nonce_cache=nonce_cache_class.load_from_config(config)),
     ]
     authn_policy = MultiAuthenticationPolicy(policies)
 
@@ -110,9 +119,12 @@ def main(global_config, **settings):
     # Events
 
     # Helper for notifying events
-    def notify(request, event, *args):
-        klass = config.maybe_dotted('daybed.events.' + event)
-        event = klass(*(args + (request,)))
+    event_classes = dict((name, getattr(events, name))
+                         for name in events.__all__)
+
+    def notify(request, event, *args, **payload):
+        klass = event_classes[event]
+        event = klass(*(args + (request,)), **payload)
         request.registry.notify(event)
 
     config.add_request_method(notify, 'notify')
@@ -125,23 +137,67 @@ def main(global_config, **settings):
     backend_class = config.maybe_dotted(settings['daybed.backend'])
     config.registry.backend = backend_class.load_from_config(config)
 
+    # Records schemas cache
+    schemas_cache_size = int(settings.get('daybed.record_schemas_cache_size',
+                                          512))
+    config.registry.record_schemas = LRUCache(schemas_cache_size)
+    config.add_subscriber(invalidate_record_schemas, events.ModelUpdated)
+    config.add_subscriber(invalidate_record_schemas, events.ModelDeleted)
+
+    # Credentials keys cache
+    config.registry.credentials_cache = CredentialsCache(
+        int(settings.get('daybed.credentials_cache_size', 1000)),
+        ttl=float(settings.get('daybed.credentials_cache_ttl', 300)))
+
+    # Models permissions cache
+    permissions_cache = None
+    permissions_cache_size = int(settings.get('daybed.permissions_cache_size',
+                                              0))
+    if permissions_cache_size > 0:
+        shared = asbool(settings.get('daybed.permissions_cache_redis', False))
+        permissions_cache = PermissionsCache(
+            permissions_cache_size,
+            ttl=float(settings.get('daybed.permissions_cache_ttl', 60)),
+            redis=backend_redis(settings) if shared else None
+        )
+        atexit.register(permissions_cache.stop)
+    config.registry.permissions_cache = permissions_cache
+
     # Indexing
 
-    # Connect client to hosts in conf
-    index_hosts = build_list(settings.get('elasticsearch.hosts',
-                                          "localhost:9200"))
-    indices_prefix = settings.get('elasticsearch.indices_prefix', 'daybed_')
-    config.registry.index = index = indexer.ElasticSearchIndexer(
-        index_hosts, indices_prefix
-    )
+    indexer_class = config.maybe_dotted(
+        settings.get('daybed.indexer', 'daybed.indexer.ElasticSearchIndexer'))
+    config.registry.index = index = indexer_class.load_from_config(config)
+
+    # Search results cache
+    search_cache = None
+    search_cache_size = int(settings.get('daybed.search_cache_size', 0))
+    if search_cache_size > 0:
+        shared = asbool(settings.get('daybed.search_cache_redis', False))
+        search_cache = SearchCache(
+            search_cache_size,
+            ttl=float(settings.get('daybed.search_cache_ttl', 60)),
+            redis=backend_redis(settings) if shared else None,
+            settle_delay=float(settings.get('daybed.search_cache_settle_delay',
+                                            index.settle_delay))
+        )
+        for event in (events.ModelUpdated, events.ModelDeleted,
+                      events.RecordCreated, events.RecordsCreated,
+                      events.RecordUpdated, events.RecordDeleted,
+                      events.AllRecordsDeleted):
+            config.add_subscriber(search_cache.on_model_changed, event)
+    config.registry.search_cache = search_cache
 
     # Suscribe index methods to API events
     config.add_subscriber(index.on_model_created, events.ModelCreated)
     config.add_subscriber(index.on_model_updated, events.ModelUpdated)
     config.add_subscriber(index.on_model_deleted, events.ModelDeleted)
     config.add_subscriber(index.on_record_created, events.RecordCreated)
+    config.add_subscriber(index.on_records_created, events.RecordsCreated)
     config.add_subscriber(index.on_record_updated, events.RecordUpdated)
     config.add_subscriber(index.on_record_deleted, events.RecordDeleted)
+    config.add_subscriber(index.on_all_records_deleted,
+                          events.AllRecordsDeleted)
 
     # Renderers
 
@@ -155,16 +211,27 @@ def main(global_config, **settings):
 
     config.add_subscriber(add_default_accept, NewRequest)
 
-    # JSONP
-    config.add_renderer('jsonp', JSONP(param_name='callback'))
+    # JSONP, with streaming of records iterators
+    config.add_renderer('jsonp', StreamingJSONP(param_name='callback'))
 
     # Geographic data renderer
     config.add_renderer('geojson', GeoJSON())
 
+    # Newline delimited JSON, for exports
+    config.add_renderer('ndjson', NDJSON())
+
     # Requests attachments
 
+    def log_avoided_reads(request):
+        if request.db.avoided_reads:
+            logger.debug("%s backend reads avoided by request cache",
+                         request.db.avoided_reads)
+
     def attach_objects_to_request(event):
-        event.request.db = config.registry.backend
+        # Models and records are read once per request.
+        event.request.db = RequestCache(config.registry.backend,
+                                        config.registry.permissions_cache)
+        event.request.add_finished_callback(log_avoided_reads)
         event.request.index = config.registry.index
         http_scheme = event.request.registry.settings.get('daybed.http_scheme')
         if http_scheme:
@@ -4,7 +4,7 @@ import socket
 import functools
 
 from couchdb.client import Server
-from couchdb.http import PreconditionFailed, Unauthorized
+from couchdb.http import PreconditionFailed, ResourceConflict, Unauthorized
 from couchdb.design import ViewDefinition
 
 from daybed import logger
@@ -28,12 +28,22 @@ class CouchDBBackend(object):
         return CouchDBBackend(
             host=settings['backend.db_host'],
             db_name=os.environ.get('DB_NAME', settings['backend.db_name']),
-            id_generator=generator(config)
+            id_generator=generator(config),
+            stale=settings.get('backend.stale') or None,
+            bulk_size=int(settings.get('backend.bulk_size', 1000))
         )
 
-    def __init__(self, host, db_name, id_generator):
+    def __init__(self, host, db_name, id_generator, stale=None,
+                 bulk_size=1000):
         self.server = Server(host)
         self.db_name = db_name
+        # Number of documents sent per ``_bulk_docs`` request.
+        self.bulk_size = bulk_size
+        # Read policy of views listing models and records (``ok`` or
+        # ``update_after``), so that reads don't wait for indexes updates.
+        self._read_options = {}
+        if stale is not None:
+            self._read_options['stale'] = stale
 
         try:
             self.create_db_if_not_exist()
@@ -57,12 +67,18 @@ class CouchDBBackend(object):
 
     def sync_views(self):
         ViewDefinition.sync_many(self.server[self.db_name], docs)
+        for doc_id in views.obsolete:
+            doc = self._db.get(doc_id)
+            if doc is not None:
+                self._db.delete(doc)
 
     def get_models(self, principals):
         principals = list(set(principals))
         models = {}
-        for result in views.models(self._db, keys=principals).rows:
-            doc = result.value
+        rows = views.models(self._db, keys=principals, include_docs=True,
+                            **self._read_options).rows
+        for result in rows:
+            doc = result.doc
             _id = doc["_id"]
             models[_id] = {
                 "id": _id,
@@ -71,43 +87,130 @@ class CouchDBBackend(object):
             }
         return list(models.values())
 
+    def get_model_ids(self):
+        return [row.id for row in views.models_ids(self._db)]
+
     def __get_raw_model(self, model_id):
-        try:
-            doc = views.model_definitions(self._db, key=model_id).rows[0]
-            return doc.value
-        except IndexError:
+        doc = self._db.get(model_id)
+        if doc is None or doc.get('type') != 'definition':
             raise backend_exceptions.ModelNotFound(model_id)
+        return doc
 
     def get_model_definition(self, model_id):
         return self.__get_raw_model(model_id)['definition']
 
-    def __get_raw_records(self, model_id):
+    def __get_raw_records(self, model_id, fresh=False):
         # Make sure the model exists.
         self.__get_raw_model(model_id)
-        return views.records(self._db, key=model_id).rows
+        options = {} if fresh else self._read_options
+        return views.records(self._db, key=model_id, include_docs=True,
+                             **options).rows
 
     def get_records(self, model_id, raw_records=None):
         return [r["record"] for r in
                 self.get_records_with_authors(model_id, raw_records)]
 
+    def get_records_page(self, model_id, limit, cursor=None):
+        """Returns at most ``limit`` records with their authors, ordered by
+        id and starting after the ``cursor`` record id, along with the cursor
+        of the next page (``None`` on the last one).
+        """
+        # Make sure the model exists.
+        self.__get_raw_model(model_id)
+
+        options = dict(startkey=model_id, endkey=model_id, limit=limit + 1,
+                       include_docs=True, **self._read_options)
+        if cursor is not None:
+            # The cursor row is returned too, if it still exists.
+            options['startkey_docid'] = u'-'.join((model_id, cursor))
+            options['limit'] += 1
+        rows = views.records(self._db, **options).rows
+        if cursor is not None and rows and \
+           rows[0].id == options['startkey_docid']:
+            rows = rows[1:]
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = rows[-1].id[len(model_id) + 1:]
+        return self.get_records_with_authors(model_id, rows), next_cursor
+
+    def iter_records_with_authors(self, model_id, batch_size=1000):
+        """Returns a generator of the model records with their authors, read
+        from the backend by pages of ``batch_size`` records.
+        """
+        records, cursor = self.get_records_page(model_id, batch_size)
+
+        def records_pages(records, cursor):
+            while True:
+                for record in records:
+                    yield record
+                if cursor is None:
+                    break
+                records, cursor = self.get_records_page(model_id, batch_size,
+                                                        cursor)
+        return records_pages(records, cursor)
+
     def get_records_with_authors(self, model_id, raw_records=None):
         if raw_records is None:
             raw_records = self.__get_raw_records(model_id)
         records = []
         for item in raw_records:
-            item.value['record']['id'] = item.value['_id'].split('-')[1]
-            records.append({"authors": item.value['authors'],
-                            "record": item.value['record']})
+            item.doc['record']['id'] = item.id[len(model_id) + 1:]
+            records.append({"authors": item.doc['authors'],
+                            "record": item.doc['record']})
         return records
 
+    def get_records_by_author(self, model_id, authors):
+        """Returns the model records of any of the authors, ordered by id.
+        """
+        # Make sure the model exists.
+        self.__get_raw_model(model_id)
+        keys = [[model_id, author] for author in set(authors)]
+        rows = views.records_by_author(self._db, keys=keys, include_docs=True,
+                                       **self._read_options).rows
+        # Records of several authors are returned once.
+        rows = dict((row.id, row) for row in rows)
+        rows = [rows[doc_id] for doc_id in sorted(rows)]
+        return self.get_records(model_id, rows)
+
+    def get_records_by_author_page(self, model_id, authors, limit,
+                                   cursor=None):
+        """Returns at most ``limit`` records of any of the authors, ordered
+        by id and starting after the ``cursor`` record id, along with the
+        cursor of the next page (``None`` on the last one).
+
+        Rows of a view key are sorted by document id, so that the first
+        records of each author are read from ``startkey_docid``.
+        """
+        # Make sure the model exists.
+        self.__get_raw_model(model_id)
+        rows = {}
+        for author in set(authors):
+            key = [model_id, author]
+            options = dict(startkey=key, endkey=key, limit=limit + 1,
+                           include_docs=True, **self._read_options)
+            if cursor is not None:
+                # The cursor row is returned too, if it still exists.
+                options['startkey_docid'] = u'-'.join((model_id, cursor))
+                options['limit'] += 1
+            for row in views.records_by_author(self._db, **options).rows:
+                if row.id != options.get('startkey_docid'):
+                    rows[row.id] = row
+        rows = [rows[doc_id] for doc_id in sorted(rows)[:limit + 1]]
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = rows[-1].id[len(model_id) + 1:]
+        return self.get_records(model_id, rows), next_cursor
+
     def __get_raw_record(self, model_id, record_id):
-        key = u'-'.join((model_id, record_id))
-        try:
-            return views.records_all(self._db, key=key).rows[0].value
-        except IndexError:
+        doc = self._db.get(u'-'.join((model_id, record_id)))
+        if doc is None or doc.get('type') != 'record':
             raise backend_exceptions.RecordNotFound(
                 u'(%s, %s)' % (model_id, record_id)
             )
+        return doc
 
     def _model_exists(self, model_id):
         try:
@@ -173,6 +276,42 @@ class CouchDBBackend(object):
         self._db.save(doc)
         return record_id
 
+    def __bulk_update(self, docs):
+        """Saves the documents using ``_bulk_docs`` requests of
+        ``bulk_size`` documents, and returns the results of each of them.
+
+        Failures are per document, callers have to check the results.
+        """
+        results = []
+        for start in range(0, len(docs), self.bulk_size):
+            results.extend(self._db.update(docs[start:start + self.bulk_size]))
+        return results
+
+    def put_records(self, model_id, records, authors):
+        """Stores new records with generated ids, and returns their ids."""
+        records_ids = [None] * len(records)
+        pending = list(range(len(records)))
+        # Records whose generated id was already taken are sent again.
+        while pending:
+            docs = []
+            for i in pending:
+                records_ids[i] = self._generate_id()
+                docs.append({
+                    '_id': '-'.join((model_id, records_ids[i])),
+                    'type': 'record',
+                    'authors': authors,
+                    'model_id': model_id,
+                    'record': records[i]})
+            results = self.__bulk_update(docs)
+            failed = []
+            for i, (success, _, error) in zip(pending, results):
+                if not success:
+                    if not isinstance(error, ResourceConflict):
+                        raise error
+                    failed.append(i)
+            pending = failed
+        return records_ids
+
     def delete_record(self, model_id, record_id):
         doc = self.__get_raw_record(model_id, record_id)
         if doc:
@@ -180,9 +319,24 @@ class CouchDBBackend(object):
         return doc
 
     def delete_records(self, model_id):
-        results = self.__get_raw_records(model_id)
-        for result in results:
-            self._db.delete(result.value)
+        # Never delete from a stale index.
+        results = self.__get_raw_records(model_id, fresh=True)
+        docs = [result.doc for result in results]
+        # Records updated meanwhile are deleted again at their new revision.
+        while docs:
+            statuses = self.__bulk_update([{'_id': doc['_id'],
+                                            '_rev': doc['_rev'],
+                                            '_deleted': True}
+                                           for doc in docs])
+            conflicted = []
+            for success, doc_id, error in statuses:
+                if not success:
+                    if not isinstance(error, ResourceConflict):
+                        raise error
+                    doc = self._db.get(doc_id)
+                    if doc is not None:
+                        conflicted.append(doc)
+            docs = conflicted
         return self.get_records(model_id, raw_records=results)
 
     def delete_model(self, model_id):
@@ -191,10 +345,7 @@ class CouchDBBackend(object):
         # Delete the associated data if any.
         records = self.delete_records(model_id)
 
-        try:
-            doc = views.model_definitions(self._db, key=model_id).rows[0].value
-        except IndexError:
-            raise backend_exceptions.ModelNotFound(model_id)
+        doc = self.__get_raw_model(model_id)
 
         # Delete the model definition if it exists.
         self._db.delete(doc)
@@ -204,7 +355,8 @@ class CouchDBBackend(object):
 
     def __get_raw_token(self, credentials_id):
         try:
-            return views.tokens(self._db, key=credentials_id).rows[0].value
+            return views.tokens(self._db, key=credentials_id,
+                                include_docs=True).rows[0].doc
         except IndexError:
             raise backend_exceptions.CredentialsNotFound(credentials_id)
 
@@ -2,23 +2,27 @@ from couchdb.design import ViewDefinition
 
 # Definition of CouchDB design documents, a.k.a. permanent views.
 
-""" Models id."""
+# Views emit no value: documents are fetched with ``include_docs`` when
+# needed, instead of being duplicated in the views indexes. Single models and
+# records are fetched by ``_id``.
+
+""" Models id, by principals allowed to read their definition."""
 models = ViewDefinition('models', 'by_principals', """
 function(doc) {
   if (doc.type == "definition") {
     for (var i = 0; i < doc.permissions.read_definition.length; i++) {
       var principal = doc.permissions.read_definition[i];
-      emit(principal, doc);
+      emit(principal, null);
     }
   }
 }""")
 
 
-""" Model definitions, by model id."""
-model_definitions = ViewDefinition('definitions', 'all', """
+""" Models id."""
+models_ids = ViewDefinition('models', 'all', """
 function(doc) {
   if (doc.type == "definition") {
-    emit(doc._id, doc);
+    emit(doc._id, null);
   }
 }""")
 
@@ -27,15 +31,17 @@ function(doc) {
 records = ViewDefinition('records', 'by_model', """
 function(doc) {
   if (doc.type == "record") {
-    emit(doc.model_id, doc);
+    emit(doc.model_id, null);
   }
 }""")
 
-""" Record, by id."""
-records_all = ViewDefinition('records_all', 'all', """
+""" Model records, by model name and author."""
+records_by_author = ViewDefinition('records', 'by_author', """
 function(doc) {
   if (doc.type == "record") {
-    emit(doc._id, doc);
+    for (var i = 0; i < doc.authors.length; i++) {
+      emit([doc.model_id, doc.authors[i]], null);
+    }
   }
 }""")
 
@@ -43,11 +49,14 @@ function(doc) {
 tokens = ViewDefinition('tokens', 'by_name', """
 function(doc){
   if(doc.type == 'token'){
-      emit(doc.credentials.id, doc);
+      emit(doc.credentials.id, null);
   }
 }
 """)
 
+""" Design documents of former versions, to be removed."""
+obsolete = ['_design/definitions', '_design/records_all']
+
 
 l = locals().values()
 docs = [v for v in l if isinstance(v, ViewDefinition)]
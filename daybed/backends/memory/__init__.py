@@ -1,3 +1,4 @@
+from bisect import bisect_left, bisect_right, insort
 from copy import deepcopy
 import functools
 
@@ -5,6 +6,12 @@ from daybed.backends import exceptions as backend_exceptions
 
 
 class MemoryBackend(object):
+    """Stores everything in a dict, for tests and ephemeral data.
+
+    Stored objects are copied on write, and never modified afterwards: reads
+    return them without copy. Callers must thus **not** mutate the models,
+    records and authors they obtain, and copy them first if needed.
+    """
 
     @classmethod
     def load_from_config(cls, config):
@@ -25,6 +32,10 @@ class MemoryBackend(object):
         self._db = {
             'models': {},
             'records': {},
+            # Sorted records ids by model, for pagination.
+            'ids': {},
+            # Sorted records ids by model and author.
+            'authors': {},
             'permissions': {},
             'tokens': {},
             'credentials_keys': {}
@@ -40,9 +51,12 @@ class MemoryBackend(object):
                 principals.intersection(m['permissions']['read_definition']) !=
                 set()]
 
+    def get_model_ids(self):
+        return list(self._db['models'].keys())
+
     def __get_raw_model(self, model_id):
         try:
-            return deepcopy(self._db['models'][model_id])
+            return self._db['models'][model_id]
         except KeyError:
             raise backend_exceptions.ModelNotFound(model_id)
 
@@ -59,19 +73,83 @@ class MemoryBackend(object):
         return [r["record"] for r in
                 self.get_records_with_authors(model_id, raw_records)]
 
+    def get_records_page(self, model_id, limit, cursor=None):
+        """Returns at most ``limit`` records with their authors, ordered by
+        id and starting after the ``cursor`` record id, along with the cursor
+        of the next page (``None`` on the last one).
+        """
+        try:
+            raw_records = self._db['records'][model_id]
+        except KeyError:
+            raise backend_exceptions.ModelNotFound(model_id)
+        records_ids = self._db['ids'][model_id]
+        start = 0
+        if cursor is not None:
+            start = bisect_right(records_ids, cursor)
+        page_ids = records_ids[start:start + limit]
+        next_cursor = None
+        if start + limit < len(records_ids):
+            next_cursor = page_ids[-1]
+        page = [raw_records[record_id] for record_id in page_ids]
+        return self.get_records_with_authors(model_id, page), next_cursor
+
+    def iter_records_with_authors(self, model_id):
+        """Returns a generator of the model records with their authors, as
+        they were when called.
+        """
+        raw_records = list(self.__get_raw_records(model_id))
+        return (self.__record_with_authors(item) for item in raw_records)
+
+    def __record_with_authors(self, doc):
+        return {"authors": doc['authors'], "record": doc['record']}
+
     def get_records_with_authors(self, model_id, raw_records=None):
         if raw_records is None:
             raw_records = self.__get_raw_records(model_id)
-        records = []
-        for item in raw_records:
-            item['record']['id'] = item['_id']
-            records.append({"authors": deepcopy(item['authors']),
-                            "record": deepcopy(item['record'])})
-        return records
+        return [self.__record_with_authors(item) for item in raw_records]
+
+    def get_records_by_author(self, model_id, authors):
+        """Returns the model records of any of the authors, ordered by id.
+        """
+        raw_records = self._db['records'].get(model_id)
+        if raw_records is None:
+            raise backend_exceptions.ModelNotFound(model_id)
+        index = self._db['authors'].get(model_id, {})
+        records_ids = set()
+        for author in authors:
+            records_ids.update(index.get(author, ()))
+        return [raw_records[record_id]['record']
+                for record_id in sorted(records_ids)]
+
+    def get_records_by_author_page(self, model_id, authors, limit,
+                                   cursor=None):
+        """Returns at most ``limit`` records of any of the authors, ordered
+        by id and starting after the ``cursor`` record id, along with the
+        cursor of the next page (``None`` on the last one).
+        """
+        raw_records = self._db['records'].get(model_id)
+        if raw_records is None:
+            raise backend_exceptions.ModelNotFound(model_id)
+        index = self._db['authors'].get(model_id, {})
+        # The page is among the first records of each author.
+        records_ids = set()
+        for author in set(authors):
+            author_ids = index.get(author, [])
+            start = 0
+            if cursor is not None:
+                start = bisect_right(author_ids, cursor)
+            records_ids.update(author_ids[start:start + limit + 1])
+        records_ids = sorted(records_ids)[:limit + 1]
+        next_cursor = None
+        if len(records_ids) > limit:
+            records_ids = records_ids[:limit]
+            next_cursor = records_ids[-1]
+        return ([raw_records[record_id]['record']
+                 for record_id in records_ids], next_cursor)
 
     def __get_raw_record(self, model_id, record_id):
         try:
-            return deepcopy(self._db['records'][model_id][record_id])
+            return self._db['records'][model_id][record_id]
         except KeyError:
             raise backend_exceptions.RecordNotFound(
                 u'(%s, %s)' % (model_id, record_id)
@@ -79,9 +157,7 @@ class MemoryBackend(object):
 
     def get_record(self, model_id, record_id):
         doc = self.__get_raw_record(model_id, record_id)
-        record = doc['record']
-        record['id'] = record_id
-        return record
+        return doc['record']
 
     def get_record_authors(self, model_id, record_id):
         doc = self.__get_raw_record(model_id, record_id)
@@ -93,10 +169,11 @@ class MemoryBackend(object):
 
         self._db['models'][model_id] = {
             'definition': deepcopy(definition),
-            'permissions': permissions
+            'permissions': deepcopy(permissions)
         }
         if model_id not in self._db['records']:
             self._db['records'][model_id] = {}
+            self._db['ids'][model_id] = []
         return model_id
 
     def _record_exists(self, model_id, record_id):
@@ -106,37 +183,64 @@ class MemoryBackend(object):
         return model_id in self._db['records']
 
     def put_record(self, model_id, record, authors, record_id=None):
-        doc = {
-            'authors': authors,
-            'record': record
-        }
+        # Stored documents are replaced, never modified (see class docstring)
+        record = deepcopy(record)
+        authors = list(authors)
 
         if record_id is not None:
             try:
                 old_doc = self.__get_raw_record(model_id, record_id)
             except backend_exceptions.RecordNotFound:
-                doc['_id'] = record_id
+                pass
             else:
-                old_doc["record"].update(doc["record"])
-                doc = old_doc
-                doc['authors'] = list(set(authors) | set(old_doc['authors']))
+                old_record = deepcopy(old_doc['record'])
+                old_record.update(record)
+                record = old_record
+                authors = list(set(authors) | set(old_doc['authors']))
         else:
             key_exist = functools.partial(self._record_exists, model_id)
             record_id = self._generate_id(key_exist=key_exist)
-            doc['_id'] = record_id
 
-        self._db['records'][model_id][record_id] = doc
+        record['id'] = record_id
+        if record_id not in self._db['records'][model_id]:
+            insort(self._db['ids'][model_id], record_id)
+        self._db['records'][model_id][record_id] = {
+            '_id': record_id,
+            'authors': authors,
+            'record': record
+        }
+        index = self._db['authors'].setdefault(model_id, {})
+        for author in authors:
+            author_ids = index.setdefault(author, [])
+            position = bisect_left(author_ids, record_id)
+            if author_ids[position:position + 1] != [record_id]:
+                author_ids.insert(position, record_id)
         return record_id
 
+    def put_records(self, model_id, records, authors):
+        """Stores new records with generated ids, and returns their ids."""
+        return [self.put_record(model_id, record, authors)
+                for record in records]
+
     def delete_record(self, model_id, record_id):
         doc = self.__get_raw_record(model_id, record_id)
         if doc:
             del self._db['records'][model_id][record_id]
+            records_ids = self._db['ids'][model_id]
+            del records_ids[bisect_left(records_ids, record_id)]
+            index = self._db['authors'].get(model_id, {})
+            for author in doc['authors']:
+                author_ids = index.get(author, [])
+                position = bisect_left(author_ids, record_id)
+                if author_ids[position:position + 1] == [record_id]:
+                    del author_ids[position]
         return doc
 
     def delete_records(self, model_id):
         results = self.get_records(model_id)
         del self._db['records'][model_id]
+        del self._db['ids'][model_id]
+        self._db['authors'].pop(model_id, None)
         return results
 
     def delete_model(self, model_id):
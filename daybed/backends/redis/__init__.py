@@ -1,10 +1,144 @@
+import binascii
 import json
-import functools
 import redis
 
+from daybed import logger
 from daybed.backends import exceptions as backend_exceptions
 
 
+# Server-side scripts, so that each write is a single atomic round trip.
+
+PUT_MODEL_SCRIPT = """
+-- KEYS: model key, models index key
+-- ARGV: model id, JSON model, JSON list of principals allowed to read it
+-- Models ids are indexed by principals allowed to read their definition, in
+-- the ``readablemodels.<principal>`` sets.
+local old = redis.call('GET', KEYS[1])
+if old then
+    local readers = cjson.decode(old)['permissions']['read_definition']
+    for _, principal in ipairs(readers or {}) do
+        redis.call('SREM', 'readablemodels.' .. principal, ARGV[1])
+    end
+end
+redis.call('SET', KEYS[1], ARGV[2])
+redis.call('SADD', KEYS[2], ARGV[1])
+for _, principal in ipairs(cjson.decode(ARGV[3])) do
+    redis.call('SADD', 'readablemodels.' .. principal, ARGV[1])
+end
+"""
+
+AUTHOR_RECORDS_KEY_FUNCTION = """
+-- Records keys are indexed by author in ``recordsbyauthor.<model>.<author>``
+-- sorted sets, with the author hex-encoded: models ids and principals may
+-- contain dots, but the last one of the key always separates them.
+local function author_records_key(model, author)
+    local encoded = author:gsub('.', function(c)
+        return string.format('%02x', string.byte(c))
+    end)
+    return 'recordsbyauthor.' .. model .. '.' .. encoded
+end
+"""
+
+PUT_RECORD_SCRIPT = AUTHOR_RECORDS_KEY_FUNCTION + """
+-- KEYS: record key, model records index key
+-- ARGV: JSON record, JSON authors, '1' to fail if the record exists, model id
+-- Authors of each model are indexed in ``modelauthors.<model>`` sets.
+local authors = cjson.decode(ARGV[2])
+local old = redis.call('GET', KEYS[1])
+if old then
+    if ARGV[3] == '1' then
+        return 0
+    end
+    -- Merge authors of the existing record.
+    local known = {}
+    for _, author in ipairs(authors) do
+        known[author] = true
+    end
+    for _, author in ipairs(cjson.decode(old)['authors']) do
+        if not known[author] then
+            table.insert(authors, author)
+            known[author] = true
+        end
+    end
+end
+-- The record itself is not decoded, to leave its serialization untouched
+-- (e.g. cjson would encode empty lists as objects).
+local encoded = '[]'
+if #authors > 0 then
+    encoded = cjson.encode(authors)
+end
+redis.call('SET', KEYS[1],
+           '{"authors": ' .. encoded .. ', "record": ' .. ARGV[1] .. '}')
+redis.call('ZADD', KEYS[2], 0, KEYS[1])
+for _, author in ipairs(authors) do
+    redis.call('ZADD', author_records_key(ARGV[4], author), 0, KEYS[1])
+    redis.call('SADD', 'modelauthors.' .. ARGV[4], author)
+end
+return 1
+"""
+
+DELETE_RECORD_SCRIPT = AUTHOR_RECORDS_KEY_FUNCTION + """
+-- KEYS: record key, model records index key
+-- ARGV: model id
+-- Returns the deleted record, or nil if unknown.
+local doc = redis.call('GET', KEYS[1])
+if not doc then
+    return false
+end
+redis.call('DEL', KEYS[1])
+redis.call('ZREM', KEYS[2], KEYS[1])
+for _, author in ipairs(cjson.decode(doc)['authors']) do
+    redis.call('ZREM', author_records_key(ARGV[1], author), KEYS[1])
+end
+return doc
+"""
+
+DELETE_RECORDS_SCRIPT = AUTHOR_RECORDS_KEY_FUNCTION + """
+-- KEYS: model key, model records index key, models index key
+-- ARGV: '1' to delete the model too, model id
+-- Returns the model followed by the deleted records, or nil if unknown.
+local model = redis.call('GET', KEYS[1])
+if not model then
+    return false
+end
+local docs = {model}
+local keys = redis.call('ZRANGE', KEYS[2], 0, -1)
+-- Keys are handled by batches, to stay within Lua stack limits.
+for i = 1, #keys, 1000 do
+    local batch = {unpack(keys, i, math.min(i + 999, #keys))}
+    for _, doc in ipairs(redis.call('MGET', unpack(batch))) do
+        if doc then
+            table.insert(docs, doc)
+        end
+    end
+    redis.call('DEL', unpack(batch))
+end
+redis.call('DEL', KEYS[2])
+local authors = redis.call('SMEMBERS', 'modelauthors.' .. ARGV[2])
+for _, author in ipairs(authors) do
+    redis.call('DEL', author_records_key(ARGV[2], author))
+end
+redis.call('DEL', 'modelauthors.' .. ARGV[2])
+if ARGV[1] == '1' then
+    redis.call('DEL', KEYS[1])
+    redis.call('SREM', KEYS[3], ARGV[2])
+    local readers = cjson.decode(model)['permissions']['read_definition']
+    for _, principal in ipairs(readers or {}) do
+        redis.call('SREM', 'readablemodels.' .. principal, ARGV[2])
+    end
+end
+return docs
+"""
+
+
+def author_records_key(model_id, author):
+    """Returns the key of the sorted set of the model records keys written
+    by the author (see ``AUTHOR_RECORDS_KEY_FUNCTION``).
+    """
+    encoded = binascii.hexlify(author.encode('utf-8')).decode('ascii')
+    return 'recordsbyauthor.%s.%s' % (model_id, encoded)
+
+
 class RedisBackend(object):
 
     @classmethod
@@ -25,22 +159,118 @@ class RedisBackend(object):
         self._db.ping()
         self._generate_id = id_generator
 
+        self._put_model = self._db.register_script(PUT_MODEL_SCRIPT)
+        self._put_record = self._db.register_script(PUT_RECORD_SCRIPT)
+        self._delete_record = self._db.register_script(DELETE_RECORD_SCRIPT)
+        self._delete_records = self._db.register_script(DELETE_RECORDS_SCRIPT)
+
     def delete_db(self):
         self._db.flushdb()
 
+    def migrate(self):
+        """Builds the indexes of databases written by former versions. It
+        can be run several times, but should be run before the new version
+        serves requests.
+        """
+        models = self.__migrate_models()
+        logger.info("Indexed %s models" % models)
+        converted = self.__migrate_records_sets()
+        logger.info("Converted %s sets of records keys" % converted)
+        records = self.__migrate_authors_index()
+        logger.info("Indexed %s records by author" % records)
+
+    def __migrate_models(self):
+        """Indexes models ids in the ``models`` set, and in the
+        ``readablemodels.<principal>`` sets.
+        """
+        count = 0
+        for key in self._db.scan_iter("model.*"):
+            doc = self._db.get(key)
+            if doc is None:
+                continue
+            model = json.loads(doc.decode("utf-8"))
+            readers = model['permissions'].get('read_definition', [])
+            with self._db.pipeline(transaction=False) as pipe:
+                pipe.sadd("models", model['id'])
+                for principal in readers:
+                    pipe.sadd("readablemodels.%s" % principal, model['id'])
+                pipe.execute()
+            count += 1
+        return count
+
+    def __migrate_records_sets(self, batch_size=1000):
+        """Converts the ``modelrecords.<model>`` sets of records keys into
+        sorted sets.
+        """
+        count = 0
+        for key in self._db.scan_iter("modelrecords.*"):
+            if self._db.type(key) != b"set":
+                continue
+            members = list(self._db.smembers(key))
+            with self._db.pipeline() as pipe:
+                pipe.delete(key)
+                for start in range(0, len(members), batch_size):
+                    args = []
+                    for member in members[start:start + batch_size]:
+                        args.extend([0, member])
+                    pipe.execute_command("ZADD", key, *args)
+                pipe.execute()
+            count += 1
+        return count
+
+    def __migrate_authors_index(self, batch_size=1000):
+        """Indexes records keys in the ``recordsbyauthor.<model>.<author>``
+        sorted sets, and authors in the ``modelauthors.<model>`` sets.
+
+        The former ``authorrecords.<model>.<author>`` sets are deleted, since
+        their keys were ambiguous with dotted ids.
+        """
+        former = list(self._db.scan_iter("authorrecords.*"))
+        for start in range(0, len(former), batch_size):
+            self._db.delete(*former[start:start + batch_size])
+        count = 0
+        for model_id in self.get_model_ids():
+            key = "modelrecords.%s" % model_id
+            for start in range(0, self._db.zcard(key), batch_size):
+                records_keys = self._db.zrange(key, start,
+                                               start + batch_size - 1)
+                docs = self._db.mget(*records_keys) if records_keys else []
+                with self._db.pipeline(transaction=False) as pipe:
+                    for record_key, doc in zip(records_keys, docs):
+                        if doc is None:
+                            continue
+                        authors = json.loads(doc.decode("utf-8"))["authors"]
+                        for author in authors:
+                            pipe.execute_command(
+                                "ZADD", author_records_key(model_id, author),
+                                0, record_key)
+                            pipe.sadd("modelauthors.%s" % model_id, author)
+                        count += 1
+                    pipe.execute()
+        return count
+
     def get_models(self, principals):
+        """Returns the models whose definition can be read by any of the
+        principals, looked up in the sets of readable models ids maintained
+        by ``put_model`` and ``delete_model``.
+        """
         principals = set(principals)
-        models_id = self._db.keys("model.*")
-        if models_id:
-            models = [json.loads(m.decode("utf-8"))
-                      for m in self._db.mget(*models_id) if m]
-            return [{"id": m['id'],
-                     "title": m['definition']['title'],
-                     "description": m['definition']['description']}
-                    for m in models if principals.intersection(
-                        m['permissions']['read_definition']) != set()]
-        else:
+        if not principals:
             return []
+        models_id = self._db.sunion(*["readablemodels.%s" % p
+                                      for p in principals])
+        if not models_id:
+            return []
+        models_keys = ["model.%s" % m.decode("utf-8") for m in models_id]
+        models = [json.loads(m.decode("utf-8"))
+                  for m in self._db.mget(*models_keys) if m]
+        return [{"id": m['id'],
+                 "title": m['definition']['title'],
+                 "description": m['definition']['description']}
+                for m in models]
+
+    def get_model_ids(self):
+        return [m.decode("utf-8") for m in self._db.smembers("models")]
 
     def __get_raw_model(self, model_id):
         model = self._db.get("model.%s" % model_id)
@@ -60,9 +290,7 @@ class RedisBackend(object):
         # Check if the model still exists or raise
         self.__get_raw_model(model_id)
 
-        model_records = self._db.smembers(
-            "modelrecords.%s" % model_id
-        )
+        model_records = self._db.zrange("modelrecords.%s" % model_id, 0, -1)
         if model_records:
             return [json.loads(i.decode("utf-8"))
                     for i in self._db.mget(*model_records)]
@@ -73,15 +301,106 @@ class RedisBackend(object):
         return [r["record"] for r in
                 self.get_records_with_authors(model_id, raw_records)]
 
+    def get_records_page(self, model_id, limit, cursor=None):
+        """Returns at most ``limit`` records with their authors, ordered by
+        id and starting after the ``cursor`` record id, along with the cursor
+        of the next page (``None`` on the last one).
+
+        Records keys are kept in a sorted set with a constant score, so that
+        pages are read with ``ZRANGEBYLEX`` instead of fetching all of them.
+        """
+        # Check if the model still exists or raise
+        self.__get_raw_model(model_id)
+
+        start = '-'
+        if cursor is not None:
+            start = "(modelrecord.%s.%s" % (model_id, cursor)
+        records_keys = self._db.zrangebylex("modelrecords.%s" % model_id,
+                                            start, '+', 0, limit + 1)
+        has_next = len(records_keys) > limit
+        records_keys = records_keys[:limit]
+        records = []
+        if records_keys:
+            records = [json.loads(i.decode("utf-8"))
+                       for i in self._db.mget(*records_keys)]
+        next_cursor = None
+        if has_next:
+            next_cursor = records[-1]["record"]["id"]
+        return self.get_records_with_authors(model_id, records), next_cursor
+
+    def iter_records_with_authors(self, model_id, batch_size=1000):
+        """Returns a generator of the model records with their authors, read
+        from the backend by pages of ``batch_size`` records.
+        """
+        records, cursor = self.get_records_page(model_id, batch_size)
+
+        def records_pages(records, cursor):
+            while True:
+                for record in records:
+                    yield record
+                if cursor is None:
+                    break
+                records, cursor = self.get_records_page(model_id, batch_size,
+                                                        cursor)
+        return records_pages(records, cursor)
+
     def get_records_with_authors(self, model_id, raw_records=None):
         if raw_records is None:
             raw_records = self.__get_raw_records(model_id)
         records = []
-        for item in self.__get_raw_records(model_id):
+        for item in raw_records:
             records.append({"authors": item["authors"],
                             "record": item["record"]})
         return records
 
+    def get_records_by_author(self, model_id, authors):
+        """Returns the model records of any of the authors, ordered by id,
+        looked up in the sets of records maintained by ``put_record`` and
+        ``delete_record``.
+        """
+        # Check if the model still exists or raise
+        self.__get_raw_model(model_id)
+
+        with self._db.pipeline(transaction=False) as pipe:
+            for author in set(authors):
+                pipe.zrange(author_records_key(model_id, author), 0, -1)
+            records_keys = sorted(set().union(*pipe.execute()))
+        if not records_keys:
+            return []
+        return [json.loads(doc.decode("utf-8"))["record"]
+                for doc in self._db.mget(*records_keys) if doc]
+
+    def get_records_by_author_page(self, model_id, authors, limit,
+                                   cursor=None):
+        """Returns at most ``limit`` records of any of the authors, ordered
+        by id and starting after the ``cursor`` record id, along with the
+        cursor of the next page (``None`` on the last one).
+
+        The first records keys of each author are read with ``ZRANGEBYLEX``,
+        in a single round trip.
+        """
+        # Check if the model still exists or raise
+        self.__get_raw_model(model_id)
+
+        start = '-'
+        if cursor is not None:
+            start = "(modelrecord.%s.%s" % (model_id, cursor)
+        with self._db.pipeline(transaction=False) as pipe:
+            for author in set(authors):
+                pipe.zrangebylex(author_records_key(model_id, author),
+                                 start, '+', 0, limit + 1)
+            records_keys = sorted(set().union(*pipe.execute()))[:limit + 1]
+        has_next = len(records_keys) > limit
+        records_keys = records_keys[:limit]
+        records = []
+        if records_keys:
+            records = [json.loads(doc.decode("utf-8"))["record"]
+                       for doc in self._db.mget(*records_keys) if doc]
+        next_cursor = None
+        if has_next and records:
+            next_cursor = records[-1]["id"]
+        return records, next_cursor
+
     def __get_raw_record(self, model_id, record_id):
         record = self._db.get("modelrecord.%s.%s" % (model_id, record_id))
         if record is not None:
@@ -105,78 +424,96 @@ class RedisBackend(object):
         if model_id is None:
             model_id = self._generate_id(key_exist=self._model_exists)
 
-        self._db.set(
-            "model.%s" % model_id,
-            json.dumps({
-                'id': model_id,
-                'definition': definition,
-                'permissions': permissions
-            })
-        )
+        doc = json.dumps({
+            'id': model_id,
+            'definition': definition,
+            'permissions': permissions
+        })
+        readers = permissions.get('read_definition', [])
+        self._put_model(keys=["model.%s" % model_id, "models"],
+                        args=[model_id, doc, json.dumps(readers)])
         return model_id
 
-    def _record_exists(self, model_id, record_id):
-        record = self._db.get("modelrecord.%s.%s" % (model_id, record_id))
-        return record is not None
-
     def put_record(self, model_id, record, authors, record_id=None):
-        doc = {
-            'authors': authors,
-            'record': record
-        }
-
-        if record_id is not None:
-            try:
-                old_doc = self.__get_raw_record(model_id, record_id)
-            except backend_exceptions.RecordNotFound:
-                pass
-            else:
-                authors = list(set(authors) | set(old_doc['authors']))
-                doc['authors'] = authors
-                old_doc.update(doc)
-                doc = old_doc
-        else:
-            key_exist = functools.partial(self._record_exists, model_id)
-            record_id = self._generate_id(key_exist=key_exist)
-
-        doc['record']['id'] = record_id
-        self._db.set(
-            "modelrecord.%s.%s" % (model_id, record_id),
-            json.dumps(doc)
-        )
-        self._db.sadd(
-            "modelrecords.%s" % model_id,
-            "modelrecord.%s.%s" % (model_id, record_id)
-        )
-        return record_id
+        """Stores the record in one round trip. Authors of an existing record
+        are merged atomically with the specified ones.
+        """
+        generate_id = record_id is None
+        while True:
+            if generate_id:
+                # Instead of checking its existence first, the record is not
+                # stored if the generated id is already taken.
+                record_id = self._generate_id()
+            record['id'] = record_id
+            key = "modelrecord.%s.%s" % (model_id, record_id)
+            stored = self._put_record(
+                keys=[key, "modelrecords.%s" % model_id],
+                args=[json.dumps(record), json.dumps(authors),
+                      int(generate_id), model_id])
+            if stored:
+                return record_id
+
+    def put_records(self, model_id, records, authors, batch_size=1000):
+        """Stores new records with generated ids, and returns their ids.
+
+        Records are sent by pipelines of ``batch_size`` records.
+        """
+        records_ids = []
+        for start in range(0, len(records), batch_size):
+            batch = records[start:start + batch_size]
+            pending = list(range(len(batch)))
+            batch_ids = [None] * len(batch)
+            # Records whose generated id was already taken are sent again.
+            while pending:
+                with self._db.pipeline(transaction=False) as pipe:
+                    for i in pending:
+                        batch_ids[i] = self._generate_id()
+                        batch[i]['id'] = batch_ids[i]
+                        key = "modelrecord.%s.%s" % (model_id, batch_ids[i])
+                        self._put_record(
+                            keys=[key, "modelrecords.%s" % model_id],
+                            args=[json.dumps(batch[i]), json.dumps(authors),
+                                  1, model_id],
+                            client=pipe)
+                    stored = pipe.execute()
+                pending = [i for i, ok in zip(pending, stored) if not ok]
+            records_ids.extend(batch_ids)
+        return records_ids
 
     def delete_record(self, model_id, record_id):
-        doc = self.__get_raw_record(model_id, record_id)
-        if doc:
-            self._db.delete("modelrecord.%s.%s" % (model_id, record_id))
-            self._db.srem(
-                "modelrecords.%s" % model_id,
-                "modelrecord.%s.%s" % (model_id, record_id)
+        key = "modelrecord.%s.%s" % (model_id, record_id)
+        doc = self._delete_record(keys=[key, "modelrecords.%s" % model_id],
+                                  args=[model_id])
+        if doc is None:
+            raise backend_exceptions.RecordNotFound(
+                u'(%s, %s)' % (model_id, record_id)
             )
-            return doc
+        return json.loads(doc.decode("utf-8"))
+
+    def __delete_records(self, model_id, delete_model=False):
+        """Deletes all records of the model, and the model itself if
+        specified, in one round trip.
+
+        Returns the model document and the list of deleted records.
+        """
+        docs = self._delete_records(
+            keys=["model.%s" % model_id, "modelrecords.%s" % model_id,
+                  "models"],
+            args=[int(delete_model), model_id])
+        if docs is None:
+            raise backend_exceptions.ModelNotFound(model_id)
+        docs = [json.loads(doc.decode("utf-8")) for doc in docs]
+        return docs[0], [doc["record"] for doc in docs[1:]]
 
     def delete_records(self, model_id):
-        records = self.get_records(model_id)
-        existing_records_keys = [
-            "modelrecord.%s.%s" % (model_id, r["id"]) for r in records
-        ]
-        existing_records_keys.append("modelrecords.%s" % model_id)
-
-        self._db.delete(*existing_records_keys)
+        _, records = self.__delete_records(model_id)
         return records
 
     def delete_model(self, model_id):
-        doc = self.__get_raw_model(model_id)
-        doc["records"] = self.delete_records(model_id)
-        self._db.delete("model.%s" % model_id)
+        doc, records = self.__delete_records(model_id, delete_model=True)
         return {
             "definition": doc["definition"],
-            "records": doc["records"],
+            "records": records,
             "permissions": doc["permissions"]
         }
 
@@ -195,14 +532,11 @@ class RedisBackend(object):
         return credentials_key.decode("utf-8")
 
     def store_credentials(self, token, credentials):
-        # Check that the token doesn't already exist.
         assert 'id' in credentials and 'key' in credentials
-        try:
-            self.get_token(credentials['id'])
+        # Fails atomically if the token already exists.
+        created = self._db.msetnx({
+            "token.%s" % credentials['id']: token,
+            "credentials_key.%s" % credentials['id']: credentials['key']
+        })
+        if not created:
             raise backend_exceptions.CredentialsAlreadyExist(credentials['id'])
-        except backend_exceptions.CredentialsNotFound:
-            pass
-
-        self._db.set("token.%s" % credentials['id'], token)
-        self._db.set("credentials_key.%s" % credentials['id'],
-                     credentials['key'])
@@ -0,0 +1,138 @@
+from daybed.backends import exceptions as backend_exceptions
+from daybed.permissions import principals_masks
+
+
+class RequestCache(object):
+    """Wraps a backend during a request, so that models and records are read
+    only once, even if they are needed by permissions checks, validators,
+    views and indexer.
+
+    Reads are forgotten when the request writes the related model or record.
+    Other methods are passed through to the backend.
+
+    Models permissions can also be kept between requests, in the given
+    ``permissions`` cache (see ``daybed.cache.PermissionsCache``).
+    """
+    def __init__(self, backend, permissions=None):
+        self.backend = backend
+        self.permissions = permissions
+        # Number of reads served without reaching the backend.
+        self.avoided_reads = 0
+        self._models = {}
+        self._records = {}
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def __cached(self, cache, key, method, *args):
+        try:
+            result = cache[key]
+            self.avoided_reads += 1
+        except KeyError:
+            try:
+                result = method(*args)
+            except (backend_exceptions.ModelNotFound,
+                    backend_exceptions.RecordNotFound) as e:
+                result = e
+            cache[key] = result
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def __forget_model(self, model_id, records=False):
+        for attr in ('definition', 'permissions', 'masks'):
+            self._models.pop((model_id, attr), None)
+        if records:
+            self._records = dict((key, value)
+                                 for key, value in self._records.items()
+                                 if key[0] != model_id)
+
+    def __forget_permissions(self, model_id):
+        """Forgets the permissions kept between requests."""
+        if self.permissions is not None:
+            self.permissions.invalidate(model_id)
+
+    def __forget_record(self, model_id, record_id):
+        for attr in ('record', 'authors'):
+            self._records.pop((model_id, record_id, attr), None)
+
+    def get_model_definition(self, model_id):
+        return self.__cached(self._models, (model_id, 'definition'),
+                             self.backend.get_model_definition, model_id)
+
+    def get_model_permissions(self, model_id):
+        load = self.backend.get_model_permissions
+        if self.permissions is not None:
+            load = self.__shared_permissions
+        return self.__cached(self._models, (model_id, 'permissions'),
+                             load, model_id)
+
+    def __shared_permissions(self, model_id):
+        return self.permissions.get(model_id,
+                                    self.backend.get_model_permissions)
+
+    def get_model_masks(self, model_id):
+        """Returns the permissions masks of the principals of the model
+        (see ``daybed.permissions.principals_masks``).
+        """
+        return self.__cached(self._models, (model_id, 'masks'),
+                             self.__load_masks, model_id)
+
+    def __load_masks(self, model_id):
+        if self.permissions is not None:
+            return self.permissions.get_masks(
+                model_id, self.backend.get_model_permissions)
+        return principals_masks(self.get_model_permissions(model_id))
+
+    def get_record(self, model_id, record_id):
+        return self.__cached(self._records, (model_id, record_id, 'record'),
+                             self.backend.get_record, model_id, record_id)
+
+    def get_record_authors(self, model_id, record_id):
+        return self.__cached(self._records, (model_id, record_id, 'authors'),
+                             self.backend.get_record_authors,
+                             model_id, record_id)
+
+    def put_model(self, definition, permissions, model_id=None):
+        try:
+            model_id = self.backend.put_model(definition, permissions,
+                                              model_id)
+            return model_id
+        finally:
+            if model_id is not None:
+                self.__forget_model(model_id)
+                self.__forget_permissions(model_id)
+
+    def delete_model(self, model_id):
+        try:
+            return self.backend.delete_model(model_id)
+        finally:
+            self.__forget_model(model_id, records=True)
+            self.__forget_permissions(model_id)
+
+    def put_record(self, model_id, record, authors, record_id=None):
+        try:
+            record_id = self.backend.put_record(model_id, record, authors,
+                                                record_id)
+            return record_id
+        finally:
+            if record_id is not None:
+                self.__forget_record(model_id, record_id)
+
+    def put_records(self, model_id, records, authors):
+        records_ids = self.backend.put_records(model_id, records, authors)
+        for record_id in records_ids:
+            self.__forget_record(model_id, record_id)
+        return records_ids
+
+    def delete_record(self, model_id, record_id):
+        try:
+            return self.backend.delete_record(model_id, record_id)
+        finally:
+            self.__forget_record(model_id, record_id)
+
+    def delete_records(self, model_id):
+        try:
+            return self.backend.delete_records(model_id)
+        finally:
+            self.__forget_model(model_id, records=True)
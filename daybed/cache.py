@@ -0,0 +1,355 @@
+import json
+import threading
+import time
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+import redis
+
+from daybed import logger
+from daybed.backends.exceptions import CredentialsNotFound
+from daybed.permissions import principals_masks
+
+
+class LRUCache(object):
+    """A bounded and thread-safe mapping, which evicts the least recently
+    used items once full.
+
+    Hits and misses are counted, to monitor its efficiency.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            # Move it to the end, as most recently used.
+            self._items[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._items.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def stats(self):
+        return {'size': len(self._items),
+                'hits': self.hits,
+                'misses': self.misses}
+
+
+class SearchCache(object):
+    """Search results by model, query and parameters.
+
+    Each model has a generation, the time of its last write, to which cached
+    results are compared. Since writes take a while to become searchable,
+    results obtained less than ``settle_delay`` seconds after a write are
+    only kept until then (see ``settle_delay`` of indexers). Generations are
+    shared through Redis if a client is given, so that writes on other nodes
+    are taken into account.
+    """
+    def __init__(self, size, ttl=60, redis=None, settle_delay=1.0):
+        self.ttl = ttl
+        self.settle_delay = settle_delay
+        self._results = LRUCache(size)
+        self._redis = redis
+        self._generations = {}
+
+    def __generation(self, model_id):
+        if self._redis is None:
+            return self._generations.get(model_id, 0)
+        generation = self._redis.get('searchgeneration.%s' % model_id)
+        return float(generation or 0)
+
+    def __key(self, model_id, query, params):
+        try:
+            query = json.dumps(json.loads(query or '{}'), sort_keys=True)
+        except ValueError:
+            return None
+        return (model_id, query, tuple(sorted(params.items())))
+
+    def get(self, model_id, query, params):
+        """Returns the cached results of the search, or ``None``."""
+        key = self.__key(model_id, query, params)
+        if key is None:
+            return None
+        cached = self._results.get(key)
+        if cached is None:
+            return None
+        generation, expires, results = cached
+        if (generation != self.__generation(model_id) or
+                time.time() >= expires):
+            self._results.pop(key)
+            return None
+        return results
+
+    def set(self, model_id, query, params, results):
+        key = self.__key(model_id, query, params)
+        if key is None:
+            return
+        generation = self.__generation(model_id)
+        now = time.time()
+        expires = now + self.ttl
+        if now < generation + self.settle_delay:
+            expires = min(expires, generation + self.settle_delay)
+        self._results.set(key, (generation, expires, results))
+
+    def invalidate(self, model_id):
+        """Makes the cached results of the model obsolete."""
+        generation = time.time()
+        if self._redis is None:
+            self._generations[model_id] = generation
+        else:
+            self._redis.set('searchgeneration.%s' % model_id, generation)
+
+    def on_model_changed(self, event):
+        self.invalidate(event.model_id)
+
+    def stats(self):
+        return self._results.stats()
+
+
+class CredentialsCache(object):
+    """Credentials keys by credentials id, kept ``ttl`` seconds.
+
+    Unknown ids are remembered too, during ``negative_ttl`` seconds only, so
+    that guessing credentials does not load the backend.
+    """
+    #: Seconds during which unknown ids are remembered.
+    negative_ttl = 10
+
+    def __init__(self, size, ttl=300):
+        self.ttl = ttl
+        self._keys = LRUCache(size)
+
+    def get_key(self, backend, credentials_id):
+        """Returns the key of the credentials, read from the backend if
+        it is not cached. Raises ``CredentialsNotFound`` if unknown.
+        """
+        cached = self._keys.get(credentials_id)
+        if cached is not None and time.time() < cached[0]:
+            key = cached[1]
+        else:
+            try:
+                key = backend.get_credentials_key(credentials_id)
+                expires = time.time() + self.ttl
+            except CredentialsNotFound:
+                key = None
+                expires = time.time() + min(self.ttl, self.negative_ttl)
+            self._keys.set(credentials_id, (expires, key))
+        if key is None:
+            raise CredentialsNotFound(credentials_id)
+        return key
+
+    def invalidate(self, credentials_id):
+        self._keys.pop(credentials_id)
+
+    def stats(self):
+        return self._keys.stats()
+
+
+class NonceCache(object):
+    """Nonces of Hawk requests, to refuse replayed ones.
+
+    Requests are accepted if their timestamp is within ``window`` seconds of
+    the current time, so nonces are kept in a ring of buckets, one for each
+    second of the window. A bucket is emptied when the ring comes back to
+    it, its nonces have expired by then.
+
+    At most ``max_size`` nonces are kept. Once full, requests are refused
+    rather than forgetting nonces that could be replayed.
+    """
+    @classmethod
+    def load_from_config(cls, config):
+        settings = config.registry.settings
+        return cls(window=int(settings.get('daybed.hawk_window', 60)),
+                   max_size=int(settings.get('daybed.hawk_nonce_cache_size',
+                                             100000)))
+
+    def __init__(self, window=60, max_size=100000):
+        self.window = window
+        self.max_size = max_size
+        # Timestamp and nonces of each bucket.
+        self._ring = [[None, set()] for i in range(2 * window + 2)]
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._size
+
+    def check_nonce(self, timestamp, nonce):
+        """Returns whether the request is fresh, and remembers its nonce."""
+        now = time.time()
+        if not now - self.window < timestamp < now + self.window:
+            return False
+        timestamp = int(timestamp)
+        with self._lock:
+            bucket = self._ring[timestamp % len(self._ring)]
+            if bucket[0] != timestamp:
+                self._size -= len(bucket[1])
+                bucket[0], bucket[1] = timestamp, set()
+            if nonce in bucket[1]:
+                return False
+            if self._size >= self.max_size:
+                self.__purge(now)
+                if self._size >= self.max_size:
+                    logger.warning("Hawk nonces cache is full")
+                    return False
+            bucket[1].add(nonce)
+            self._size += 1
+            return True
+
+    def __purge(self, now):
+        for bucket in self._ring:
+            if bucket[0] is not None and bucket[0] <= now - self.window:
+                self._size -= len(bucket[1])
+                bucket[0], bucket[1] = None, set()
+
+
+def backend_redis(settings):
+    """Returns a client of the Redis server of the backend settings, which
+    caches share between nodes.
+    """
+    return redis.StrictRedis(host=settings.get('backend.db_host', 'localhost'),
+                             port=settings.get('backend.db_port', 6379),
+                             db=settings.get('backend.db_index', 0))
+
+
+class RedisNonceCache(object):
+    """Nonces of Hawk requests, stored in Redis so that replayed requests
+    are refused by all workers.
+
+    Each nonce is a key, set only if missing, which expires once its
+    timestamp is out of the window.
+    """
+    @classmethod
+    def load_from_config(cls, config):
+        settings = config.registry.settings
+        return cls(backend_redis(settings),
+                   window=int(settings.get('daybed.hawk_window', 60)))
+
+    def __init__(self, client, window=60):
+        self.window = window
+        self._redis = client
+
+    def check_nonce(self, timestamp, nonce):
+        """Returns whether the request is fresh, and remembers its nonce."""
+        now = time.time()
+        if not now - self.window < timestamp < now + self.window:
+            return False
+        key = 'hawknonce.%s.%s' % (int(timestamp), nonce)
+        return bool(self._redis.set(key, 1, nx=True, ex=2 * self.window))
+
+
+class PermissionsCache(object):
+    """Permissions of models, read once until the model is written.
+
+    Writes are numbered by a clock, and the last write of each model is
+    compared to the clock at which its permissions were read: permissions
+    read while the model was being written are never served. Only the
+    ``size`` last written models are remembered, permissions read before the
+    oldest of them are read again. If a Redis client is given, written models
+    are published on a channel, so that all nodes number the write. Since
+    messages can be missed while disconnected, permissions are kept ``ttl``
+    seconds at most.
+    """
+    channel = 'daybed.permissions'
+
+    def __init__(self, size, ttl=60, redis=None):
+        self.size = size
+        self.ttl = ttl
+        self._permissions = LRUCache(size)
+        self._clock = 0
+        self._writes = OrderedDict()
+        # Clock of the last write forgotten.
+        self._forgotten = 0
+        self._lock = threading.Lock()
+        self._redis = redis
+        self._listener = None
+        if redis is not None:
+            pubsub = redis.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(**{self.channel: self.__on_message})
+            self._listener = pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+    def __on_message(self, message):
+        model_id = message['data']
+        if isinstance(model_id, bytes):
+            model_id = model_id.decode('utf-8')
+        self.__bump(model_id)
+
+    def __bump(self, model_id):
+        with self._lock:
+            self._clock += 1
+            self._writes.pop(model_id, None)
+            self._writes[model_id] = self._clock
+            if len(self._writes) > self.size:
+                _, self._forgotten = self._writes.popitem(last=False)
+        self._permissions.pop(model_id)
+
+    def __entry(self, model_id, load):
+        with self._lock:
+            clock = self._clock
+            written = self._writes.get(model_id, self._forgotten)
+        cached = self._permissions.get(model_id)
+        if (cached is not None and cached[0] >= written and
+                time.time() < cached[1]):
+            return cached
+        # Masks are compiled on first use, and kept with the permissions.
+        entry = [clock, time.time() + self.ttl, load(model_id), None]
+        self._permissions.set(model_id, entry)
+        return entry
+
+    def get(self, model_id, load):
+        """Returns the permissions of the model, obtained with
+        ``load(model_id)`` if they are not cached.
+        """
+        return self.__entry(model_id, load)[2]
+
+    def get_masks(self, model_id, load):
+        """Returns the permissions masks of the principals of the model
+        (see ``daybed.permissions.principals_masks``).
+        """
+        entry = self.__entry(model_id, load)
+        if entry[3] is None:
+            entry[3] = principals_masks(entry[2])
+        return entry[3]
+
+    def invalidate(self, model_id):
+        """Forgets the permissions of the model, on all nodes."""
+        self.__bump(model_id)
+        if self._redis is not None:
+            self._redis.publish(self.channel, model_id)
+
+    def stop(self):
+        if self._listener is not None:
+            self._listener.stop()
+
+    def stats(self):
+        return self._permissions.stats()
@@ -1,37 +1,106 @@
-class ModelCreated(object):
-    def __init__(self, model_id, request):
-        self.model_id = model_id
-        self.request = request
+"""Events notified on models and records changes.
 
+Besides ids, events carry the objects involved, so that subscribers do not
+have to read them again. When they were not given by the notifier, they are
+read from the request backend on first access.
+"""
 
-class ModelUpdated(object):
-    def __init__(self, model_id, request):
-        self.model_id = model_id
-        self.request = request
+__all__ = ['ModelCreated', 'ModelUpdated', 'ModelDeleted',
+           'RecordCreated', 'RecordUpdated', 'RecordDeleted',
+           'RecordsCreated', 'AllRecordsDeleted']
 
 
-class ModelDeleted(object):
-    def __init__(self, model_id, request):
+class ModelEvent(object):
+    __slots__ = ('model_id', 'request', '_definition')
+
+    def __init__(self, model_id, request, definition=None):
         self.model_id = model_id
         self.request = request
+        self._definition = definition
 
+    @property
+    def definition(self):
+        """The model definition."""
+        if self._definition is None:
+            db = self.request.db
+            self._definition = db.get_model_definition(self.model_id)
+        return self._definition
 
-class RecordCreated(object):
-    def __init__(self, model_id, record_id, request):
-        self.model_id = model_id
-        self.record_id = record_id
-        self.request = request
 
+class ModelCreated(ModelEvent):
+    __slots__ = ()
 
-class RecordUpdated(object):
-    def __init__(self, model_id, record_id, request):
-        self.model_id = model_id
-        self.record_id = record_id
-        self.request = request
 
+class ModelUpdated(ModelEvent):
+    __slots__ = ('previous',)
 
-class RecordDeleted(object):
-    def __init__(self, model_id, record_id, request):
-        self.model_id = model_id
+    def __init__(self, model_id, request, definition=None, previous=None):
+        super(ModelUpdated, self).__init__(model_id, request, definition)
+        #: The definition before the update, if known.
+        self.previous = previous
+
+
+class ModelDeleted(ModelEvent):
+    """The definition of the deleted model has to be given, since it can
+    not be read anymore.
+    """
+    __slots__ = ()
+
+
+class RecordEvent(ModelEvent):
+    __slots__ = ('record_id', '_record')
+
+    def __init__(self, model_id, record_id, request, record=None,
+                 definition=None):
+        super(RecordEvent, self).__init__(model_id, request, definition)
         self.record_id = record_id
-        self.request = request
+        self._record = record
+
+    @property
+    def record(self):
+        """The record, as stored."""
+        if self._record is None:
+            db = self.request.db
+            self._record = db.get_record(self.model_id, self.record_id)
+        return self._record
+
+
+class RecordCreated(RecordEvent):
+    __slots__ = ()
+
+
+class RecordUpdated(RecordEvent):
+    __slots__ = ('previous',)
+
+    def __init__(self, model_id, record_id, request, record=None,
+                 definition=None, previous=None):
+        super(RecordUpdated, self).__init__(model_id, record_id, request,
+                                            record, definition)
+        #: The record before the update, if known.
+        self.previous = previous
+
+
+class RecordDeleted(RecordEvent):
+    """The deleted record has to be given, since it can not be read
+    anymore.
+    """
+    __slots__ = ()
+
+
+class RecordsCreated(ModelEvent):
+    __slots__ = ('records',)
+
+    def __init__(self, model_id, records, request, definition=None):
+        super(RecordsCreated, self).__init__(model_id, request, definition)
+        self.records = records
+
+
+class AllRecordsDeleted(ModelEvent):
+    """Notified once when all records of a model are deleted, instead of a
+    ``RecordDeleted`` event per record.
+    """
+    __slots__ = ('records',)
+
+    def __init__(self, model_id, records, request, definition=None):
+        super(AllRecordsDeleted, self).__init__(model_id, request, definition)
+        self.records = records
@@ -0,0 +1,1067 @@
+import atexit
+import json
+import threading
+import time
+import uuid
+from itertools import islice
+
+import elasticsearch
+from six.moves import queue
+from elasticsearch.exceptions import (RequestError, ElasticsearchException,
+                                      ConnectionError, TransportError)
+from pyramid.settings import asbool
+from urllib3 import Timeout
+
+from daybed import logger
+from daybed.cache import LRUCache
+
+
+#: Values of the ``refresh`` parameter of Elasticsearch write requests, by
+#: refresh policy name. ``wait_for`` requires Elasticsearch 5 or later.
+REFRESH_POLICIES = {
+    'none': False,
+    'wait_for': 'wait_for',
+    'immediate': True,
+}
+
+#: Elasticsearch types of fields, by field type (``string`` by default).
+INDEX_TYPES = {
+    'int': 'integer',
+    'range': 'integer',
+    'date': 'date',
+    'datetime': 'date',
+    'boolean': 'boolean',
+    'decimal': 'float',
+    'point': 'geo_point',
+    'line': 'geo_shape',
+    'polygon': 'geo_shape',
+    'geojson': 'geo_shape',
+    'json': 'object',
+    'object': 'object',
+}
+
+#: Conversions of record values into document values, by field type.
+DOCUMENT_VALUES = {
+    'point': lambda value: {'lon': value[0], 'lat': value[1]},
+    'line': lambda value: {'type': 'Linestring', 'coordinates': value},
+    'polygon': lambda value: {'type': 'Polygon', 'coordinates': value},
+    'list': json.dumps,
+}
+
+
+class SearchError(Exception):
+    """Exception raised on request error to indexer.
+    """
+    def __init__(self, *args):
+        self.status_code, self.error, self.info = args[:3]
+
+
+class CircuitOpenError(TransportError):
+    """Exception raised when Elasticsearch is not called, because it failed
+    repeatedly.
+    """
+
+
+class CircuitBreaker(object):
+    """Stops calling a failing service for a while.
+
+    The breaker opens after ``threshold`` consecutive failures. Calls are
+    then refused during ``reset_timeout`` seconds, after which a single call
+    is let through to probe the service: the breaker closes if it succeeds,
+    and opens again otherwise.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.rejected = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def closed(self):
+        return self.state == self.CLOSED
+
+    def allow(self):
+        """Returns whether the service can be called."""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if (self.state == self.OPEN and
+                    time.time() >= self._opened_at + self.reset_timeout):
+                # This call probes the service.
+                self.state = self.HALF_OPEN
+                return True
+            self.rejected += 1
+            return False
+
+    def retry_in(self):
+        """Returns the number of seconds before the service can be called
+        again.
+        """
+        with self._lock:
+            if self.state == self.OPEN:
+                return max(0, self._opened_at + self.reset_timeout -
+                           time.time())
+            return 0
+
+    def success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info("Indexing service is available again")
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if (self.state == self.HALF_OPEN or
+                    self.failures >= self.threshold):
+                if self.state != self.OPEN:
+                    logger.error("Indexing service is unavailable, retry in "
+                                 "%s seconds" % self.reset_timeout)
+                self.state = self.OPEN
+                self._opened_at = time.time()
+
+    def stats(self):
+        return {'state': self.state,
+                'failures': self.failures,
+                'rejected': self.rejected}
+
+
+class BreakerTransport(elasticsearch.Transport):
+    """Transport of the Elasticsearch client that sends requests through a
+    circuit breaker. Connection errors, timeouts and server errors count as
+    failures.
+    """
+    def __init__(self, hosts, breaker=None, **kwargs):
+        super(BreakerTransport, self).__init__(hosts, **kwargs)
+        self.breaker = breaker or CircuitBreaker()
+
+    def perform_request(self, *args, **kwargs):
+        if not self.breaker.allow():
+            raise CircuitOpenError('N/A', 'Indexing service is unavailable')
+        try:
+            result = super(BreakerTransport, self).perform_request(*args,
+                                                                   **kwargs)
+        except ConnectionError:
+            self.breaker.failure()
+            raise
+        except TransportError as e:
+            if isinstance(e.status_code, int) and e.status_code >= 500:
+                self.breaker.failure()
+            else:
+                self.breaker.success()
+            raise
+        self.breaker.success()
+        return result
+
+
+class IndexingQueue(object):
+    """Bounded queue of records indexing operations, drained by worker
+    threads which send them to Elasticsearch with ``_bulk`` requests.
+
+    Operations are gathered until ``batch_size`` of them are pending, or
+    until ``flush_interval`` seconds have elapsed since the first one. When
+    the queue is full, callers wait for some room if ``block`` is true and
+    the ``breaker`` is closed, otherwise the operation is dropped.
+    ``flush()`` and ``stop()`` wait at most ``timeout`` seconds for the
+    workers.
+    """
+    def __init__(self, client, batch_size=500, flush_interval=1.0,
+                 max_size=10000, workers=1, block=True, refresh=False,
+                 breaker=None, timeout=30):
+        self.client = client
+        # Operations are kept while the breaker is open.
+        self.breaker = breaker
+        self._stopping = False
+        self.refresh = refresh
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.block = block
+        self.timeout = timeout
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.discarded = 0
+        self._queue = queue.Queue(max_size)
+        self._lock = threading.Lock()
+        # Operations obtained by workers, and not sent yet.
+        self._held = []
+        # Operations in ``_bulk`` requests, notified once sent.
+        self._sending = []
+        self._sent = threading.Condition(self._lock)
+        self._workers = []
+        for i in range(workers):
+            worker = threading.Thread(target=self._work,
+                                      name='daybed-indexer-%s' % i)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def put(self, action, source=None):
+        """Enqueues a bulk action (e.g. ``{'index': {...}}``), along with the
+        document source if any.
+        """
+        operation = [action] if source is None else [action, source]
+        # Workers do not drain the queue while the breaker is open.
+        block = self.block and (self.breaker is None or self.breaker.closed)
+        try:
+            self._queue.put(operation, block=block)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            logger.error("Indexing queue is full, dropped %s" % action)
+
+    def flush(self, timeout=None):
+        """Waits until all enqueued operations were sent, or until the
+        ``timeout`` (in seconds, the queue ``timeout`` by default) is
+        reached. Returns whether the queue was drained.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time.time() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._queue.all_tasks_done.wait(remaining)
+            pending = self._queue.unfinished_tasks
+        if pending:
+            logger.error("Indexing queue not flushed after %s seconds, %s "
+                         "operations pending" % (timeout, pending))
+        return not pending
+
+    def discard(self, index):
+        """Drops the pending operations on the given index, e.g. because it
+        is deleted. Operations being sent are not recalled.
+        """
+        def kept(operations):
+            return [operation for operation in operations
+                    if operation is None or
+                    not self._targets(operation, index)]
+
+        discarded = 0
+        # Workers take operations from the queue and hold them at once.
+        with self._queue.mutex:
+            with self._lock:
+                for operations in self._held:
+                    remaining = kept(operations)
+                    discarded += len(operations) - len(remaining)
+                    operations[:] = remaining
+            pending = self._queue.queue
+            remaining = kept(pending)
+            removed = len(pending) - len(remaining)
+            if removed:
+                pending.clear()
+                pending.extend(remaining)
+                self._queue.unfinished_tasks -= removed
+                if not self._queue.unfinished_tasks:
+                    self._queue.all_tasks_done.notify_all()
+                self._queue.not_full.notify(removed)
+        with self._lock:
+            self.discarded += discarded + removed
+        if discarded + removed:
+            logger.debug("Discarded %s indexing operations on '%s'"
+                         % (discarded + removed, index))
+
+    def wait(self, index, timeout=None):
+        """Waits until the operations on the given index which are being
+        sent are complete, or until the ``timeout`` (in seconds, the queue
+        ``timeout`` by default) is reached. Returns whether they were.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time.time() + timeout
+
+        def sending():
+            return any(self._targets(operation, index)
+                       for operations in self._sending
+                       for operation in operations)
+
+        with self._sent:
+            while sending():
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._sent.wait(remaining)
+            complete = not sending()
+        if not complete:
+            logger.error("Indexing operations on '%s' not sent after %s "
+                         "seconds" % (index, timeout))
+        return complete
+
+    @staticmethod
+    def _targets(operation, index):
+        return list(operation[0].values())[0].get('_index') == index
+
+    def stop(self):
+        """Sends pending operations and stops the workers, waiting at most
+        ``timeout`` seconds.
+        """
+        self._stopping = True
+        deadline = time.time() + self.timeout
+        try:
+            for worker in self._workers:
+                self._queue.put(None, timeout=max(deadline - time.time(), 0))
+        except queue.Full:
+            pass
+        for worker in self._workers:
+            worker.join(max(deadline - time.time(), 0))
+            if worker.is_alive():
+                logger.error("Indexing worker %s did not stop" % worker.name)
+        self._workers = []
+
+    @property
+    def pending(self):
+        """Number of operations enqueued and not sent yet."""
+        return self._queue.unfinished_tasks
+
+    def stats(self):
+        return {'depth': self._queue.qsize(),
+                'sent': self.sent,
+                'failed': self.failed,
+                'dropped': self.dropped,
+                'discarded': self.discarded}
+
+    def _take(self, operations, timeout=None):
+        """Takes the next item of the queue, waiting at most ``timeout``
+        seconds, and holds it in ``operations`` meanwhile, so that it can be
+        discarded.
+        """
+        not_empty = self._queue.not_empty
+        with not_empty:
+            if timeout is not None:
+                deadline = time.time() + timeout
+            while not self._queue.queue:
+                if timeout is None:
+                    not_empty.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise queue.Empty
+                not_empty.wait(remaining)
+            item = self._queue.queue.popleft()
+            self._queue.not_full.notify()
+            if item is not None:
+                with self._lock:
+                    operations.append(item)
+            return item
+
+    def _next_batch(self, operations):
+        """Takes operations from the queue into ``operations``. Returns the
+        number of items taken, and whether the worker must stop.
+        """
+        taken = 0
+        deadline = None
+        while len(operations) < self.batch_size:
+            timeout = None
+            if deadline is not None:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+            try:
+                item = self._take(operations, timeout)
+            except queue.Empty:
+                break
+            taken += 1
+            # ``None`` asks the worker to stop.
+            if item is None:
+                return taken, True
+            if deadline is None:
+                deadline = time.time() + self.flush_interval
+        return taken, False
+
+    def _work(self):
+        while True:
+            # Operations obtained by the worker, and not sent yet.
+            operations = []
+            with self._lock:
+                self._held.append(operations)
+            taken, stop = self._next_batch(operations)
+            try:
+                self._send(operations)
+            except Exception as e:
+                # Keep the worker alive, whatever the failure.
+                logger.error(e)
+                with self._lock:
+                    self.failed += len(operations)
+            finally:
+                with self._lock:
+                    self._held = [held for held in self._held
+                                  if held is not operations]
+                for _ in range(taken):
+                    self._queue.task_done()
+            if stop:
+                break
+
+    def _send(self, operations):
+        if not operations:
+            return
+        while self.breaker is not None and not self._stopping:
+            retry_in = self.breaker.retry_in()
+            if retry_in <= 0:
+                break
+            time.sleep(min(retry_in, 1))
+        with self._lock:
+            # Some operations may have been discarded meanwhile.
+            operations = list(operations)
+            if not operations:
+                return
+            self._sending.append(operations)
+        try:
+            self._send_bulk(operations)
+        finally:
+            with self._sent:
+                self._sending = [sending for sending in self._sending
+                                 if sending is not operations]
+                self._sent.notify_all()
+
+    def _send_bulk(self, operations):
+        body = [line for operation in operations for line in operation]
+        params = {}
+        if self.refresh:
+            params['refresh'] = self.refresh
+        try:
+            result = self.client.bulk(body=body, **params)
+        except ElasticsearchException as e:
+            logger.error(e)
+            with self._lock:
+                self.failed += len(operations)
+            return
+        failed = [item for item in result['items']
+                  if list(item.values())[0].get('error')]
+        with self._lock:
+            self.sent += len(operations) - len(failed)
+            self.failed += len(failed)
+        if failed:
+            logger.error("Could not index %s records: %s"
+                         % (len(failed), list(failed[0].values())[0]))
+        logger.debug("Sent %s indexing operations, %s pending"
+                     % (len(operations), self._queue.qsize()))
+
+
+class NullIndexer(object):
+    """Indexer that does nothing, for deployments without search.
+
+    It also describes the interface of indexers: subscribers of models and
+    records events, ``search()`` and ``scan()`` on the records of a model,
+    ``reindex()`` of a model records, ``delete_indices()``, ``status()``,
+    and ``settled()`` along with ``settle_delay`` to tell when writes are
+    searchable.
+    """
+    #: Number of seconds for writes to become searchable.
+    settle_delay = 0
+
+    @classmethod
+    def load_from_config(cls, config):
+        return cls()
+
+    def status(self):
+        return {}
+
+    def settled(self):
+        """Returns whether all writes are searchable, or will be within
+        ``settle_delay``.
+        """
+        return True
+
+    def search(self, model_id, query, params):
+        raise SearchError(501, 'NotImplemented', 'Search is disabled')
+
+    def scan(self, model_id, query, params):
+        raise SearchError(501, 'NotImplemented', 'Search is disabled')
+
+    def reindex(self, model_id, definition, records):
+        pass
+
+    def delete_indices(self):
+        pass
+
+    def on_model_created(self, event):
+        pass
+
+    def on_model_updated(self, event):
+        pass
+
+    def on_model_deleted(self, event):
+        pass
+
+    def on_record_created(self, event):
+        pass
+
+    def on_records_created(self, event):
+        pass
+
+    def on_record_updated(self, event):
+        pass
+
+    def on_record_deleted(self, event):
+        pass
+
+    def on_all_records_deleted(self, event):
+        pass
+
+
+def record_transformer(definition):
+    """Returns a function which transforms a record of the given model
+    definition into an Elasticsearch document.
+
+    Only fields that need a conversion are looked at, since records values
+    are indexed as is otherwise.
+    """
+    conversions = {}
+
+    def collect(fields):
+        for field in fields:
+            field_type = field.get('type')
+            if field_type == 'group':
+                # Fields of groups are stored at the first level.
+                collect(field['fields'])
+            elif field_type in DOCUMENT_VALUES:
+                conversions[field.get('name')] = DOCUMENT_VALUES[field_type]
+    collect(definition['fields'])
+    conversions = list(conversions.items())
+
+    def transform(record):
+        document = record.copy()
+        for name, convert in conversions:
+            if name in document:
+                document[name] = convert(document[name])
+        return document
+    return transform
+
+
+class ElasticSearchIndexer(object):
+
+    # Number of records sent per ``_bulk`` request.
+    bulk_size = 1000
+
+    #: Request header to override the refresh policy.
+    refresh_header = 'Index-Refresh'
+
+    #: Number of hits obtained per request when scanning search results, and
+    #: how long Elasticsearch keeps the search context between requests.
+    scroll_size = 500
+    scroll_keepalive = '1m'
+
+    #: Number of compiled record transformers kept in memory.
+    transformers_cache_size = 1000
+
+    #: Refresh interval of Elasticsearch indices, in seconds.
+    refresh_interval = 1.0
+
+    @classmethod
+    def load_from_config(cls, config):
+        from daybed import build_list
+
+        settings = config.registry.settings
+        # Connect client to hosts in conf
+        hosts = build_list(settings.get('elasticsearch.hosts',
+                                        "localhost:9200"))
+        prefix = settings.get('elasticsearch.indices_prefix', 'daybed_')
+
+        # Index records in background, by batches
+        queue_options = None
+        if asbool(settings.get('elasticsearch.async', False)):
+            queue_options = dict(
+                batch_size=int(settings.get('elasticsearch.batch_size', 500)),
+                flush_interval=float(
+                    settings.get('elasticsearch.flush_interval', 1)),
+                max_size=int(settings.get('elasticsearch.queue_size', 10000)),
+                workers=int(settings.get('elasticsearch.workers', 1)),
+                block=(settings.get('elasticsearch.queue_full', 'block') ==
+                       'block'),
+                timeout=float(settings.get('elasticsearch.flush_timeout', 30))
+            )
+        # Fail fast when Elasticsearch is unhealthy
+        client_options = dict(
+            timeout=Timeout(
+                connect=float(settings.get('elasticsearch.connect_timeout',
+                                           10)),
+                read=float(settings.get('elasticsearch.read_timeout', 10))),
+            maxsize=int(settings.get('elasticsearch.pool_size', 10))
+        )
+        breaker = CircuitBreaker(
+            threshold=int(settings.get('elasticsearch.breaker_threshold', 5)),
+            reset_timeout=float(
+                settings.get('elasticsearch.breaker_reset_timeout', 30))
+        )
+        index = cls(hosts, prefix, queue_options,
+                    refresh=settings.get('elasticsearch.refresh', 'none'),
+                    client_options=client_options, breaker=breaker)
+        if index.queue is not None:
+            # Send pending operations on shutdown.
+            atexit.register(index.queue.stop)
+        return index
+
+    def __init__(self, hosts, prefix, queue_options=None, refresh='none',
+                 client_options=None, breaker=None):
+        self.breaker = breaker or CircuitBreaker()
+        self.client = elasticsearch.Elasticsearch(
+            hosts, transport_class=BreakerTransport, breaker=self.breaker,
+            **(client_options or {}))
+        self.transformers = LRUCache(self.transformers_cache_size)
+        self.prefix = lambda x: u'%s_%s' % (prefix, x)
+        # Changes of records made during the latest rebuild of each model
+        # index, by model id.
+        self._rebuilds = {}
+        self._rebuilds_lock = threading.Lock()
+        self._rebuild_threads = []
+        if refresh not in REFRESH_POLICIES:
+            raise ValueError("Unknown refresh policy '%s'" % refresh)
+        self.refresh = refresh
+        # Records are indexed in background if options are given
+        # (see ``IndexingQueue``).
+        self.queue = None
+        if queue_options is not None:
+            self.queue = IndexingQueue(self.client,
+                                       refresh=REFRESH_POLICIES[refresh],
+                                       breaker=self.breaker,
+                                       **queue_options)
+
+    def _refresh_policy(self, request):
+        """Returns the refresh policy requested by the client, or the default
+        one.
+        """
+        policy = request.headers.get(self.refresh_header, self.refresh)
+        if policy not in REFRESH_POLICIES:
+            return self.refresh
+        return policy
+
+    @property
+    def settle_delay(self):
+        """Writes are searchable once sent by the queue and refreshed."""
+        if self.queue is None:
+            return self.refresh_interval
+        return self.refresh_interval + self.queue.flush_interval
+
+    def settled(self):
+        """Writes are pending while the queue is not drained, or while
+        Elasticsearch is unavailable.
+        """
+        if not self.breaker.closed:
+            return False
+        return self.queue is None or not self.queue.pending
+
+    def status(self):
+        """Returns the state of the circuit breaker and of the queue."""
+        status = {'breaker': self.breaker.stats()}
+        if self.queue is not None:
+            status['queue'] = self.queue.stats()
+        return status
+
+    def search(self, model_id, query, params):
+        supported_params = ['sort', 'from', 'source', 'fields', 'size']
+        params = dict([p for p in params.items() if p[0] in supported_params])
+        try:
+            return self.client.search(index=self.prefix(model_id),
+                                      doc_type=model_id,
+                                      body=query,
+                                      **params)
+        except RequestError as e:
+            raise SearchError(*e.args)
+        except CircuitOpenError as e:
+            raise SearchError(503, 'ServiceUnavailable', e.error)
+        except ElasticsearchException as e:
+            logger.error(e)  # big fail
+            raise
+
+    def scan(self, model_id, query, params):
+        """Returns an iterator of all the hits of the search, obtained
+        with the scroll API by pages of ``scroll_size``.
+
+        The first page is obtained right away, so that errors in the query
+        are raised here.
+        """
+        supported_params = ['sort', 'source', 'fields']
+        params = dict([p for p in params.items() if p[0] in supported_params])
+        try:
+            response = self.client.search(index=self.prefix(model_id),
+                                          doc_type=model_id,
+                                          body=query,
+                                          scroll=self.scroll_keepalive,
+                                          size=self.scroll_size,
+                                          **params)
+        except RequestError as e:
+            raise SearchError(*e.args)
+        except CircuitOpenError as e:
+            raise SearchError(503, 'ServiceUnavailable', e.error)
+        except ElasticsearchException as e:
+            logger.error(e)
+            raise
+        return self.__scroll(response)
+
+    def __scroll(self, response):
+        scroll_id = response.get('_scroll_id')
+        try:
+            while response['hits']['hits']:
+                for hit in response['hits']['hits']:
+                    yield hit
+                response = self.client.scroll(scroll_id=scroll_id,
+                                              scroll=self.scroll_keepalive)
+                scroll_id = response.get('_scroll_id', scroll_id)
+        except ElasticsearchException as e:
+            logger.error(e)
+            raise
+        finally:
+            if scroll_id is not None:
+                try:
+                    self.client.clear_scroll(scroll_id=scroll_id)
+                except ElasticsearchException as e:
+                    logger.error(e)
+
+    def reindex(self, model_id, definition, records):
+        """Builds a new index for the model with the given records, and
+        replaces the current one.
+
+        Each model has an alias (its prefixed id), pointing to a versioned
+        index. The alias is moved to the new index once complete, so that
+        searches never see an empty or partial index.
+        """
+        changes = self.__start_rebuild(model_id)
+        self.__rebuild(model_id, definition, records, changes)
+
+    def join(self, timeout=None):
+        """Waits for the indices rebuilt in background to be complete."""
+        for thread in list(self._rebuild_threads):
+            thread.join(timeout)
+
+    def __start_rebuild(self, model_id):
+        """Starts tracking the changes of the model records, which are
+        replayed in the new index before it replaces the current one.
+
+        Former rebuilds of the model index are obsolete, and stop by
+        themselves.
+        """
+        changes = {}
+        with self._rebuilds_lock:
+            self._rebuilds[model_id] = changes
+        return changes
+
+    def __track(self, model_id, changes):
+        """Records changes of records (documents by record id, ``None`` when
+        deleted) if the index of their model is being rebuilt.
+
+        Only changes made by this process are tracked: with several
+        processes, indices should be rebuilt while records are not modified.
+        """
+        with self._rebuilds_lock:
+            rebuild = self._rebuilds.get(model_id)
+            if rebuild is not None:
+                rebuild.update(changes)
+
+    def __rebuild(self, model_id, definition, records, changes):
+        alias = self.prefix(model_id)
+        # Rebuilds may start within the same millisecond.
+        index = u'%s_%d_%s' % (alias, time.time() * 1000, uuid.uuid4().hex)
+        logger.debug("Build index '%s' for model '%s'" % (index, model_id))
+        created = swapped = False
+        try:
+            self.client.indices.create(index=index)
+            created = True
+            self.__put_mapping(model_id, definition, index)
+            self.__send_bulk(model_id, definition, records, 'none', index)
+            # Records written meanwhile were sent to the current index.
+            while True:
+                with self._rebuilds_lock:
+                    if self._rebuilds.get(model_id) is not changes:
+                        logger.info("Index '%s' is obsolete" % index)
+                        return
+                    pending = dict(changes)
+                    changes.clear()
+                    if not pending:
+                        # Writes wait until the alias is moved.
+                        self.client.indices.refresh(index=index)
+                        swapped = self.__swap_alias(alias, index)
+                        return
+                self.__replay(model_id, index, pending)
+        except Exception as e:
+            # E.g. the model was deleted while its records were read.
+            logger.error(e)
+            logger.error("Could not rebuild index of model '%s'" % model_id)
+        finally:
+            with self._rebuilds_lock:
+                if self._rebuilds.get(model_id) is changes:
+                    self._rebuilds.pop(model_id)
+            if created and not swapped:
+                self.__delete_index(index)
+
+    def __delete_index(self, index):
+        try:
+            self.client.indices.delete(index=index)
+        except ElasticsearchException as e:
+            logger.error(e)
+
+    def __replay(self, model_id, index, changes):
+        actions = []
+        for record_id, document in changes.items():
+            if document is None:
+                actions.append({'delete': {'_id': record_id}})
+            else:
+                actions.extend([{'index': {'_id': record_id}}, document])
+        self.client.bulk(index=index, doc_type=model_id, body=actions)
+
+    def __in_thread(self, function, *args):
+        thread = threading.Thread(target=function, args=args,
+                                  name='daybed-reindex')
+        thread.daemon = True
+        thread.start()
+        self._rebuild_threads = [t for t in self._rebuild_threads
+                                 if t.is_alive()] + [thread]
+
+    def __swap_alias(self, alias, index):
+        """Points the alias to the index, and deletes the indices it was
+        pointing to. Returns whether the alias was moved.
+        """
+        try:
+            previous = []
+            if self.client.indices.exists(index=alias):
+                if self.client.indices.exists_alias(name=alias):
+                    previous = list(self.client.indices.get_alias(name=alias))
+                else:
+                    # Indices of former versions are not versioned, and can
+                    # only be replaced by an alias once deleted.
+                    logger.info("Replace index '%s' by an alias" % alias)
+                    self.client.indices.delete(index=alias)
+            actions = [{'remove': {'index': old, 'alias': alias}}
+                       for old in previous]
+            actions.append({'add': {'index': index, 'alias': alias}})
+            self.client.indices.update_aliases(body={'actions': actions})
+        except ElasticsearchException as e:
+            logger.error(e)
+            return False
+        if previous:
+            self.__delete_index(','.join(previous))
+        return True
+
+    def on_model_created(self, event):
+        logger.debug("Create index for model '%s'" % event.model_id)
+        self.reindex(event.model_id, event.definition, [])
+
+    def on_model_updated(self, event):
+        # The index is rebuilt in background, out of the request.
+        logger.debug("Reindex records of model '%s'" % event.model_id)
+        self.__flush_queue(event.model_id)
+        self.transformers.pop(event.model_id)
+        changes = self.__start_rebuild(event.model_id)
+        records = event.request.db.iter_records_with_authors(event.model_id)
+        self.__in_thread(self.__rebuild, event.model_id, event.definition,
+                         (r['record'] for r in records), changes)
+
+    def on_model_deleted(self, event):
+        logger.debug("Delete index of model '%s'" % event.model_id)
+        self.__flush_queue(event.model_id)
+        self.transformers.pop(event.model_id)
+        with self._rebuilds_lock:
+            # Abort rebuilds of the index.
+            self._rebuilds.pop(event.model_id, None)
+        try:
+            self.client.indices.delete(index=self.prefix(event.model_id))
+        except ElasticsearchException as e:
+            logger.error(e)
+
+    def on_record_created(self, event):
+        logger.debug("Index record %s of model '%s'" % (event.record_id,
+                                                        event.model_id))
+        self.__index(event.model_id, event.definition, event.record_id,
+                     event.record, self._refresh_policy(event.request))
+
+    def on_records_created(self, event):
+        logger.debug("Index %s records of model '%s'" % (len(event.records),
+                                                         event.model_id))
+        self.__bulk_index(event.model_id, event.definition, event.records,
+                          self._refresh_policy(event.request))
+
+    def on_record_updated(self, event):
+        logger.debug("Reindex record %s of model '%s'" % (event.record_id,
+                                                          event.model_id))
+        self.__index(event.model_id, event.definition, event.record_id,
+                     event.record, self._refresh_policy(event.request))
+
+    def on_record_deleted(self, event):
+        logger.debug("Unindex record %s of model '%s'" % (event.record_id,
+                                                          event.model_id))
+        refresh = self._refresh_policy(event.request)
+        self.__track(event.model_id, {event.record_id: None})
+        if self.__in_background(refresh):
+            self.queue.put(self.__action('delete', event.model_id,
+                                         event.record_id))
+            return
+        try:
+            self.client.delete(index=self.prefix(event.model_id),
+                               doc_type=event.model_id,
+                               id=event.record_id,
+                               refresh=REFRESH_POLICIES[refresh])
+        except ElasticsearchException as e:
+            logger.error(e)
+
+    def on_all_records_deleted(self, event):
+        # Replacing the index is much cheaper than deleting every document.
+        logger.debug("Empty index of model '%s'" % event.model_id)
+        self.__flush_queue(event.model_id)
+        with self._rebuilds_lock:
+            # Rebuilds with the deleted records delete their own index.
+            self._rebuilds.pop(event.model_id, None)
+        self.reindex(event.model_id, event.definition, [])
+
+    def delete_indices(self):
+        logger.debug("Drop the index on database deleted event.")
+        try:
+            fullnames = self.client.cat.indices().split('\n')[:-1]
+            indices = [x.split()[1] for x in fullnames]
+            prefixed_indices = [indice for indice in indices
+                                if indice.startswith(self.prefix(''))]
+            if len(prefixed_indices) > 0:
+                self.client.indices.delete(index=','.join(prefixed_indices))
+        except ElasticsearchException as e:
+            logger.error(e)
+
+    def __flush_queue(self, model_id):
+        """Makes sure that pending operations on the records of the model are
+        not sent after its index is rebuilt or deleted: they are dropped, and
+        operations being sent are waited for. Operations on other models are
+        not.
+        """
+        if self.queue is None:
+            return
+        self.queue.discard(self.prefix(model_id))
+        self.queue.wait(self.prefix(model_id))
+
+    def __in_background(self, refresh):
+        """Operations are sent during the request if the client asked for
+        another refresh policy than the default one, to be able to read its
+        own writes. They are queued anyway while Elasticsearch is
+        unavailable.
+        """
+        if self.queue is None:
+            return False
+        return refresh == self.refresh or not self.breaker.closed
+
+    def __action(self, action, model_id, record_id):
+        return {action: {'_index': self.prefix(model_id),
+                         '_type': model_id,
+                         '_id': record_id}}
+
+    def __put_mapping(self, model_id, definition, index):
+        """ Transforms the model definition into an Elasticsearch mapping,
+        and associate to its index.
+        """
+        mapping_definition = self._definition_as_mapping(definition)
+        try:
+            mapping = self.client.indices.put_mapping(
+                index=index,
+                doc_type=model_id,
+                body=mapping_definition
+            )
+            return mapping
+        except ElasticsearchException as e:
+            logger.error(e)
+
+    def __index(self, model_id, definition, record_id, record, refresh):
+        """ Transforms the record to an ElasticSearch record compatible with
+        the mapping built from its model definition.
+        """
+        transform = self._record_transformer(model_id, definition)
+        mapping_record = transform(record)
+        self.__track(model_id, {record_id: mapping_record})
+        if self.__in_background(refresh):
+            self.queue.put(self.__action('index', model_id, record_id),
+                           mapping_record)
+            return
+        try:
+            index = self.client.index(index=self.prefix(model_id),
+                                      doc_type=model_id,
+                                      id=record_id,
+                                      body=mapping_record,
+                                      refresh=REFRESH_POLICIES[refresh])
+            return index
+        except ElasticsearchException as e:
+            logger.error(e)
+
+    def __bulk_index(self, model_id, definition, records, refresh):
+        """ Indexes the records with ``_bulk`` requests of ``bulk_size``
+        records.
+        """
+        if model_id in self._rebuilds:
+            transform = self._record_transformer(model_id, definition)
+            self.__track(model_id, dict((record['id'], transform(record))
+                                        for record in records))
+        if self.__in_background(refresh):
+            transform = self._record_transformer(model_id, definition)
+            for record in records:
+                self.queue.put(self.__action('index', model_id, record['id']),
+                               transform(record))
+            return
+        self.__send_bulk(model_id, definition, records, refresh,
+                         self.prefix(model_id))
+
+    def __send_bulk(self, model_id, definition, records, refresh, index):
+        transform = self._record_transformer(model_id, definition)
+        records = iter(records)
+        while True:
+            batch = list(islice(records, self.bulk_size))
+            if not batch:
+                break
+            actions = []
+            for record in batch:
+                actions.append({'index': {'_id': record['id']}})
+                actions.append(transform(record))
+            try:
+                result = self.client.bulk(index=index,
+                                          doc_type=model_id,
+                                          body=actions,
+                                          refresh=REFRESH_POLICIES[refresh])
+            except ElasticsearchException as e:
+                logger.error(e)
+                continue
+            if result.get('errors'):
+                failed = [item['index'] for item in result['items']
+                          if item['index'].get('error')]
+                logger.error("Could not index %s records of model '%s': %s"
+                             % (len(failed), model_id, failed[0]['error']))
+
+    def _definition_as_mapping(self, definition):
+        def field_list(fields):
+            mappings = {}
+            for field in fields:
+                fieldname = field.get('name')
+                fieldtype = field.get('type')
+                mapping = {'type': INDEX_TYPES.get(fieldtype, 'string')}
+                if fieldtype == 'json':
+                    mapping['enabled'] = False
+                if fieldtype == 'group':
+                    mappings.update(field_list(field['fields']))
+                    continue
+                if fieldtype == 'object':
+                    mapping['properties'] = field_list(field['fields'])
+                mappings[fieldname] = mapping
+            return mappings
+
+        mapping = {
+            'properties': field_list(definition['fields'])
+        }
+        return mapping
+
+    def _record_transformer(self, model_id, definition):
+        """Returns the function which transforms the records of the model
+        into documents compatible with its mapping.
+
+        Functions are compiled once per model, and forgotten when it is
+        updated. The definition they were compiled from is compared to the
+        given one, in case the model was updated on another node.
+        """
+        cached = self.transformers.get(model_id)
+        if cached is not None:
+            compiled, transformer = cached
+            if compiled is definition or compiled == definition:
+                return transformer
+        transformer = record_transformer(definition)
+        self.transformers.set(model_id, (definition, transformer))
+        return transformer
@@ -0,0 +1,424 @@
+"""Embedded indexer, storing records in a SQLite database.
+
+Text fields of records are indexed with the FTS5 extension of SQLite, in one
+table per model. Searches support a subset of the Elasticsearch query DSL:
+
+- queries: ``match_all``, ``match`` (on a field, or on ``_all`` fields),
+  ``term``, ``range``, ``bool`` (``must``, ``filter``, ``should`` and
+  ``must_not``) and ``filtered``;
+- ``sort``, ``from`` and ``size``, in the body or in the querystring.
+
+Only first level fields can be queried, and relevance is not computed: hits
+are sorted as requested, or in indexing order. Full text queries use the FTS5
+index, whereas ``term``, ``range`` and ``sort`` read the JSON documents of the
+model with the JSON1 functions of SQLite: their cost grows with the number of
+records of the model.
+"""
+import json
+import re
+import sqlite3
+import threading
+import time
+
+import six
+
+from daybed import logger
+from daybed.indexer import INDEX_TYPES, SearchError
+
+
+RANGE_OPERATORS = {'gt': '>', 'gte': '>=', 'lt': '<', 'lte': '<='}
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS models (
+         id INTEGER PRIMARY KEY,
+         model_id TEXT NOT NULL UNIQUE,
+         fields TEXT NOT NULL)""",
+    """CREATE TABLE IF NOT EXISTS documents (
+         id INTEGER PRIMARY KEY,
+         model_id TEXT NOT NULL,
+         record_id TEXT NOT NULL,
+         document TEXT NOT NULL,
+         UNIQUE (model_id, record_id))""",
+]
+
+
+def quote(name):
+    """Quotes a SQL identifier."""
+    return u'"%s"' % name.replace(u'"', u'""')
+
+
+def text_fields(fields):
+    """Returns the names of the fields indexed as full text."""
+    names = []
+    for field in fields:
+        field_type = field.get('type')
+        if field_type == 'group':
+            names.extend(text_fields(field['fields']))
+        elif field.get('name') and INDEX_TYPES.get(field_type,
+                                                   'string') == 'string':
+            names.append(field['name'])
+    return names
+
+
+#: SQL expression of a field value of documents (JSON for lists and objects),
+#: given the field name.
+FIELD_VALUE = u'(SELECT value FROM json_each(d.document) WHERE key = ?)'
+
+#: SQL condition on documents having the given value in a field, or in the
+#: items of a list field, given the field name and the value twice.
+TERM_MATCHES = (u'EXISTS (SELECT 1 FROM json_each(d.document) f'
+                u" WHERE f.key = ? AND (f.atom = ? OR f.type = 'array'"
+                u' AND EXISTS (SELECT 1 FROM json_each(f.value) i'
+                u' WHERE i.atom = ?)))')
+
+
+class SQLiteIndexer(object):
+
+    #: Number of hits obtained per query when scanning search results.
+    scroll_size = 500
+
+    #: Writes are searchable once their request is complete.
+    settle_delay = 0
+
+    @classmethod
+    def load_from_config(cls, config):
+        settings = config.registry.settings
+        return cls(settings.get('sqlite.path', ':memory:'))
+
+    def __init__(self, path=':memory:'):
+        # The connection is shared by the threads of the application.
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            for statement in SCHEMA:
+                self._db.execute(statement)
+        try:
+            self._db.execute('CREATE VIRTUAL TABLE temp.fts5_check'
+                             ' USING fts5(content)')
+        except sqlite3.OperationalError:
+            raise ValueError("SQLite was built without FTS5 support")
+        self._db.execute('DROP TABLE temp.fts5_check')
+        try:
+            self._db.execute("SELECT json('{}')")
+        except sqlite3.OperationalError:
+            raise ValueError("SQLite was built without JSON1 support")
+        # Full text tables and fields by model id.
+        self._models = {}
+
+    def __model(self, model_id):
+        """Returns the full text table and fields of the model, or ``None``
+        if it is unknown.
+        """
+        if model_id not in self._models:
+            row = self._db.execute('SELECT id, fields FROM models'
+                                   ' WHERE model_id = ?',
+                                   (model_id,)).fetchone()
+            if row is None:
+                return None
+            self._models[model_id] = (u'fulltext_%s' % row[0],
+                                      json.loads(row[1]))
+        return self._models[model_id]
+
+    def __drop_model(self, model_id):
+        model = self.__model(model_id)
+        if model is not None:
+            self._db.execute('DROP TABLE IF EXISTS %s' % quote(model[0]))
+        self._db.execute('DELETE FROM models WHERE model_id = ?', (model_id,))
+        self._db.execute('DELETE FROM documents WHERE model_id = ?',
+                         (model_id,))
+        self._models.pop(model_id, None)
+
+    def __create_model(self, model_id, definition):
+        self.__drop_model(model_id)
+        fields = text_fields(definition['fields'])
+        cursor = self._db.execute('INSERT INTO models (model_id, fields)'
+                                  ' VALUES (?, ?)',
+                                  (model_id, json.dumps(fields)))
+        table = u'fulltext_%s' % cursor.lastrowid
+        columns = [quote(field) for field in fields] or [u'_none']
+        self._db.execute('CREATE VIRTUAL TABLE %s USING fts5(%s)'
+                         % (quote(table), u', '.join(columns)))
+        self._models[model_id] = (table, fields)
+
+    def __put(self, model_id, definition, records):
+        if self.__model(model_id) is None:
+            self.__create_model(model_id, definition)
+        table, fields = self.__model(model_id)
+        for record in records:
+            document = json.dumps(record)
+            row = self._db.execute('SELECT id FROM documents'
+                                   ' WHERE model_id = ? AND record_id = ?',
+                                   (model_id, record['id'])).fetchone()
+            if row is None:
+                cursor = self._db.execute(
+                    'INSERT INTO documents (model_id, record_id, document)'
+                    ' VALUES (?, ?, ?)', (model_id, record['id'], document))
+                rowid = cursor.lastrowid
+            else:
+                rowid = row[0]
+                self._db.execute('UPDATE documents SET document = ?'
+                                 ' WHERE id = ?', (document, rowid))
+                self._db.execute('DELETE FROM %s WHERE rowid = ?'
+                                 % quote(table), (rowid,))
+            if fields:
+                values = [record.get(field) for field in fields]
+                values = [value if isinstance(value, six.string_types)
+                          else None for value in values]
+                self._db.execute(
+                    'INSERT INTO %s (rowid, %s) VALUES (?%s)'
+                    % (quote(table), u', '.join(quote(f) for f in fields),
+                       u', ?' * len(fields)), [rowid] + values)
+
+    def __delete(self, model_id, record_id):
+        model = self.__model(model_id)
+        row = self._db.execute('SELECT id FROM documents'
+                               ' WHERE model_id = ? AND record_id = ?',
+                               (model_id, record_id)).fetchone()
+        if model is None or row is None:
+            return
+        self._db.execute('DELETE FROM documents WHERE id = ?', row)
+        self._db.execute('DELETE FROM %s WHERE rowid = ?' % quote(model[0]),
+                         row)
+
+    def __write(self, method, *args):
+        """Runs the method in a transaction."""
+        with self._lock:
+            try:
+                with self._db:
+                    method(*args)
+            except sqlite3.Error as e:
+                logger.error(e)
+                # Tables of models may have been rolled back.
+                self._models.clear()
+
+    def status(self):
+        with self._lock:
+            count = self._db.execute('SELECT COUNT(*) FROM documents')
+            return {'documents': count.fetchone()[0]}
+
+    def settled(self):
+        return True
+
+    def reindex(self, model_id, definition, records):
+        def rebuild():
+            self.__create_model(model_id, definition)
+            self.__put(model_id, definition, records)
+        self.__write(rebuild)
+
+    def delete_indices(self):
+        def delete_all():
+            for (model_id,) in self._db.execute('SELECT model_id FROM models'
+                                                ).fetchall():
+                self.__drop_model(model_id)
+            self._db.execute('DELETE FROM documents')
+        self.__write(delete_all)
+
+    def on_model_created(self, event):
+        logger.debug("Create index for model '%s'" % event.model_id)
+        self.reindex(event.model_id, event.definition, [])
+
+    def on_model_updated(self, event):
+        logger.debug("Reindex records of model '%s'" % event.model_id)
+        records = event.request.db.iter_records_with_authors(event.model_id)
+        self.reindex(event.model_id, event.definition,
+                     (r['record'] for r in records))
+
+    def on_model_deleted(self, event):
+        logger.debug("Delete index of model '%s'" % event.model_id)
+        self.__write(self.__drop_model, event.model_id)
+
+    def on_record_created(self, event):
+        logger.debug("Index record %s of model '%s'" % (event.record_id,
+                                                        event.model_id))
+        record = dict(event.record, id=event.record_id)
+        self.__write(self.__put, event.model_id, event.definition, [record])
+
+    on_record_updated = on_record_created
+
+    def on_records_created(self, event):
+        logger.debug("Index %s records of model '%s'" % (len(event.records),
+                                                         event.model_id))
+        self.__write(self.__put, event.model_id, event.definition,
+                     event.records)
+
+    def on_record_deleted(self, event):
+        logger.debug("Unindex record %s of model '%s'" % (event.record_id,
+                                                          event.model_id))
+        self.__write(self.__delete, event.model_id, event.record_id)
+
+    def on_all_records_deleted(self, event):
+        logger.debug("Empty index of model '%s'" % event.model_id)
+        self.reindex(event.model_id, event.definition, [])
+
+    def search(self, model_id, query, params):
+        started = time.time()
+        if isinstance(query, six.string_types):
+            try:
+                query = json.loads(query) if query.strip() else {}
+            except ValueError as e:
+                raise SearchError(400, 'SearchParseException',
+                                  u'Invalid JSON body: %s' % e)
+        with self._lock:
+            model = self.__model(model_id)
+            try:
+                body = dict(query, **dict((key, params[key])
+                                          for key in ('sort', 'from', 'size')
+                                          if key in params))
+                where, args = self.__compile(
+                    model, body.get('query', {'match_all': {}}))
+                order, order_args = self.__sort(body.get('sort', []))
+                size = int(body.get('size', 10))
+                offset = int(body.get('from', 0))
+            except (AttributeError, TypeError, ValueError):
+                raise SearchError(400, 'SearchParseException',
+                                  u'Malformed search request')
+            if size < 0 or offset < 0:
+                raise SearchError(400, 'SearchParseException',
+                                  u'Negative size or from')
+            where = u'model_id = ? AND (%s)' % where
+            args = [model_id] + args
+            total = self._db.execute(u'SELECT COUNT(*) FROM documents d'
+                                     u' WHERE %s' % where, args).fetchone()[0]
+            rows = self._db.execute(
+                u'SELECT record_id, document FROM documents d WHERE %s'
+                u' ORDER BY %s LIMIT ? OFFSET ?' % (where, order),
+                args + order_args + [size, offset]).fetchall()
+
+        hits = [{'_index': model_id,
+                 '_type': model_id,
+                 '_id': record_id,
+                 '_score': None,
+                 '_source': json.loads(document)}
+                for record_id, document in rows]
+        return {'took': int((time.time() - started) * 1000),
+                'timed_out': False,
+                'hits': {'total': total, 'max_score': None, 'hits': hits}}
+
+    def scan(self, model_id, query, params):
+        """Returns an iterator of all the hits of the search, obtained by
+        pages of ``scroll_size``.
+        """
+        params = dict(params, size=self.scroll_size)
+        params['from'] = 0
+        results = self.search(model_id, query, params)
+
+        def hits(results):
+            while True:
+                for hit in results['hits']['hits']:
+                    yield hit
+                if len(results['hits']['hits']) < self.scroll_size:
+                    return
+                params['from'] += self.scroll_size
+                results = self.search(model_id, query, params)
+        return hits(results)
+
+    def __sort(self, sort):
+        """Returns the SQL ``ORDER BY`` clause of the ``sort`` parameter,
+        given as in the body or in the querystring of Elasticsearch searches.
+        """
+        if isinstance(sort, six.string_types):
+            sort = [dict([part.split(':', 1)]) if ':' in part else part
+                    for part in sort.split(',') if part]
+        elif isinstance(sort, dict):
+            sort = [sort]
+        clauses, args = [], []
+        for criteria in sort:
+            if isinstance(criteria, dict):
+                (field, order), = criteria.items()
+                if isinstance(order, dict):
+                    order = order.get('order', 'asc')
+            else:
+                field, order = criteria, 'asc'
+            if order not in ('asc', 'desc'):
+                raise SearchError(400, 'SearchParseException',
+                                  u'Unknown sort order "%s"' % order)
+            clauses.append(u'%s %s' % (FIELD_VALUE, order.upper()))
+            args.append(field)
+        clauses.append(u'd.id')
+        return u', '.join(clauses), args
+
+    def __compile(self, model, query):
+        """Returns the SQL condition on documents, and its arguments, of a
+        query.
+        """
+        (name, spec), = query.items()
+        if name == 'match_all':
+            return u'1', []
+        if name == 'match':
+            return self.__match(model, spec)
+        if name == 'term':
+            (field, value), = spec.items()
+            if isinstance(value, dict):
+                value = value.get('value')
+            if isinstance(value, (list, dict)):
+                value = json.dumps(value)
+            return TERM_MATCHES, [field, value, value]
+        if name == 'range':
+            (field, bounds), = spec.items()
+            conditions, args = [u'%s IS NOT NULL' % FIELD_VALUE], [field]
+            for bound, value in bounds.items():
+                if bound not in RANGE_OPERATORS:
+                    continue
+                conditions.append(u'%s %s ?' % (FIELD_VALUE,
+                                                RANGE_OPERATORS[bound]))
+                args.extend([field, value])
+            return u' AND '.join(conditions), args
+        if name == 'bool':
+            return self.__bool(model, spec)
+        if name == 'filtered':
+            clauses = {'must': spec.get('query', {'match_all': {}}),
+                       'filter': spec.get('filter', {'match_all': {}})}
+            return self.__bool(model, clauses)
+        raise SearchError(400, 'QueryParsingException',
+                          u'Unsupported query "%s"' % name)
+
+    def __bool(self, model, spec):
+        def compiled(occurence):
+            queries = spec.get(occurence, [])
+            if isinstance(queries, dict):
+                queries = [queries]
+            return [self.__compile(model, query) for query in queries]
+
+        conditions, args = [], []
+        for condition, condition_args in compiled('must') + compiled('filter'):
+            conditions.append(u'(%s)' % condition)
+            args.extend(condition_args)
+        for condition, condition_args in compiled('must_not'):
+            conditions.append(u'NOT (%s)' % condition)
+            args.extend(condition_args)
+        should = compiled('should')
+        # Without other clauses, at least one should clause has to match.
+        # Otherwise they only contribute to relevance, which is not computed.
+        if should and not conditions:
+            conditions.append(u'(%s)' % u' OR '.join(u'(%s)' % c
+                                                     for c, _ in should))
+            for _, condition_args in should:
+                args.extend(condition_args)
+        if not conditions:
+            return u'1', []
+        return u' AND '.join(conditions), args
+
+    def __match(self, model, spec):
+        (field, text), = spec.items()
+        operator = 'or'
+        if isinstance(text, dict):
+            operator = text.get('operator', operator).lower()
+            text = text.get('query', u'')
+        if model is None:
+            return u'0', []
+        table, fields = model
+        if field == '_all':
+            column = quote(table)
+        elif field in fields:
+            column = quote(field)
+        else:
+            # Values of other fields are not analyzed.
+            return self.__compile(model, {'term': {field: text}})
+
+        tokens = re.findall(r'\w+', six.text_type(text), re.UNICODE)
+        if not tokens:
+            return u'0', []
+        separator = u' AND ' if operator == 'and' else u' OR '
+        expression = separator.join(u'"%s"' % token for token in tokens)
+        return (u'd.id IN (SELECT rowid FROM %s WHERE %s MATCH ?)'
+                % (quote(table), column), [expression])
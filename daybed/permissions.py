@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import logging
 from collections import defaultdict
 from six import iteritems
 from pyramid.interfaces import IAuthorizationPolicy
@@ -19,6 +20,42 @@ PERMISSIONS_SET = set([
 ])
 
 
+# Permissions granted by settings instead of models.
+GLOBAL_PERMISSIONS_SET = set(['create_model', 'create_token',
+                              'manage_tokens'])
+
+# Bit of each permission in permissions masks.
+PERMISSIONS_BITS = dict((perm, 1 << i) for i, perm in enumerate(
+    sorted(PERMISSIONS_SET | GLOBAL_PERMISSIONS_SET)))
+
+
+def permissions_mask(permissions):
+    """Returns the mask of the given permissions names."""
+    mask = 0
+    for perm in permissions:
+        mask |= PERMISSIONS_BITS[perm]
+    return mask
+
+
+def permissions_names(mask):
+    """Returns the set of permissions names of the given mask."""
+    return set(perm for perm, bit in iteritems(PERMISSIONS_BITS)
+               if mask & bit)
+
+
+def principals_masks(model_permissions):
+    """Reverse from {perm: [credentials_ids]} to {credentials_id: mask}.
+
+    Unknown permissions names are ignored.
+    """
+    masks = defaultdict(int)
+    for perm, credentials_ids in iteritems(model_permissions):
+        bit = PERMISSIONS_BITS.get(perm, 0)
+        for credentials_id in credentials_ids:
+            masks[credentials_id] |= bit
+    return dict(masks)
+
+
 def default_model_permissions(credentials_id):
     """ Give all permissions to the model creator.
     Permissions of models created by anonymous (i.e. ``Everyone``)
@@ -77,6 +114,15 @@ class Any(list):
                 check |= perm in permissions
         return check
 
+    def compile(self):
+        """Returns a function telling if a permissions mask matches."""
+        mask = permissions_mask(p for p in self if not hasattr(p, 'compile'))
+        nested = [p.compile() for p in self if hasattr(p, 'compile')]
+        if not nested:
+            return lambda permissions: bool(permissions & mask)
+        return lambda permissions: bool(permissions & mask) or any(
+            matches(permissions) for matches in nested)
+
 
 class All(list):
     def matches(self, permissions):
@@ -88,9 +134,19 @@ class All(list):
                 check &= perm in permissions
         return check
 
+    def compile(self):
+        """Returns a function telling if a permissions mask matches."""
+        mask = permissions_mask(p for p in self if not hasattr(p, 'compile'))
+        nested = [p.compile() for p in self if hasattr(p, 'compile')]
+        if not nested:
+            return lambda permissions: permissions & mask == mask
+        return lambda permissions: permissions & mask == mask and all(
+            matches(permissions) for matches in nested)
+
 
 AUTHORS_PERMISSIONS = set(['update_own_records', 'delete_own_records',
                            'read_own_records'])
+AUTHORS_MASK = permissions_mask(AUTHORS_PERMISSIONS)
 
 VIEWS_PERMISSIONS_REQUIRED = {
     'get_models':      All(),
@@ -118,6 +174,11 @@ VIEWS_PERMISSIONS_REQUIRED = {
     'delete_token':    All(['manage_tokens']),
 }
 
+# Requirements compiled into functions of permissions masks.
+VIEWS_PERMISSIONS_MATCHES = dict(
+    (view, required.compile())
+    for view, required in iteritems(VIEWS_PERMISSIONS_REQUIRED))
+
 
 @implementer(IAuthorizationPolicy)
 class DaybedAuthorizationPolicy(object):
@@ -150,33 +211,31 @@ class DaybedAuthorizationPolicy(object):
         principals has access to the given permission.
         """
         principals = set(principals)
-        permissions_required = VIEWS_PERMISSIONS_REQUIRED[permission]
-        current_permissions = set()
+        matches = VIEWS_PERMISSIONS_MATCHES[permission]
+        current_permissions = 0
 
         if principals.intersection(self.model_creators):
-            current_permissions.add("create_model")
+            current_permissions |= PERMISSIONS_BITS["create_model"]
 
         if principals.intersection(self.token_creators):
-            current_permissions.add("create_token")
+            current_permissions |= PERMISSIONS_BITS["create_token"]
 
         if principals.intersection(self.token_managers):
-            current_permissions.add("manage_token")
+            current_permissions |= PERMISSIONS_BITS["manage_tokens"]
 
         model_id = context.model_id
         if model_id is not None:
             try:
-                model_permissions = context.db.get_model_permissions(model_id)
+                masks = context.db.get_model_masks(model_id)
             except backend_exceptions.ModelNotFound:
-                model_permissions = {}
+                masks = {}
                 if permission != 'post_model':
                     # Prevent unauthorized error to shadow 404 responses
                     return True
             finally:
-                for perm_name, credentials_ids in iteritems(model_permissions):
-                    # If one of the principals is in the valid credentials_ids
-                    # for this permission, grant the permission.
-                    if principals.intersection(credentials_ids):
-                        current_permissions.add(perm_name)
+                # Grant the permissions of each principal.
+                for principal in principals:
+                    current_permissions |= masks.get(principal, 0)
 
         # Remove author's permissions if a record is involved, and if it
         # does not belong to the token.
@@ -188,16 +247,18 @@ class DaybedAuthorizationPolicy(object):
                 authors = []
             finally:
                 if not principals.intersection(authors):
-                    current_permissions -= AUTHORS_PERMISSIONS
+                    current_permissions &= ~AUTHORS_MASK
 
-        logger.debug("Current permissions: %s", current_permissions)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Current permissions: %s",
+                         permissions_names(current_permissions))
 
-        # Expose permissions and principals for in_view checks
+        # Expose permissions mask and principals for in_view checks
         context.request.permissions = current_permissions
         context.request.principals = principals
 
         # Check view permission matches token permissions.
-        return permissions_required.matches(current_permissions)
+        return matches(current_permissions)
 
     def principals_allowed_by_permission(self, context, permission):
         raise NotImplementedError()  # PRAGMA NOCOVER
@@ -218,7 +279,8 @@ def get_credentials(request, credentials_id):
     if credentials_id is Everyone:
         return Everyone, None
     try:
-        stored_key = request.db.get_credentials_key(credentials_id)
+        stored_key = request.registry.credentials_cache.get_key(
+            request.db, credentials_id)
     except backend_exceptions.CredentialsNotFound:
         raise ValueError
     return credentials_id, stored_key
@@ -1,12 +1,115 @@
+from functools import partial
+from itertools import chain
 try:
     from collections import OrderedDict
 except ImportError:
     from ordereddict import OrderedDict
 
-from pyramid.renderers import JSONP
+from pyramid.httpexceptions import HTTPBadRequest
+from pyramid.renderers import JSONP, JSONP_VALID_CALLBACK
 
 
-class GeoJSON(JSONP):
+def is_iterator(value):
+    return hasattr(value, '__next__') or hasattr(value, 'next')
+
+
+class StreamingJSONP(JSONP):
+    """JSONP renderer that streams the iterators found in the rendered
+    mapping (e.g. records generators from backends).
+
+    Iterators are serialized as JSON arrays, item by item, in the response
+    ``app_iter``: the whole collection is never held in memory and the first
+    bytes are sent before the last items are read.
+    """
+    #: Size of the chunks written to the response.
+    chunk_size = 64 * 1024
+
+    def __call__(self, info):
+        render_jsonp = super(StreamingJSONP, self).__call__(info)
+
+        def _render(value, system):
+            streamed = isinstance(value, dict) and \
+                any(is_iterator(v) for v in value.values())
+            if not streamed:
+                return render_jsonp(value, system)
+
+            request = system.get('request')
+            content_type = 'application/json'
+            chunks = self._iter_json(value, self._make_default(request))
+
+            callback = request.GET.get(self.param_name)
+            if callback is not None:
+                if not JSONP_VALID_CALLBACK.match(callback):
+                    raise HTTPBadRequest('Invalid JSONP callback function '
+                                         'name.')
+                content_type = 'application/javascript'
+                chunks = chain(['/**/%s(' % callback], chunks, [');'])
+
+            response = request.response
+            if response.content_type == response.default_content_type:
+                response.content_type = content_type
+            charset = response.charset or 'UTF-8'
+            response.app_iter = self._buffered(chunks, charset)
+
+        return _render
+
+    def _iter_json(self, value, default):
+        """Yields the JSON representation of the ``value`` mapping, piece by
+        piece.
+        """
+        dumps = partial(self.serializer, default=default, **self.kw)
+        yield '{'
+        for i, (key, item) in enumerate(value.items()):
+            if i > 0:
+                yield ', '
+            yield '%s: ' % dumps(key)
+            if not is_iterator(item):
+                yield dumps(item)
+                continue
+            yield '['
+            for j, element in enumerate(item):
+                if j > 0:
+                    yield ', '
+                yield dumps(element)
+            yield ']'
+        yield '}'
+
+    def _buffered(self, chunks, charset):
+        """Groups the serialized pieces into encoded chunks of
+        ``chunk_size``.
+        """
+        buffer, size = [], 0
+        for chunk in chunks:
+            buffer.append(chunk)
+            size += len(chunk)
+            if size >= self.chunk_size:
+                yield u''.join(buffer).encode(charset)
+                buffer, size = [], 0
+        if buffer:
+            yield u''.join(buffer).encode(charset)
+
+
+class NDJSON(StreamingJSONP):
+    """Renderer of an iterator as newline delimited JSON, streamed item by
+    item like with ``StreamingJSONP``.
+    """
+    def __call__(self, info):
+        def _render(value, system):
+            request = system.get('request')
+            dumps = partial(self.serializer,
+                            default=self._make_default(request), **self.kw)
+            lines = (u'%s\n' % dumps(item) for item in value)
+
+            response = request.response
+            if response.content_type == response.default_content_type:
+                response.content_type = 'application/x-ndjson'
+            charset = response.charset or 'UTF-8'
+            response.app_iter = self._buffered(lines, charset)
+
+        return _render
+
+
+class GeoJSON(StreamingJSONP):
     def __call__(self, info):
         def _render(value, system):
             request = system.get('request')
@@ -29,11 +132,11 @@ class GeoJSON(JSONP):
             records = value.get('records')
 
             if records is not None:
-                geojson = dict(type='FeatureCollection', features=[])
-                for record in records:
-                    feature = self._buildFeature(geom_fields, record)
-                    geojson['features'].append(feature)
-                value = geojson
+                features = (self._buildFeature(geom_fields, record)
+                            for record in records)
+                if not is_iterator(records):
+                    features = list(features)
+                value = dict(type='FeatureCollection', features=features)
 
             jsonp = super(GeoJSON, self).__call__(info)
             return jsonp(value, system)
@@ -59,19 +162,23 @@ class GeoJSON(JSONP):
 
     def _buildFeature(self, geom_fields, record):
         """Return GeoJSON feature (properties + geometry(ies))
+
+        The record is left untouched, since it can be shared with the
+        backend.
         """
+        properties = dict(record)
         feature = dict(type='Feature')
-        feature['id'] = record.pop('id', None)
+        feature['id'] = properties.pop('id', None)
         first = True
         for name, geomtype in geom_fields.items():
             if geomtype == 'geojson':
-                geometry = record.pop(name)
+                geometry = properties.pop(name)
             else:
                 # Note for future: this won't work for GeometryCollection
-                coords = record.pop(name)
+                coords = properties.pop(name)
                 geometry = dict(type=geomtype, coordinates=coords)
             name = 'geometry' if first else name
             feature[name] = geometry
             first = False
-        feature['properties'] = record
+        feature['properties'] = properties
         return feature
@@ -3,7 +3,7 @@ import datetime
 
 from pyramid.i18n import TranslationString as _
 from colander import (
-    deferred,
+    required,
     SchemaNode,
     String,
     OneOf,
@@ -186,9 +186,29 @@ class URLField(TypeField):
         return super(URLField, cls).validation(**kwargs)
 
 
+class AutoNowNode(SchemaNode):
+    """A schema node whose ``missing`` value can be a callable, evaluated on
+    each deserialization.
+
+    Unlike a bound ``deferred``, the default value is not frozen when the
+    schema is built: schemas can thus be cached and reused across requests.
+    """
+    @property
+    def missing(self):
+        missing = self.__dict__.get('missing', required)
+        if callable(missing):
+            return missing()
+        return missing
+
+    @missing.setter
+    def missing(self, value):
+        self.__dict__['missing'] = value
+
+
 class AutoNowMixin(object):
     """Mixin to share ``autonow`` mechanism for both date and datetime fields.
     """
+    schemanode = AutoNowNode
     autonow = False
 
     @classmethod
@@ -203,7 +223,7 @@ class AutoNowMixin(object):
         autonow = kwargs.get('autonow', cls.autonow)
         if autonow:
             kwargs['missing'] = cls.auto_value
-        return super(AutoNowMixin, cls).validation(**kwargs).bind()
+        return super(AutoNowMixin, cls).validation(**kwargs)
 
 
 @registry.add('date')
@@ -212,8 +232,8 @@ class DateField(AutoNowMixin, TypeField):
     node = Date
     hint = _('A date (yyyy-mm-dd)')
 
-    @deferred
-    def auto_value(node, kw):
+    @staticmethod
+    def auto_value():
         return datetime.date.today()
 
 
@@ -223,8 +243,8 @@ class DateTimeField(AutoNowMixin, TypeField):
     node = DateTime
     hint = _('A date with time (yyyy-mm-ddTHH:MM)')
 
-    @deferred
-    def auto_value(node, kw):
+    @staticmethod
+    def auto_value():
         return datetime.datetime.now()
 
 
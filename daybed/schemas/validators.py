@@ -1,6 +1,7 @@
 from __future__ import absolute_import
 from functools import partial
 from copy import deepcopy
+import hashlib
 import json
 import datetime
 import collections
@@ -178,6 +179,39 @@ model_validator = partial(validator, schema=ModelSchema())
 permissions_validator = partial(validator, schema=PermissionsSchema())
 
 
+def definition_hash(definition):
+    """Returns a digest of the model definition, to identify its revision.
+    """
+    serialized = json.dumps(definition, sort_keys=True)
+    return hashlib.md5(serialized.encode('utf-8')).hexdigest()
+
+
+def get_record_schema(request, model_id, definition):
+    """Returns the ``RecordSchema`` of the model definition, from the schemas
+    cache of the application if possible.
+    """
+    cache = getattr(request.registry, 'record_schemas', None)
+    if cache is None:
+        # Cache is not configured (e.g. outside the application).
+        return RecordSchema(definition)
+
+    key = (model_id, definition_hash(definition))
+    schema = cache.get(key)
+    if schema is None:
+        schema = RecordSchema(definition)
+        cache.set(key, schema)
+    return schema
+
+
+def invalidate_record_schemas(event):
+    """Drops cached schemas when a model definition changes.
+
+    Since a schema can embed the definition of another model (see ``object``
+    fields), they are all dropped.
+    """
+    event.request.registry.record_schemas.clear()
+
+
 def record_validator(request):
     """Validates a request body according to its model definition.
     """
@@ -185,7 +219,7 @@ def record_validator(request):
 
     try:
         definition = request.db.get_model_definition(model_id)
-        schema = RecordSchema(definition)
+        schema = get_record_schema(request, model_id, definition)
         validator(request, schema)
     except ModelNotFound:
         request.errors.add('path', 'modelname',
@@ -0,0 +1,32 @@
+"""Migrates the data stored in the backend by former versions of Daybed.
+"""
+import optparse
+import sys
+
+from pyramid.paster import bootstrap, setup_logging
+
+from daybed import logger
+
+
+def migrate(backend):
+    """Migrates the backend data, if the backend needs it."""
+    if not hasattr(backend, 'migrate'):
+        logger.info("%s has nothing to migrate." % type(backend).__name__)
+        return
+    backend.migrate()
+
+
+def main(argv=sys.argv):
+    parser = optparse.OptionParser(usage="%prog CONFIG_URI",
+                                   description=__doc__.strip())
+    _, args = parser.parse_args(argv[1:])
+    if not args:
+        parser.error("configuration file is missing.")
+    config_uri = args[0]
+
+    setup_logging(config_uri)
+    env = bootstrap(config_uri)
+    try:
+        migrate(env['registry'].backend)
+    finally:
+        env['closer']()
@@ -0,0 +1,42 @@
+"""Rebuilds the Elasticsearch indices of models from the backend, e.g. after
+an outage of the indexing service.
+"""
+import optparse
+import sys
+
+from pyramid.paster import bootstrap, setup_logging
+
+from daybed import logger
+from daybed.backends.exceptions import ModelNotFound
+
+
+def reindex(backend, index, model_ids=None):
+    """Reindexes the records of the specified models (all by default)."""
+    if not model_ids:
+        model_ids = backend.get_model_ids()
+    for model_id in model_ids:
+        try:
+            definition = backend.get_model_definition(model_id)
+            records = backend.iter_records_with_authors(model_id)
+        except ModelNotFound:
+            logger.error("Model '%s' not found." % model_id)
+            continue
+        logger.info("Reindex records of model '%s'" % model_id)
+        index.reindex(model_id, definition, (r['record'] for r in records))
+
+
+def main(argv=sys.argv):
+    parser = optparse.OptionParser(usage="%prog CONFIG_URI [MODEL_ID ...]",
+                                   description=__doc__.strip())
+    _, args = parser.parse_args(argv[1:])
+    if not args:
+        parser.error("configuration file is missing.")
+    config_uri, model_ids = args[0], args[1:]
+
+    setup_logging(config_uri)
+    env = bootstrap(config_uri)
+    try:
+        registry = env['registry']
+        reindex(registry.backend, registry.index, model_ids)
+    finally:
+        env['closer']()
@@ -9,13 +9,14 @@ import mock
 import six
 from couchdb.client import Server
 from couchdb.design import ViewDefinition
+from couchdb.http import Unauthorized
 
 from daybed.backends import exceptions as backend_exceptions
 from daybed.backends.couchdb import (
     CouchDBBackendConnectionError, CouchDBBackend
 )
 from daybed.backends.memory import MemoryBackend
-from daybed.backends.redis import RedisBackend
+from daybed.backends.redis import RedisBackend, author_records_key
 from redis.exceptions import ConnectionError
 
 from daybed.backends.couchdb.views import docs as couchdb_views
@@ -121,6 +122,27 @@ class BackendTestBase(object):
         self._create_model()
         self.assertEqual(self.db.get_models(["unknown"]), [])
 
+    def test_get_model_ids(self):
+        self._create_model()
+        self._create_model('other')
+        self.assertEqual(sorted(self.db.get_model_ids()),
+                         ['modelname', 'other'])
+        self.db.delete_model('other')
+        self.assertEqual(self.db.get_model_ids(), ['modelname'])
+
+    def test_get_models_follows_permissions_changes(self):
+        self.db.put_model(self.definition, {'read_definition': ['Remy']},
+                          'modelname')
+        self.db.put_model(self.definition, {'read_definition': ['Alexis']},
+                          'modelname')
+        self.assertEqual(self.db.get_models(["Remy"]), [])
+        self.assertEqual(len(self.db.get_models(["Alexis"])), 1)
+
+    def test_get_models_ignores_deleted_models(self):
+        self._create_model()
+        self.db.delete_model('modelname')
+        self.assertEqual(self.db.get_models(["Remy"]), [])
+
     def test_get_model_permissions(self):
         self._create_model()
         self.assertEqual(self.db.get_model_permissions('modelname'), {
@@ -139,6 +161,38 @@ class BackendTestBase(object):
         authors = self.db.get_record_authors('modelname', item_id)
         self.assertEquals(set(authors), set(['Alexis', 'Remy']))
 
+    def test_put_records(self):
+        self._create_model()
+        records = [{'age': age} for age in range(5)]
+        records_ids = self.db.put_records('modelname', records, ['Remy'])
+        self.assertEqual(len(set(records_ids)), 5)
+        for age, record_id in enumerate(records_ids):
+            record = self.db.get_record('modelname', record_id)
+            self.assertEqual(record['age'], age)
+            self.assertEqual(
+                self.db.get_record_authors('modelname', record_id), ['Remy'])
+
+    def test_put_record_keeps_empty_lists(self):
+        self._create_model()
+        self.db.put_record('modelname', {'tags': [], 'meta': {}},
+                           ['author'], 'record')
+        record = self.db.get_record('modelname', 'record')
+        self.assertEqual(record['tags'], [])
+        self.assertEqual(record['meta'], {})
+
+    def test_delete_records(self):
+        self._create_model()
+        self.db.put_record('modelname', self.record, ['author'], 'record')
+        records = self.db.delete_records('modelname')
+        self.assertEqual(records, [{'age': 7, 'id': 'record'}])
+        self.assertRaises(backend_exceptions.RecordNotFound,
+                          self.db.get_record, 'modelname', 'record')
+
+    def test_delete_unknown_record(self):
+        self._create_model()
+        self.assertRaises(backend_exceptions.RecordNotFound,
+                          self.db.delete_record, 'modelname', 'unknown')
+
     def test_get_records(self):
         self._create_model()
         self.db.put_record('modelname', self.record, ['author'])
@@ -157,6 +211,112 @@ class BackendTestBase(object):
         del records[0]['record']['id']
         self.assertDictEqual(records[0], {'authors': [u'author'], 'record': {u'age': 7}})
 
+    def test_get_records_page(self):
+        self._create_model()
+        for record_id in ('c', 'a', 'd', 'b', 'e'):
+            self.db.put_record('modelname', self.record, ['author'],
+                               record_id)
+        records, cursor = self.db.get_records_page('modelname', 2)
+        self.assertEqual([r['record']['id'] for r in records], ['a', 'b'])
+        self.assertEqual(records[0]['authors'], ['author'])
+        self.assertEqual(cursor, 'b')
+
+        records, cursor = self.db.get_records_page('modelname', 2, cursor)
+        self.assertEqual([r['record']['id'] for r in records], ['c', 'd'])
+        records, cursor = self.db.get_records_page('modelname', 2, cursor)
+        self.assertEqual([r['record']['id'] for r in records], ['e'])
+        self.assertIsNone(cursor)
+
+    def test_get_records_page_after_deleted_cursor(self):
+        self._create_model()
+        for record_id in ('a', 'b', 'c'):
+            self.db.put_record('modelname', self.record, ['author'],
+                               record_id)
+        self.db.delete_record('modelname', 'a')
+        records, cursor = self.db.get_records_page('modelname', 5, 'a')
+        self.assertEqual([r['record']['id'] for r in records], ['b', 'c'])
+        self.assertIsNone(cursor)
+
+    def test_get_records_page_unknown_model(self):
+        self.assertRaises(backend_exceptions.ModelNotFound,
+                          self.db.get_records_page, 'unknown', 10)
+
+    def test_iter_records_with_authors(self):
+        self._create_model()
+        for record_id in ('a', 'b', 'c'):
+            self.db.put_record('modelname', self.record, ['author'],
+                               record_id)
+        records = self.db.iter_records_with_authors('modelname')
+        self.assertFalse(isinstance(records, list))
+        records = sorted(records, key=lambda r: r['record']['id'])
+        self.assertEqual([r['record']['id'] for r in records],
+                         ['a', 'b', 'c'])
+        self.assertEqual(records[0]['authors'], ['author'])
+
+    def test_iter_records_with_authors_unknown_model(self):
+        self.assertRaises(backend_exceptions.ModelNotFound,
+                          self.db.iter_records_with_authors, 'unknown')
+
+    def test_get_records_by_author(self):
+        self._create_model()
+        self.db.put_record('modelname', self.record, ['remy'], 'c')
+        self.db.put_record('modelname', self.record, ['alexis'], 'b')
+        self.db.put_record('modelname', self.record, ['remy', 'alexis'], 'a')
+        records = self.db.get_records_by_author('modelname', ['remy'])
+        self.assertEqual([r['id'] for r in records], ['a', 'c'])
+        self.assertEqual(records[0]['age'], 7)
+        records = self.db.get_records_by_author('modelname',
+                                                ['remy', 'alexis'])
+        self.assertEqual([r['id'] for r in records], ['a', 'b', 'c'])
+        self.assertEqual(
+            self.db.get_records_by_author('modelname', ['unknown']), [])
+
+    def test_get_records_by_author_follows_writes(self):
+        self._create_model()
+        self.db.put_record('modelname', self.record, ['remy'], 'a')
+        self.db.put_record('modelname', self.record, ['remy'], 'b')
+        self.db.put_record('modelname', {'age': 8}, ['alexis'], 'a')
+        records = self.db.get_records_by_author('modelname', ['alexis'])
+        self.assertEqual([r['id'] for r in records], ['a'])
+        self.db.delete_record('modelname', 'a')
+        records = self.db.get_records_by_author('modelname', ['remy'])
+        self.assertEqual([r['id'] for r in records], ['b'])
+        self.db.delete_records('modelname')
+        self._create_model()
+        self.assertEqual(
+            self.db.get_records_by_author('modelname', ['remy']), [])
+
+    def test_get_records_by_author_page(self):
+        self._create_model()
+        for record_id, authors in (('d', ['remy']), ('c', ['alexis']),
+                                   ('b', ['remy', 'alexis']), ('a', ['ed'])):
+            self.db.put_record('modelname', self.record, authors, record_id)
+        records, cursor = self.db.get_records_by_author_page(
+            'modelname', ['remy', 'alexis'], 2)
+        self.assertEqual([r['id'] for r in records], ['b', 'c'])
+        self.assertEqual(records[0]['age'], 7)
+        records, cursor = self.db.get_records_by_author_page(
+            'modelname', ['remy', 'alexis'], 2, cursor)
+        self.assertEqual([r['id'] for r in records], ['d'])
+        self.assertIsNone(cursor)
+        records, cursor = self.db.get_records_by_author_page(
+            'modelname', ['unknown'], 2)
+        self.assertEqual((records, cursor), ([], None))
+
+    def test_get_records_by_author_page_after_deleted_cursor(self):
+        self._create_model()
+        for record_id in ('a', 'b', 'c'):
+            self.db.put_record('modelname', self.record, ['remy'], record_id)
+        self.db.delete_record('modelname', 'b')
+        records, cursor = self.db.get_records_by_author_page(
+            'modelname', ['remy'], 1, 'b')
+        self.assertEqual([r['id'] for r in records], ['c'])
+        self.assertIsNone(cursor)
+
+    def test_get_records_by_author_unknown_model(self):
+        self.assertRaises(backend_exceptions.ModelNotFound,
+                          self.db.get_records_by_author, 'unknown', ['remy'])
+
     def test_get_records_empty(self):
         self._create_model()
         self.assertEqual(self.db.get_records('modelname'), [])
@@ -235,6 +395,79 @@ class TestCouchDBBackend(BackendTestBase, TestCase):
         CouchDBBackend.load_from_config(config)
         self.assertTrue(constructor_mock.called)
 
+    @mock.patch('daybed.backends.couchdb.CouchDBBackend.__init__')
+    def test_load_from_config_reads_stale_policy(self, constructor_mock):
+        constructor_mock.return_value = None
+        config = mock.MagicMock()
+        config.registry.settings = {'backend.db_host': 'http://localhost',
+                                    'backend.db_name': 'daybed',
+                                    'daybed.id_generator': 'generator',
+                                    'backend.stale': 'update_after'}
+        CouchDBBackend.load_from_config(config)
+        _, kwargs = constructor_mock.call_args
+        self.assertEqual(kwargs['stale'], 'update_after')
+
+    def test_bulk_operations_are_sent_by_batches(self):
+        self.db.bulk_size = 2
+        self._create_model()
+        records = [{'age': age} for age in range(5)]
+        with mock.patch.object(self.db._db, 'update',
+                               wraps=self.db._db.update) as mocked:
+            self.db.put_records('modelname', records, ['Remy'])
+            self.assertEqual(mocked.call_count, 3)
+            self.db.delete_records('modelname')
+            self.assertEqual(mocked.call_count, 6)
+        self.assertEqual(self.db.get_records('modelname'), [])
+
+    def test_records_updated_during_deletion_are_deleted(self):
+        self._create_model()
+        self.db.put_record('modelname', self.record, ['Remy'], 'record')
+        update = self.db._db.update
+        calls = []
+
+        def update_meanwhile(docs):
+            if not calls:
+                self.db.put_record('modelname', {'age': 8}, ['Remy'],
+                                   'record')
+            calls.append(docs)
+            return update(docs)
+
+        with mock.patch.object(self.db._db, 'update',
+                               side_effect=update_meanwhile):
+            self.db.delete_records('modelname')
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(self.db.get_records('modelname'), [])
+
+    def test_records_deletion_errors_are_raised(self):
+        self._create_model()
+        self.db.put_record('modelname', self.record, ['Remy'], 'record')
+        with mock.patch.object(self.db._db, 'update',
+                               return_value=[(False, 'modelname-record',
+                                              Unauthorized())]):
+            self.assertRaises(Unauthorized,
+                              self.db.delete_records, 'modelname')
+
+    def test_views_do_not_duplicate_documents(self):
+        self._create_model()
+        self.db.put_record('modelname', self.record, ['Remy'], 'record')
+        rows = list(self.db._db.view('records/by_model'))
+        self.assertEqual([r.value for r in rows], [None])
+
+    def test_obsolete_views_are_removed(self):
+        self.db._db['_design/records_all'] = {'views': {}}
+        self.db.sync_views()
+        self.assertIsNone(self.db._db.get('_design/records_all'))
+
+    def test_listing_reads_can_be_stale(self):
+        self.db._read_options = {'stale': 'update_after'}
+        self._create_model()
+        with mock.patch.object(self.db._db, 'view',
+                               wraps=self.db._db.view) as mocked:
+            self.db.get_records('modelname')
+            self.db.get_models(['Remy'])
+        for call in mocked.call_args_list:
+            self.assertEqual(call[1]['stale'], 'update_after')
+
 
 class TestRedisBackend(BackendTestBase, TestCase):
 
@@ -252,6 +485,129 @@ class TestRedisBackend(BackendTestBase, TestCase):
     def tearDown(self):
         self.db.delete_db()
 
+    def _count_round_trips(self, method, *args):
+        with mock.patch.object(self.db._db, 'execute_command',
+                               wraps=self.db._db.execute_command) as mocked:
+            method(*args)
+            return mocked.call_count
+
+    def test_writes_are_single_round_trips(self):
+        self._create_model()
+        # Load server-side scripts first.
+        self.db.put_record('modelname', self.record, ['Remy'], 'record')
+        self.db.delete_record('modelname', 'record')
+        self.db.delete_records('modelname')
+
+        trips = self._count_round_trips(self.db.put_record, 'modelname',
+                                        self.record, ['Alexis'])
+        self.assertEqual(trips, 1)
+        trips = self._count_round_trips(self.db.put_record, 'modelname',
+                                        self.record, ['Alexis'], 'record')
+        self.assertEqual(trips, 1)
+        trips = self._count_round_trips(self.db.delete_records, 'modelname')
+        self.assertEqual(trips, 1)
+        self.db.put_record('modelname', self.record, ['Alexis'], 'record')
+        trips = self._count_round_trips(self.db.delete_record, 'modelname',
+                                        'record')
+        self.assertEqual(trips, 1)
+
+    def test_authors_index_is_deleted_with_model(self):
+        self._create_model()
+        self.db.put_record('modelname', self.record, ['Remy'], 'record')
+        self.assertTrue(self.db._db.exists(
+            author_records_key('modelname', 'Remy')))
+        self.db.delete_model('modelname')
+        self.assertEqual(self.db._db.keys('*modelname*'), [])
+
+    def test_put_records_retries_if_generated_id_exists(self):
+        self._create_model()
+        self.db.put_record('modelname', self.record, ['Remy'], 'taken')
+        self.db._generate_id = mock.Mock(side_effect=['a', 'taken', 'b'])
+        records = [{'age': 1}, {'age': 2}]
+        records_ids = self.db.put_records('modelname', records, ['Alexis'])
+        self.assertEqual(records_ids, ['a', 'b'])
+        self.assertEqual(self.db.get_record('modelname', 'taken')['age'], 7)
+        self.assertEqual(self.db.get_record('modelname', 'b')['age'], 2)
+
+    def test_put_records_is_a_single_round_trip_per_batch(self):
+        self._create_model()
+        # Load server-side scripts first.
+        self.db.put_record('modelname', self.record, ['Remy'], 'record')
+        records = [{'age': age} for age in range(5)]
+        with mock.patch.object(self.db._db, 'pipeline',
+                               wraps=self.db._db.pipeline) as mocked:
+            self.db.put_records('modelname', records, ['Remy'], batch_size=2)
+        self.assertEqual(mocked.call_count, 3)
+
+    def test_get_models_does_not_scan_keyspace(self):
+        self._create_model()
+        with mock.patch.object(self.db._db, 'execute_command',
+                               wraps=self.db._db.execute_command) as mocked:
+            self.assertEqual(len(self.db.get_models(["Remy"])), 1)
+        commands = [c[0][0] for c in mocked.call_args_list]
+        self.assertNotIn('KEYS', commands)
+        self.assertNotIn('SCAN', commands)
+
+    def test_migration_indexes_models_of_former_versions(self):
+        self._create_model()
+        self.db._db.delete('models', 'readablemodels.Remy')
+        self.assertEqual(self.db.get_models(['Remy']), [])
+        self.db.migrate()
+        self.db.migrate()
+        self.assertEqual(self.db.get_model_ids(), ['modelname'])
+        self.assertEqual(len(self.db.get_models(['Remy'])), 1)
+
+    def test_migration_converts_records_sets_to_sorted_sets(self):
+        self._create_model()
+        for record_id in ('b', 'a'):
+            self.db.put_record('modelname', self.record, ['Remy'], record_id)
+        keys = self.db._db.zrange('modelrecords.modelname', 0, -1)
+        self.db._db.delete('modelrecords.modelname')
+        self.db._db.sadd('modelrecords.modelname', *keys)
+        self.db.migrate()
+        self.db.migrate()
+        records, cursor = self.db.get_records_page('modelname', 1)
+        self.assertEqual(records[0]['record']['id'], 'a')
+        self.assertEqual(len(self.db.get_records('modelname')), 2)
+
+    def test_migration_indexes_records_by_author(self):
+        self._create_model()
+        self.db.put_record('modelname', self.record, ['Remy', 'Ed'], 'a')
+        self.db.put_record('modelname', self.record, ['Remy'], 'b')
+        self.db._db.delete(author_records_key('modelname', 'Remy'),
+                           author_records_key('modelname', 'Ed'),
+                           'modelauthors.modelname')
+        # Index of former versions.
+        self.db._db.execute_command('ZADD', 'authorrecords.modelname.Remy',
+                                    0, 'x')
+        self.db.migrate()
+        records = self.db.get_records_by_author('modelname', ['Remy'])
+        self.assertEqual([r['id'] for r in records], ['a', 'b'])
+        self.db.delete_model('modelname')
+        self.assertEqual(self.db._db.keys('*modelname*'), [])
+
+    def test_authors_index_is_unambiguous_with_dotted_ids(self):
+        self.db.put_model({'fields': []}, {}, 'm.1')
+        self.db.put_model({'fields': []}, {}, 'm')
+        self.db.put_record('m.1', self.record, ['u'], 'a')
+        self.db.put_record('m', self.record, ['1.u'], 'b')
+        self.assertEqual(self.db.get_records_by_author('m', ['1.u']),
+                         [dict(self.record, id='b')])
+        records, _ = self.db.get_records_by_author_page('m', ['1.u'], 10)
+        self.assertEqual([r['id'] for r in records], ['b'])
+        self.db.delete_records('m.1')
+        self.assertEqual(len(self.db.get_records_by_author('m', ['1.u'])), 1)
+
+    def test_put_record_retries_if_generated_id_exists(self):
+        self._create_model()
+        self.db.put_record('modelname', self.record, ['Remy'], 'taken')
+        self.db._generate_id = mock.Mock(side_effect=['taken', 'free'])
+        record_id = self.db.put_record('modelname', {'age': 3}, ['Alexis'])
+        self.assertEqual(record_id, 'free')
+        self.assertEqual(self.db.get_record('modelname', 'taken')['age'], 7)
+        self.assertEqual(self.db.get_record_authors('modelname', 'taken'),
+                         ['Remy'])
+
     def test_server_unreachable(self):
         with self.assertRaises(ConnectionError):
             RedisBackend(
@@ -272,3 +628,32 @@ class TestMemoryBackend(BackendTestBase, TestCase):
     def setUp(self):
         self.db = MemoryBackend(self.id_generator)
         super(TestMemoryBackend, self).setUp()
+
+    def test_reads_are_not_copied(self):
+        self._create_model()
+        self.db.put_record('modelname', self.record, ['Remy'], 'record')
+        self.assertIs(self.db.get_record('modelname', 'record'),
+                      self.db.get_records('modelname')[0])
+        self.assertIs(self.db.get_model_definition('modelname'),
+                      self.db.get_model_definition('modelname'))
+
+    def test_writes_are_copied(self):
+        self._create_model()
+        self.db.put_record('modelname', self.record, ['Remy'], 'record')
+        self.record['age'] = 12
+        self.assertEqual(self.db.get_record('modelname', 'record')['age'], 7)
+
+    def test_updates_do_not_modify_previous_reads(self):
+        self._create_model()
+        self.db.put_record('modelname', self.record, ['Remy'], 'record')
+        before = self.db.get_record('modelname', 'record')
+        self.db.put_record('modelname', {'age': 12}, ['Alexis'], 'record')
+        self.assertEqual(before['age'], 7)
+        self.assertEqual(self.db.get_record('modelname', 'record')['age'], 12)
+
+    def test_records_ids_are_kept_sorted(self):
+        self._create_model()
+        for record_id in ('c', 'a', 'b', 'a'):
+            self.db.put_record('modelname', self.record, ['Remy'], record_id)
+        self.db.delete_record('modelname', 'b')
+        self.assertEqual(self.db._db['ids']['modelname'], ['a', 'c'])
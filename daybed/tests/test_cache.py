@@ -0,0 +1,256 @@
+import time
+
+import mock
+
+from daybed.backends.exceptions import CredentialsNotFound
+from daybed.cache import (CredentialsCache, LRUCache, NonceCache,
+                          PermissionsCache, RedisNonceCache, SearchCache)
+from daybed.permissions import PERMISSIONS_BITS, principals_masks
+from daybed.tests.support import unittest
+
+
+class LRUCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = LRUCache(size=2)
+
+    def test_returns_default_if_missing(self):
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(self.cache.get('a', 42), 42)
+
+    def test_returns_stored_values(self):
+        self.cache.set('a', 1)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertIn('a', self.cache)
+
+    def test_least_recently_used_items_are_evicted(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.get('a')
+        self.cache.set('c', 3)
+        self.assertEqual(len(self.cache), 2)
+        self.assertNotIn('b', self.cache)
+        self.assertIn('a', self.cache)
+
+    def test_hits_and_misses_are_counted(self):
+        self.cache.set('a', 1)
+        self.cache.get('a')
+        self.cache.get('b')
+        self.cache.get('c')
+        self.assertEqual(self.cache.stats(),
+                         {'size': 1, 'hits': 1, 'misses': 2})
+
+    def test_items_can_be_removed(self):
+        self.cache.set('a', 1)
+        self.assertEqual(self.cache.pop('a'), 1)
+        self.assertIsNone(self.cache.pop('a'))
+        self.cache.set('b', 2)
+        self.cache.clear()
+        self.assertEqual(len(self.cache), 0)
+
+
+class SearchCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = SearchCache(size=10)
+        self.cache.set('movies', '{"a": 1, "b": 2}', {'size': '1'}, 'results')
+
+    def test_results_are_found_by_normalized_query(self):
+        self.assertEqual(self.cache.get('movies', '{"b": 2, "a": 1}',
+                                        {'size': '1'}), 'results')
+        self.assertIsNone(self.cache.get('movies', '{"a": 1, "b": 2}', {}))
+        self.assertIsNone(self.cache.get('other', '{"a": 1, "b": 2}',
+                                         {'size': '1'}))
+
+    def test_results_are_obsolete_once_model_changes(self):
+        self.cache.invalidate('movies')
+        self.assertIsNone(self.cache.get('movies', '{"a": 1, "b": 2}',
+                                         {'size': '1'}))
+
+    def test_results_obtained_right_after_changes_expire_soon(self):
+        self.cache.invalidate('movies')
+        self.cache.set('movies', '{}', {}, 'results')
+        self.assertEqual(self.cache.get('movies', '{}', {}), 'results')
+        with mock.patch('daybed.cache.time.time') as time_mock:
+            time_mock.return_value = self.cache._generations['movies'] + 1
+            self.assertIsNone(self.cache.get('movies', '{}', {}))
+
+    def test_settle_delay_can_be_configured(self):
+        cache = SearchCache(size=10, settle_delay=5)
+        cache.invalidate('movies')
+        cache.set('movies', '{}', {}, 'results')
+        with mock.patch('daybed.cache.time.time') as time_mock:
+            time_mock.return_value = cache._generations['movies'] + 1
+            self.assertEqual(cache.get('movies', '{}', {}), 'results')
+            time_mock.return_value = cache._generations['movies'] + 5
+            self.assertIsNone(cache.get('movies', '{}', {}))
+
+    def test_invalid_queries_are_not_cached(self):
+        self.cache.set('movies', '{', {}, 'error')
+        self.assertIsNone(self.cache.get('movies', '{', {}))
+
+    def test_generations_can_be_shared_through_redis(self):
+        redis = mock.MagicMock()
+        redis.get.return_value = None
+        cache = SearchCache(size=10, redis=redis)
+        cache.set('movies', '{}', {}, 'results')
+        self.assertEqual(cache.get('movies', '{}', {}), 'results')
+        redis.get.return_value = b'1234.5'
+        self.assertIsNone(cache.get('movies', '{}', {}))
+        cache.invalidate('movies')
+        self.assertEqual(redis.set.call_args[0][0], 'searchgeneration.movies')
+
+
+class CredentialsCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = CredentialsCache(size=10, ttl=300)
+        self.backend = mock.MagicMock()
+        self.backend.get_credentials_key.return_value = 'secret'
+        patcher = mock.patch('daybed.cache.time.time', return_value=100)
+        self.time_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_keys_are_read_once_until_expired(self):
+        self.assertEqual(self.cache.get_key(self.backend, 'alexis'), 'secret')
+        self.cache.get_key(self.backend, 'alexis')
+        self.assertEqual(self.backend.get_credentials_key.call_count, 1)
+        self.time_mock.return_value = 400
+        self.cache.get_key(self.backend, 'alexis')
+        self.assertEqual(self.backend.get_credentials_key.call_count, 2)
+
+    def test_unknown_ids_are_remembered_for_a_short_while(self):
+        self.backend.get_credentials_key.side_effect = CredentialsNotFound
+        for i in range(2):
+            self.assertRaises(CredentialsNotFound, self.cache.get_key,
+                              self.backend, 'unknown')
+        self.assertEqual(self.backend.get_credentials_key.call_count, 1)
+        self.time_mock.return_value = 110
+        self.assertRaises(CredentialsNotFound, self.cache.get_key,
+                          self.backend, 'unknown')
+        self.assertEqual(self.backend.get_credentials_key.call_count, 2)
+
+    def test_invalidated_ids_are_read_again(self):
+        self.backend.get_credentials_key.side_effect = CredentialsNotFound
+        self.assertRaises(CredentialsNotFound, self.cache.get_key,
+                          self.backend, 'alexis')
+        self.cache.invalidate('alexis')
+        self.backend.get_credentials_key.side_effect = None
+        self.assertEqual(self.cache.get_key(self.backend, 'alexis'), 'secret')
+
+
+class NonceCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = NonceCache(window=60, max_size=3)
+        patcher = mock.patch('daybed.cache.time.time', return_value=1000)
+        self.time_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_nonces_can_be_used_once(self):
+        self.assertTrue(self.cache.check_nonce(1000, 'abc'))
+        self.assertFalse(self.cache.check_nonce(1000, 'abc'))
+        self.assertTrue(self.cache.check_nonce(1001, 'abc'))
+
+    def test_timestamps_out_of_window_are_refused(self):
+        self.assertFalse(self.cache.check_nonce(940, 'abc'))
+        self.assertFalse(self.cache.check_nonce(1060, 'abc'))
+
+    def test_nonces_expire_with_their_timestamp(self):
+        self.cache.check_nonce(1000, 'abc')
+        self.cache.check_nonce(1000, 'def')
+        self.time_mock.return_value = 1000 + 122
+        self.assertTrue(self.cache.check_nonce(1122, 'abc'))
+        self.assertEqual(len(self.cache), 1)
+
+    def test_requests_are_refused_when_full_of_valid_nonces(self):
+        for nonce in ('a', 'b', 'c'):
+            self.cache.check_nonce(1000, nonce)
+        self.assertFalse(self.cache.check_nonce(1000, 'd'))
+        self.time_mock.return_value = 1070
+        self.assertTrue(self.cache.check_nonce(1070, 'd'))
+
+
+class RedisNonceCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.redis = mock.MagicMock()
+        self.cache = RedisNonceCache(self.redis, window=60)
+
+    def test_nonces_are_set_if_missing_until_out_of_window(self):
+        self.redis.set.return_value = True
+        self.assertTrue(self.cache.check_nonce(time.time(), 'abc'))
+        self.redis.set.return_value = None
+        self.assertFalse(self.cache.check_nonce(time.time(), 'abc'))
+        args, kwargs = self.redis.set.call_args
+        self.assertTrue(args[0].startswith('hawknonce.'))
+        self.assertEqual(kwargs, {'nx': True, 'ex': 120})
+
+    def test_timestamps_out_of_window_are_refused(self):
+        self.assertFalse(self.cache.check_nonce(time.time() - 120, 'abc'))
+        self.assertFalse(self.redis.set.called)
+
+
+class PermissionsCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = PermissionsCache(size=10, ttl=60)
+        self.load = mock.MagicMock(return_value={'read_definition': ['a']})
+
+    def test_permissions_are_loaded_once_until_invalidated(self):
+        self.assertEqual(self.cache.get('movies', self.load),
+                         {'read_definition': ['a']})
+        self.cache.get('movies', self.load)
+        self.assertEqual(self.load.call_count, 1)
+        self.cache.invalidate('movies')
+        self.cache.get('movies', self.load)
+        self.assertEqual(self.load.call_count, 2)
+
+    def test_permissions_read_during_a_write_are_not_served(self):
+        def load(model_id):
+            self.cache.invalidate(model_id)
+            return {}
+        self.cache.get('movies', load)
+        self.cache.get('movies', self.load)
+        self.assertEqual(self.load.call_count, 1)
+
+    def test_masks_are_compiled_once_until_invalidated(self):
+        with mock.patch('daybed.cache.principals_masks',
+                        wraps=principals_masks) as compile_masks:
+            self.assertEqual(self.cache.get_masks('movies', self.load),
+                             {'a': PERMISSIONS_BITS['read_definition']})
+            self.cache.get_masks('movies', self.load)
+            self.cache.get('movies', self.load)
+            self.assertEqual(compile_masks.call_count, 1)
+            self.assertEqual(self.load.call_count, 1)
+            self.cache.invalidate('movies')
+            self.cache.get_masks('movies', self.load)
+            self.assertEqual(compile_masks.call_count, 2)
+
+    def test_only_last_written_models_are_remembered(self):
+        self.cache.get('movies', self.load)
+        for i in range(20):
+            self.cache.invalidate('model%s' % i)
+        self.assertEqual(len(self.cache._writes), 10)
+        # Permissions read before forgotten writes are read again.
+        self.cache.get('movies', self.load)
+        self.assertEqual(self.load.call_count, 2)
+        self.cache.get('movies', self.load)
+        self.assertEqual(self.load.call_count, 2)
+
+    @mock.patch('daybed.cache.time.time')
+    def test_permissions_expire(self, time_mock):
+        time_mock.return_value = 100
+        self.cache.get('movies', self.load)
+        time_mock.return_value = 160
+        self.cache.get('movies', self.load)
+        self.assertEqual(self.load.call_count, 2)
+
+    def test_writes_are_published_to_other_nodes(self):
+        redis = mock.MagicMock()
+        cache = PermissionsCache(size=10, redis=redis)
+        self.addCleanup(cache.stop)
+        cache.get('movies', self.load)
+        cache.invalidate('movies')
+        redis.publish.assert_called_with('daybed.permissions', 'movies')
+        # Messages of other nodes invalidate permissions.
+        cache.get('movies', self.load)
+        on_message = redis.pubsub().subscribe.call_args[1][
+            'daybed.permissions']
+        on_message({'data': b'movies'})
+        cache.get('movies', self.load)
+        self.assertEqual(self.load.call_count, 3)
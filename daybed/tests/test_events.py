@@ -0,0 +1,86 @@
+import mock
+
+from daybed import events
+
+from .support import BaseWebTest, unittest
+from .test_views import MODEL_DEFINITION, MODEL_RECORD
+
+
+class EventsPayloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.request = mock.MagicMock()
+        self.db = self.request.db
+
+    def test_given_objects_are_not_read(self):
+        event = events.RecordCreated('test', 'rec', self.request,
+                                     record={'age': 7},
+                                     definition={'fields': []})
+        self.assertEqual(event.record, {'age': 7})
+        self.assertEqual(event.definition, {'fields': []})
+        self.assertFalse(self.db.get_record.called)
+        self.assertFalse(self.db.get_model_definition.called)
+
+    def test_missing_objects_are_read_once(self):
+        event = events.RecordUpdated('test', 'rec', self.request)
+        event.record
+        event.record
+        self.db.get_record.assert_called_once_with('test', 'rec')
+        event.definition
+        self.db.get_model_definition.assert_called_once_with('test')
+
+    def test_events_have_no_instance_dict(self):
+        event = events.ModelCreated('test', self.request)
+        self.assertRaises(AttributeError, setattr, event, 'other', 1)
+
+
+class NotifiedPayloadTest(BaseWebTest):
+
+    def setUp(self):
+        super(NotifiedPayloadTest, self).setUp()
+        self.app.put_json('/models/test', MODEL_DEFINITION,
+                          headers=self.headers)
+        self.app.put_json('/models/test/records/rec', MODEL_RECORD,
+                          headers=self.headers)
+        self.notified = []
+        registry = self.app.app.registry
+        for klass in (events.ModelUpdated, events.RecordUpdated,
+                      events.RecordDeleted, events.AllRecordsDeleted):
+            registry.registerHandler(self.notified.append, (klass,))
+
+    def test_updated_record_is_notified_with_previous_version(self):
+        record = dict(MODEL_RECORD, age=43)
+        self.app.put_json('/models/test/records/rec', record,
+                          headers=self.headers)
+        event, = self.notified
+        self.assertEqual(event.record['age'], 43)
+        self.assertEqual(event.previous['age'], MODEL_RECORD['age'])
+
+    def test_patched_record_is_notified_with_previous_version(self):
+        self.app.patch_json('/models/test/records/rec', {'age': 43},
+                            headers=self.headers)
+        event, = self.notified
+        self.assertEqual(event.record['age'], 43)
+        self.assertEqual(event.previous['age'], MODEL_RECORD['age'])
+
+    def test_deleted_record_is_notified(self):
+        self.app.delete('/models/test/records/rec', headers=self.headers)
+        event, = self.notified
+        self.assertEqual(event.record['age'], MODEL_RECORD['age'])
+
+    def test_updated_definition_is_notified_with_previous_version(self):
+        definition = dict(MODEL_DEFINITION['definition'], title='changed')
+        self.app.put_json('/models/test/definition', definition,
+                          headers=self.headers)
+        event, = self.notified
+        self.assertEqual(event.definition['title'], 'changed')
+        self.assertEqual(event.previous['title'],
+                         MODEL_DEFINITION['definition']['title'])
+
+    def test_deleting_all_records_notifies_one_event(self):
+        self.app.put_json('/models/test/records/other', MODEL_RECORD,
+                          headers=self.headers)
+        self.app.delete('/models/test/records', headers=self.headers)
+        event, = self.notified
+        self.assertIsInstance(event, events.AllRecordsDeleted)
+        self.assertEqual(len(event.records), 2)
@@ -48,11 +48,11 @@ class FunctionalTest(object):
                                  {'definition': data},
                                  headers=self.headers)
 
-    def create_record(self, data=None):
+    def create_record(self, data=None, headers=None):
         if not data:
             data = self.valid_record
         return self.app.post_json('/models/%s/records' % self.model_id,
-                                  data, headers=self.headers)
+                                  data, headers=headers or self.headers)
 
     def test_normal_record_creation(self):
         # Put data against this definition
@@ -143,7 +143,9 @@ class FunctionalTest(object):
 
     def test_data_search_without_filter(self):
         self.create_definition()
-        self.create_record()
+        # Record has to be searchable right away.
+        self.create_record(headers=dict(self.headers,
+                                        **{'Index-Refresh': 'immediate'}))
         query = {'query': {'match_all': {}}}
         resp = self.app.request('/models/%s/search/' % self.model_id,
                                 method='GET',
@@ -2,11 +2,14 @@ import decimal
 import json
 import copy
 import mock
+import time
+import threading
 
+from daybed.backends import exceptions as backend_exceptions
 from daybed.schemas import registry
 from daybed import indexer
 
-from .support import BaseWebTest
+from .support import BaseWebTest, unittest
 from .test_views import MODEL_DEFINITION, MODEL_RECORD
 
 
@@ -60,21 +63,185 @@ class ModelsIndicesTest(BaseWebTest):
                            headers=self.headers)
         self.assertTrue(error_mock.called)
 
-    @mock.patch('elasticsearch.client.indices.IndicesClient.delete')
-    def test_existing_index_is_not_deleted_on_model_put(self, delete_mock):
+    def _mock_indices(self):
+        patcher = mock.patch.object(self.indexer.client, 'indices')
+        self.addCleanup(patcher.stop)
+        indices = patcher.start()
+        patcher = mock.patch.object(self.indexer.client, 'bulk')
+        self.addCleanup(patcher.stop)
+        self.bulk_mock = patcher.start()
+        self.bulk_mock.return_value = {'errors': False, 'items': []}
+        return indices
+
+    def test_index_is_created_behind_alias_on_model_creation(self):
+        indices = self._mock_indices()
+        indices.exists.return_value = False
+        self.app.put_json('/models/test', MODEL_DEFINITION,
+                          headers=self.headers)
+        alias = self.indexer.prefix('test')
+        index = indices.create.call_args[1]['index']
+        self.assertTrue(index.startswith(alias + '_'))
+        indices.update_aliases.assert_called_with(body={'actions': [
+            {'add': {'index': index, 'alias': alias}}]})
+
+    def test_records_are_reindexed_in_new_index_on_model_update(self):
         self.app.put_json('/models/test', MODEL_DEFINITION,
                           headers=self.headers)
+        self.app.put_json('/models/test/records/1', MODEL_RECORD,
+                          headers=self.headers)
+        indices = self._mock_indices()
+        alias = self.indexer.prefix('test')
+        indices.exists.return_value = True
+        indices.exists_alias.return_value = True
+        indices.get_alias.return_value = {alias + '_1': {}}
+        self.app.put_json('/models/test/definition',
+                          MODEL_DEFINITION['definition'],
+                          headers=self.headers)
+        self.indexer.join()
+
+        index = indices.create.call_args[1]['index']
+        self.assertNotEqual(index, alias + '_1')
+        self.assertEqual(self.bulk_mock.call_args[1]['index'], index)
+        self.assertEqual(self.bulk_mock.call_args[1]['body'], [
+            {'index': {'_id': '1'}}, dict(MODEL_RECORD, id='1')])
+        indices.update_aliases.assert_called_with(body={'actions': [
+            {'remove': {'index': alias + '_1', 'alias': alias}},
+            {'add': {'index': index, 'alias': alias}}]})
+        indices.delete.assert_called_with(index=alias + '_1')
+
+    def test_former_unversioned_index_is_replaced_by_alias(self):
+        self.app.put_json('/models/test', MODEL_DEFINITION,
+                          headers=self.headers)
+        indices = self._mock_indices()
+        indices.exists.return_value = True
+        indices.exists_alias.return_value = False
+        self.app.put_json('/models/test/definition',
+                          MODEL_DEFINITION['definition'],
+                          headers=self.headers)
+        self.indexer.join()
+        alias = self.indexer.prefix('test')
+        indices.delete.assert_called_with(index=alias)
+        index = indices.create.call_args[1]['index']
+        indices.update_aliases.assert_called_with(body={'actions': [
+            {'add': {'index': index, 'alias': alias}}]})
+
+    @mock.patch('daybed.indexer.logger.error')
+    def test_reindex_is_aborted_if_index_cannot_be_created(self, error_mock):
+        indices = self._mock_indices()
+        indices.create.side_effect = indexer.ElasticsearchException
+        self.indexer.reindex('test', MODEL_DEFINITION['definition'],
+                             [dict(MODEL_RECORD, id='1')])
+        self.assertTrue(error_mock.called)
+        self.assertFalse(indices.put_mapping.called)
+        self.assertFalse(self.bulk_mock.called)
+        self.assertFalse(indices.update_aliases.called)
+
+    @mock.patch('elasticsearch.client.Elasticsearch.index')
+    def test_records_written_during_reindex_are_replayed(self, index_mock):
         self.app.put_json('/models/test', MODEL_DEFINITION,
                           headers=self.headers)
-        self.assertEqual(delete_mock.call_count, 0)
+        self.app.put_json('/models/test/records/1', MODEL_RECORD,
+                          headers=self.headers)
+        indices = self._mock_indices()
+        indices.exists.return_value = False
 
-    @mock.patch('elasticsearch.client.indices.IndicesClient.delete_mapping')
-    def test_existing_mapping_is_deleted_on_put(self, delete_mapping_mock):
+        def records():
+            yield dict(MODEL_RECORD, id='1')
+            # Written to the current index, while the new one is built.
+            self.app.put_json('/models/test/records/2', MODEL_RECORD,
+                              headers=self.headers)
+            self.app.delete('/models/test/records/1', headers=self.headers)
+
+        self.indexer.reindex('test', MODEL_DEFINITION['definition'],
+                             records())
+        index = indices.create.call_args[1]['index']
+        self.assertEqual(index_mock.call_args[1]['index'],
+                         self.indexer.prefix('test'))
+        replayed = self.bulk_mock.call_args[1]
+        self.assertEqual(replayed['index'], index)
+        self.assertIn({'delete': {'_id': '1'}}, replayed['body'])
+        self.assertIn({'index': {'_id': '2'}}, replayed['body'])
+        self.assertTrue(indices.update_aliases.called)
+
+    def test_rebuild_is_aborted_when_model_is_deleted(self):
         self.app.put_json('/models/test', MODEL_DEFINITION,
                           headers=self.headers)
+        indices = self._mock_indices()
+
+        def records():
+            self.app.delete('/models/test', headers=self.headers)
+            yield dict(MODEL_RECORD, id='1')
+
+        self.indexer.reindex('test', MODEL_DEFINITION['definition'],
+                             records())
+        index = indices.create.call_args[1]['index']
+        indices.delete.assert_called_with(index=index)
+        self.assertFalse(indices.update_aliases.called)
+
+    def test_former_rebuild_is_aborted_when_a_new_one_starts(self):
+        indices = self._mock_indices()
+        indices.exists.return_value = False
+
+        def records():
+            # The model is updated again meanwhile.
+            self.indexer.reindex('test', MODEL_DEFINITION['definition'], [])
+            yield dict(MODEL_RECORD, id='1')
+
+        self.indexer.reindex('test', MODEL_DEFINITION['definition'],
+                             records())
+        former, latest = [call[1]['index']
+                          for call in indices.create.call_args_list]
+        self.assertNotEqual(former, latest)
+        indices.update_aliases.assert_called_once_with(body={'actions': [
+            {'add': {'index': latest, 'alias': self.indexer.prefix('test')}}
+        ]})
+        indices.delete.assert_called_with(index=former)
+
+    @mock.patch('daybed.indexer.logger.error')
+    def test_new_index_is_deleted_if_records_cannot_be_read(self,
+                                                            error_mock):
+        indices = self._mock_indices()
+
+        def records():
+            raise backend_exceptions.ModelNotFound('test')
+            yield
+
+        self.indexer.reindex('test', MODEL_DEFINITION['definition'],
+                             records())
+        self.assertTrue(error_mock.called)
+        index = indices.create.call_args[1]['index']
+        indices.delete.assert_called_with(index=index)
+        self.assertFalse(indices.update_aliases.called)
+
+    def test_rebuild_is_aborted_when_all_records_are_deleted(self):
         self.app.put_json('/models/test', MODEL_DEFINITION,
                           headers=self.headers)
-        self.assertEqual(delete_mapping_mock.call_count, 1)
+        self.app.put_json('/models/test/records/1', MODEL_RECORD,
+                          headers=self.headers)
+        indices = self._mock_indices()
+        indices.exists.return_value = False
+
+        def records():
+            yield dict(MODEL_RECORD, id='1')
+            self.app.delete('/models/test/records', headers=self.headers)
+
+        self.indexer.reindex('test', MODEL_DEFINITION['definition'],
+                             records())
+        rebuilt, emptied = [call[1]['index']
+                            for call in indices.create.call_args_list]
+        indices.update_aliases.assert_called_once_with(body={'actions': [
+            {'add': {'index': emptied, 'alias': self.indexer.prefix('test')}}
+        ]})
+        indices.delete.assert_called_with(index=rebuilt)
+
+    @mock.patch('daybed.indexer.time.time', return_value=100)
+    def test_indices_of_rebuilds_have_distinct_names(self, time_mock):
+        indices = self._mock_indices()
+        self.indexer.reindex('test', MODEL_DEFINITION['definition'], [])
+        self.indexer.reindex('test', MODEL_DEFINITION['definition'], [])
+        first, second = [call[1]['index']
+                         for call in indices.create.call_args_list]
+        self.assertNotEqual(first, second)
 
     @mock.patch('elasticsearch.client.indices.IndicesClient.delete')
     def test_index_deleted_on_model_deletion(self, delete_index_mock):
@@ -144,6 +311,37 @@ class RecordsIndicesTest(BaseWebTest):
                             headers=self.headers)
         self.assertEqual(index_mock.call_count, 2)
 
+    @mock.patch('elasticsearch.client.Elasticsearch.index')
+    @mock.patch('elasticsearch.client.Elasticsearch.bulk')
+    def test_records_indexed_at_once_on_bulk_post(self, bulk_mock,
+                                                  index_mock):
+        bulk_mock.return_value = {'errors': False, 'items': []}
+        self.app.post_json('/models/test/bulk', [MODEL_RECORD] * 3,
+                           headers=self.headers)
+        self.assertFalse(index_mock.called)
+        self.assertEqual(bulk_mock.call_count, 1)
+        actions = bulk_mock.call_args[1]['body']
+        self.assertEqual(len(actions), 6)
+        self.assertEqual(actions[1], dict(MODEL_RECORD,
+                                          id=actions[0]['index']['_id']))
+
+    @mock.patch('elasticsearch.client.Elasticsearch.bulk')
+    def test_bulk_indexing_is_sent_by_batches(self, bulk_mock):
+        bulk_mock.return_value = {'errors': False, 'items': []}
+        self.indexer.bulk_size = 2
+        self.app.post_json('/models/test/bulk', [MODEL_RECORD] * 3,
+                           headers=self.headers)
+        self.assertEqual(bulk_mock.call_count, 2)
+
+    @mock.patch('daybed.indexer.logger.error')
+    @mock.patch('elasticsearch.client.Elasticsearch.bulk')
+    def test_bulk_indexing_errors_are_logged(self, bulk_mock, error_mock):
+        bulk_mock.return_value = {'errors': True, 'items': [
+            {'index': {'_id': 'a', 'error': 'MapperParsingException'}}]}
+        self.app.post_json('/models/test/bulk', [MODEL_RECORD],
+                           headers=self.headers)
+        self.assertTrue(error_mock.called)
+
     @mock.patch('elasticsearch.client.Elasticsearch.delete')
     def test_record_unindexed_on_delete(self, delete_mock):
         self.app.put_json('/models/test/records/1', MODEL_RECORD,
@@ -153,9 +351,50 @@ class RecordsIndicesTest(BaseWebTest):
         delete_mock.assert_called_with(
             index=self.app.app.registry.index.prefix('test'),
             doc_type='test',
-            id='1', refresh=True
+            id='1', refresh=False
         )
 
+    @mock.patch('elasticsearch.client.Elasticsearch.delete')
+    def test_index_is_replaced_when_all_records_are_deleted(self,
+                                                            delete_mock):
+        for record_id in ('1', '2'):
+            self.app.put_json('/models/test/records/%s' % record_id,
+                              MODEL_RECORD, headers=self.headers)
+        index = self.app.app.registry.index
+        with mock.patch.object(index, 'reindex') as reindex_mock:
+            self.app.delete('/models/test/records', headers=self.headers)
+        self.assertFalse(delete_mock.called)
+        reindex_mock.assert_called_once_with(
+            'test', MODEL_DEFINITION['definition'], [])
+
+    @mock.patch('elasticsearch.client.Elasticsearch.index')
+    def test_records_are_not_refreshed_by_default(self, index_mock):
+        self.app.put_json('/models/test/records/1', MODEL_RECORD,
+                          headers=self.headers)
+        self.assertEqual(index_mock.call_args[1]['refresh'], False)
+
+    @mock.patch('elasticsearch.client.Elasticsearch.index')
+    def test_refresh_policy_can_be_requested_by_header(self, index_mock):
+        headers = dict(self.headers, **{'Index-Refresh': 'wait_for'})
+        self.app.put_json('/models/test/records/1', MODEL_RECORD,
+                          headers=headers)
+        self.assertEqual(index_mock.call_args[1]['refresh'], 'wait_for')
+        headers['Index-Refresh'] = 'immediate'
+        self.app.put_json('/models/test/records/1', MODEL_RECORD,
+                          headers=headers)
+        self.assertEqual(index_mock.call_args[1]['refresh'], True)
+
+    @mock.patch('elasticsearch.client.Elasticsearch.index')
+    def test_unknown_refresh_policy_header_is_ignored(self, index_mock):
+        headers = dict(self.headers, **{'Index-Refresh': 'sometimes'})
+        self.app.put_json('/models/test/records/1', MODEL_RECORD,
+                          headers=headers)
+        self.assertEqual(index_mock.call_args[1]['refresh'], False)
+
+    def test_unknown_refresh_policy_setting_is_refused(self):
+        self.assertRaises(ValueError, indexer.ElasticSearchIndexer,
+                          ['localhost:9200'], 'daybed', refresh='sometimes')
+
     @mock.patch('daybed.indexer.logger.error')
     @mock.patch('elasticsearch.client.Elasticsearch.delete')
     def test_no_exception_on_record_deletion_when_index_fails(self,
@@ -241,6 +480,192 @@ ALL_FIELDS_DEFINITION = {
 }
 
 
+class IndexingQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = mock.MagicMock()
+        self.client.bulk.return_value = {'errors': False, 'items': []}
+
+    def _queue(self, **options):
+        options.setdefault('flush_interval', 0.01)
+        q = indexer.IndexingQueue(self.client, **options)
+        self.addCleanup(q.stop)
+        return q
+
+    def test_operations_are_sent_in_one_bulk_request(self):
+        q = self._queue(flush_interval=0.5)
+        q.put({'index': {'_id': 1}}, {'age': 1})
+        q.put({'delete': {'_id': 2}})
+        self.assertTrue(q.flush(timeout=5))
+        self.client.bulk.assert_called_once_with(body=[
+            {'index': {'_id': 1}}, {'age': 1}, {'delete': {'_id': 2}}])
+        self.assertEqual(q.stats()['sent'], 2)
+
+    def test_operations_are_sent_by_batches(self):
+        q = self._queue(batch_size=2, flush_interval=0.5)
+        for i in range(5):
+            q.put({'delete': {'_id': i}})
+        q.flush(timeout=5)
+        self.assertEqual(self.client.bulk.call_count, 3)
+
+    def test_operations_are_dropped_when_full_and_not_blocking(self):
+        q = self._queue(workers=0, max_size=1, block=False)
+        q.put({'delete': {'_id': 1}})
+        q.put({'delete': {'_id': 2}})
+        self.assertEqual(q.stats()['depth'], 1)
+        self.assertEqual(q.stats()['dropped'], 1)
+        self.assertFalse(q.flush(timeout=0.01))
+
+    @mock.patch('daybed.indexer.logger.error')
+    def test_failures_are_counted_and_logged(self, error_mock):
+        self.client.bulk.side_effect = indexer.ElasticsearchException
+        q = self._queue()
+        q.put({'delete': {'_id': 1}})
+        q.flush(timeout=5)
+        self.assertEqual(q.stats()['failed'], 1)
+        self.assertTrue(error_mock.called)
+
+    def _open_breaker(self):
+        breaker = indexer.CircuitBreaker(threshold=1, reset_timeout=60)
+        breaker.failure()
+        return breaker
+
+    @mock.patch('daybed.indexer.logger.error')
+    def test_writes_are_not_blocked_while_breaker_is_open(self, error_mock):
+        q = self._queue(workers=0, max_size=1, breaker=self._open_breaker())
+        q.put({'delete': {'_id': 1}})
+        q.put({'delete': {'_id': 2}})
+        self.assertEqual(q.stats()['dropped'], 1)
+
+    def test_pending_operations_of_an_index_can_be_discarded(self):
+        q = self._queue(workers=0)
+        q.put({'delete': {'_index': 'a', '_id': 1}})
+        q.put({'delete': {'_index': 'b', '_id': 1}})
+        q.discard('a')
+        self.assertEqual(q.stats()['depth'], 1)
+        self.assertEqual(q.stats()['discarded'], 1)
+
+    def test_operations_held_by_workers_can_be_discarded(self):
+        breaker = self._open_breaker()
+        q = self._queue(breaker=breaker)
+        q.put({'delete': {'_index': 'a', '_id': 1}})
+        while q.stats()['depth']:
+            time.sleep(0.01)
+        q.discard('a')
+        breaker.success()
+        self.assertTrue(q.flush(timeout=5))
+        self.assertFalse(self.client.bulk.called)
+        self.assertEqual(q.stats()['discarded'], 1)
+
+    @mock.patch('daybed.indexer.logger.error')
+    def test_only_operations_of_an_index_being_sent_are_waited_for(
+            self, error_mock):
+        sent = threading.Event()
+        sending = threading.Event()
+
+        def bulk(**kwargs):
+            sending.set()
+            sent.wait(5)
+            return {'items': []}
+        self.client.bulk.side_effect = bulk
+        q = self._queue()
+        q.put({'delete': {'_index': 'b', '_id': 1}})
+        sending.wait(5)
+        started = time.time()
+        self.assertTrue(q.wait('a'))
+        self.assertFalse(q.wait('b', timeout=0.05))
+        self.assertLess(time.time() - started, 1)
+        sent.set()
+        self.assertTrue(q.wait('b', timeout=5))
+
+    @mock.patch('daybed.indexer.logger.error')
+    def test_workers_survive_unexpected_errors(self, error_mock):
+        self.client.bulk.side_effect = [ValueError, {'items': []}]
+        q = self._queue()
+        q.put({'delete': {'_id': 1}})
+        self.assertTrue(q.flush(timeout=5))
+        q.put({'delete': {'_id': 2}})
+        self.assertTrue(q.flush(timeout=5))
+        self.assertEqual(q.stats()['failed'], 1)
+        self.assertEqual(q.stats()['sent'], 1)
+
+    @mock.patch('daybed.indexer.logger.error')
+    def test_flush_and_stop_are_bounded(self, error_mock):
+        self.client.bulk.side_effect = lambda **kw: time.sleep(0.5)
+        q = self._queue(timeout=0.05)
+        q.put({'delete': {'_id': 1}})
+        started = time.time()
+        self.assertFalse(q.flush())
+        q.stop()
+        self.assertLess(time.time() - started, 0.4)
+
+    def test_pending_operations_are_sent_on_stop(self):
+        q = self._queue(flush_interval=60)
+        q.put({'delete': {'_id': 1}})
+        q.stop()
+        self.assertEqual(self.client.bulk.call_count, 1)
+
+
+class AsyncRecordsIndicesTest(BaseWebTest):
+
+    def setUp(self):
+        super(AsyncRecordsIndicesTest, self).setUp()
+        self.indexer.queue = indexer.IndexingQueue(self.indexer.client,
+                                                   flush_interval=0.01)
+        self.addCleanup(self.indexer.queue.stop)
+        self.app.put_json('/models/test', MODEL_DEFINITION,
+                          headers=self.headers)
+
+    @mock.patch('elasticsearch.client.Elasticsearch.index')
+    @mock.patch('elasticsearch.client.Elasticsearch.bulk')
+    def test_records_are_indexed_in_background(self, bulk_mock, index_mock):
+        bulk_mock.return_value = {'errors': False, 'items': []}
+        self.app.put_json('/models/test/records/1', MODEL_RECORD,
+                          headers=self.headers)
+        self.app.delete('/models/test/records/1', headers=self.headers)
+        self.indexer.queue.flush(timeout=5)
+        self.assertFalse(index_mock.called)
+        actions = [line for call in bulk_mock.call_args_list
+                   for line in call[1]['body']]
+        index = self.indexer.prefix('test')
+        self.assertEqual(actions, [
+            {'index': {'_index': index, '_type': 'test', '_id': '1'}},
+            dict(MODEL_RECORD, id='1'),
+            {'delete': {'_index': index, '_type': 'test', '_id': '1'}}])
+
+    @mock.patch('daybed.indexer.logger.error')
+    def test_pending_operations_are_dropped_when_model_is_deleted(
+            self, error_mock):
+        self.indexer.queue.stop()
+        self.indexer.queue = indexer.IndexingQueue(
+            self.indexer.client, workers=0, breaker=self.indexer.breaker)
+        self.app.put_json('/models/test/records/1', MODEL_RECORD,
+                          headers=self.headers)
+        self.assertEqual(self.indexer.queue.stats()['depth'], 1)
+        self.app.delete('/models/test', headers=self.headers)
+        self.assertEqual(self.indexer.queue.stats()['depth'], 0)
+
+    def test_indexer_is_not_settled_while_operations_are_pending(self):
+        self.assertEqual(self.indexer.settle_delay,
+                         self.indexer.refresh_interval + 0.01)
+        self.assertTrue(self.indexer.settled())
+        self.indexer.queue.stop()
+        self.indexer.queue = indexer.IndexingQueue(self.indexer.client,
+                                                   workers=0)
+        self.app.put_json('/models/test/records/1', MODEL_RECORD,
+                          headers=self.headers)
+        self.assertFalse(self.indexer.settled())
+
+    @mock.patch('elasticsearch.client.Elasticsearch.index')
+    def test_records_are_indexed_during_request_if_refresh_asked(
+            self, index_mock):
+        headers = dict(self.headers, **{'Index-Refresh': 'wait_for'})
+        self.app.put_json('/models/test/records/1', MODEL_RECORD,
+                          headers=headers)
+        self.assertEqual(index_mock.call_args[1]['refresh'], 'wait_for')
+        self.assertEqual(self.indexer.queue.stats()['depth'], 0)
+
+
 class DefinitionMappingTest(BaseWebTest):
 
     def setUp(self):
@@ -358,8 +783,9 @@ class RecordMappingTest(BaseWebTest):
         self.assertFalse(error_mock.called)
 
     def test_indexed_record_is_kept_in_source(self):
+        headers = dict(self.headers, **{'Index-Refresh': 'immediate'})
         self.app.post_json('/models/test/records', self.record,
-                           headers=self.headers)
+                           headers=headers)
         response = self.app.get('/models/test/search/',
                                 headers=self.headers)
         result = response.json['hits']['hits'][0]['_source']
@@ -379,6 +805,123 @@ class RecordMappingTest(BaseWebTest):
                          {"type": "Polygon",
                           "coordinates": self.record['u']})
 
+    def test_points_are_converted_to_geo_points(self):
+        self.assertEqual(self.mapping['t'], {'lon': 0.0, 'lat': 1.0})
+
+    def test_record_transformer_is_compiled_once_per_definition(self):
+        with mock.patch('daybed.indexer.record_transformer',
+                        wraps=indexer.record_transformer) as compile_mock:
+            for i in range(2):
+                self.app.post_json('/models/test/records', self.record,
+                                   headers=self.headers)
+            self.assertFalse(compile_mock.called)
+            definition = copy.deepcopy(ALL_FIELDS_DEFINITION)
+            definition['definition']['title'] = 'changed'
+            self.app.put_json('/models/test', definition,
+                              headers=self.headers)
+            self.indexer.join()
+            self.app.post_json('/models/test/records', self.record,
+                               headers=self.headers)
+            self.assertEqual(compile_mock.call_count, 1)
+
+    def test_record_transformer_is_compiled_again_if_definition_differs(self):
+        definition = copy.deepcopy(ALL_FIELDS_DEFINITION['definition'])
+        transform = self.indexer._record_transformer('test', definition)
+        self.assertIs(self.indexer._record_transformer(
+            'test', copy.deepcopy(definition)), transform)
+        # Model updated on another node.
+        changed = copy.deepcopy(definition)
+        changed['fields'] = changed['fields'][:1]
+        self.assertIsNot(self.indexer._record_transformer('test', changed),
+                         transform)
+
+
+class RecordTransformerTest(unittest.TestCase):
+
+    def test_fields_of_groups_are_converted(self):
+        definition = {'fields': [
+            {'type': 'group', 'description': 'Location',
+             'fields': [{'name': 'where', 'type': 'point'}]}
+        ]}
+        transform = indexer.record_transformer(definition)
+        self.assertEqual(transform({'where': [1, 2]}),
+                         {'where': {'lon': 1, 'lat': 2}})
+
+    def test_records_are_not_modified(self):
+        definition = {'fields': [{'name': 'tags', 'type': 'list'}]}
+        record = {'tags': ['a']}
+        indexer.record_transformer(definition)(record)
+        self.assertEqual(record, {'tags': ['a']})
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.breaker = indexer.CircuitBreaker(threshold=2, reset_timeout=30)
+        patcher = mock.patch('daybed.indexer.time.time', return_value=100)
+        self.time_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_breaker_opens_after_consecutive_failures(self):
+        self.breaker.failure()
+        self.breaker.success()
+        self.breaker.failure()
+        self.assertTrue(self.breaker.allow())
+        self.breaker.failure()
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.breaker.retry_in(), 30)
+        self.assertEqual(self.breaker.stats()['rejected'], 1)
+
+    def test_a_single_call_probes_the_service_after_timeout(self):
+        self.breaker.failure()
+        self.breaker.failure()
+        self.time_mock.return_value = 130
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+        self.breaker.success()
+        self.assertTrue(self.breaker.closed)
+
+    def test_breaker_opens_again_if_probe_fails(self):
+        self.breaker.failure()
+        self.breaker.failure()
+        self.time_mock.return_value = 130
+        self.breaker.allow()
+        self.breaker.failure()
+        self.assertEqual(self.breaker.state, indexer.CircuitBreaker.OPEN)
+        self.assertEqual(self.breaker.retry_in(), 30)
+
+
+class BreakerTransportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.breaker = indexer.CircuitBreaker(threshold=1)
+        self.client = indexer.elasticsearch.Elasticsearch(
+            ['localhost:9200'], transport_class=indexer.BreakerTransport,
+            breaker=self.breaker, max_retries=0)
+
+    @mock.patch('elasticsearch.Transport.perform_request')
+    def test_connection_errors_open_the_breaker(self, request_mock):
+        request_mock.side_effect = indexer.ConnectionError('N/A', 'down', '')
+        self.assertRaises(indexer.ConnectionError, self.client.info)
+        self.assertRaises(indexer.CircuitOpenError, self.client.info)
+        self.assertEqual(request_mock.call_count, 1)
+
+    @mock.patch('elasticsearch.Transport.perform_request')
+    def test_client_errors_do_not_open_the_breaker(self, request_mock):
+        request_mock.side_effect = indexer.TransportError(404, 'missing')
+        self.assertRaises(indexer.TransportError, self.client.info)
+        self.assertTrue(self.breaker.closed)
+
+    def test_search_is_unavailable_while_open(self):
+        es = indexer.ElasticSearchIndexer(['localhost:9200'], 'daybed',
+                                          breaker=self.breaker)
+        self.breaker.failure()
+        try:
+            es.search('test', {}, {})
+            self.fail('SearchError not raised')
+        except indexer.SearchError as e:
+            self.assertEqual(e.status_code, 503)
+
 
 class SpatialSearchTest(BaseWebTest):
 
@@ -392,12 +935,14 @@ class SpatialSearchTest(BaseWebTest):
         }]
         self.app.put_json('/models/location', definition,
                           headers=self.headers)
+        # Records have to be searchable right away.
+        headers = dict(self.headers, **{'Index-Refresh': 'immediate'})
         self.app.put_json('/models/location/records/0', {'geom': [0, 0]},
-                          headers=self.headers)
+                          headers=headers)
         self.app.put_json('/models/location/records/1', {'geom': [1, 1]},
-                          headers=self.headers)
+                          headers=headers)
         self.app.put_json('/models/location/records/2', {'geom': [2, 2]},
-                          headers=self.headers)
+                          headers=headers)
 
     def spatialSearch(self, bbox):
         query = {'filter': {'geo_bounding_box': {'geom': bbox}}}
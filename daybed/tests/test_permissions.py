@@ -10,7 +10,10 @@ from daybed.backends import exceptions
 from daybed.permissions import (
     All, Any, DaybedAuthorizationPolicy,
     invert_permissions_matrix, dict_set2list, dict_list2set,
-    default_model_permissions, PERMISSIONS_SET, merge_permissions
+    default_model_permissions, PERMISSIONS_BITS, PERMISSIONS_SET,
+    merge_permissions,
+    permissions_mask, permissions_names, principals_masks,
+    VIEWS_PERMISSIONS_REQUIRED, VIEWS_PERMISSIONS_MATCHES
 )
 
 
@@ -56,6 +59,41 @@ class TestAnyAll(TestCase):
             .matches(['un', 'deux']))
 
 
+class TestCompiledPermissions(TestCase):
+
+    def test_nested(self):
+        matches = All([Any(['read_all_records', 'read_own_records']),
+                       'read_definition']).compile()
+        self.assertTrue(matches(permissions_mask(['read_own_records',
+                                                  'read_definition'])))
+        self.assertFalse(matches(permissions_mask(['read_own_records'])))
+        self.assertFalse(matches(permissions_mask(['read_definition'])))
+
+    def test_compiled_views_requirements_are_equivalent(self):
+        sets = [set(), PERMISSIONS_SET, set(['create_record']),
+                set(['read_own_records', 'read_definition']),
+                set(['create_record', 'update_own_records',
+                     'delete_all_records'])]
+        for view, required in VIEWS_PERMISSIONS_REQUIRED.items():
+            for permissions in sets:
+                self.assertEqual(
+                    VIEWS_PERMISSIONS_MATCHES[view](
+                        permissions_mask(permissions)),
+                    required.matches(permissions), view)
+
+    def test_masks_can_be_converted_back_to_names(self):
+        self.assertEqual(permissions_names(permissions_mask(PERMISSIONS_SET)),
+                         PERMISSIONS_SET)
+
+    def test_principals_masks(self):
+        masks = principals_masks({'read_definition': ['alexis', 'remy'],
+                                  'delete_model': ['remy'],
+                                  'unknown': ['alexis']})
+        self.assertEqual(masks, {
+            'alexis': permissions_mask(['read_definition']),
+            'remy': permissions_mask(['read_definition', 'delete_model'])})
+
+
 class TestPermissionTools(TestCase):
 
     def test_default_model_permissions(self):
@@ -165,6 +203,9 @@ class BasePolicyPermissionTest(TestCase):
         self.policy = DaybedAuthorizationPolicy()
         self.context = mock.MagicMock()
         self.context.db.get_model_permissions.return_value = {}
+        db = self.context.db
+        db.get_model_masks.side_effect = lambda model_id: principals_masks(
+            db.get_model_permissions(model_id))
 
     def permits(self, *args):
         return self.policy.permits(self.context, *args)
@@ -188,6 +229,14 @@ class PolicyPermissionTest(BasePolicyPermissionTest):
         }
         self.assertFalse(self.permits(['abc'], 'get_definition'))
 
+    def test_token_managers_are_allowed_to_create_tokens(self):
+        policy = DaybedAuthorizationPolicy(token_creators=[],
+                                           token_managers=['abc'])
+        self.context.model_id = None
+        self.context.record_id = None
+        self.assertTrue(policy.permits(self.context, ['abc'], 'post_token'))
+        self.assertFalse(policy.permits(self.context, ['xyz'], 'post_token'))
+
     def test_not_allowed_if_not_author_of_record(self):
         self.context.db.get_model_permissions.return_value = {
             'read_own_records': ['abc']
@@ -195,6 +244,14 @@ class PolicyPermissionTest(BasePolicyPermissionTest):
         self.context.db.get_record_authors.return_value = ['xyz']
         self.assertFalse(self.permits(['abc'], 'get_record'))
 
+    def test_compiled_masks_of_the_model_are_used(self):
+        self.context.db.get_model_masks.side_effect = None
+        self.context.db.get_model_masks.return_value = {
+            'abc': PERMISSIONS_BITS['read_definition']
+        }
+        self.assertTrue(self.permits(['abc'], 'get_definition'))
+        self.assertFalse(self.context.db.get_model_permissions.called)
+
 
 class UnknownModelPolicyPermissionTest(BasePolicyPermissionTest):
 
@@ -3,7 +3,7 @@ import json
 import mock
 from pyramid import testing
 
-from daybed.renderers import GeoJSON
+from daybed.renderers import GeoJSON, StreamingJSONP
 from .support import BaseWebTest, force_unicode
 from .test_views import MODEL_DEFINITION, MODEL_RECORD, MODEL_RECORD2
 
@@ -145,6 +145,12 @@ class GeoJSONRendererTest(BaseWebTest):
                 'properties': {}}
             ]})
 
+    def test_geojson_renderer_does_not_modify_records(self):
+        record = {'id': 'abc', 'location': [0, 0], 'name': 'home'}
+        self._rendered({'records': [record]})
+        self.assertDictEqual(record, {'id': 'abc', 'location': [0, 0],
+                                      'name': 'home'})
+
     def test_geojson_renderer_serves_with_official_mimetype(self):
         request = self._build_request()
         response = mock.MagicMock()
@@ -162,3 +168,52 @@ class GeoJSONRendererTest(BaseWebTest):
         self._rendered({'records': []}, request)
         self.assertEqual(request.response.content_type,
                          'application/octet-stream')
+
+    def test_geojson_renderer_streams_records_iterators(self):
+        request = self._build_request()
+        records = iter([{'location': [0, 0]}, {'location': [1, 1]}])
+        self.assertIsNone(self._rendered({'records': records}, request))
+        geojson = b''.join(request.response.app_iter).decode('utf-8')
+        features = json.loads(geojson)['features']
+        self.assertEqual([f['geometry']['coordinates'] for f in features],
+                         [[0, 0], [1, 1]])
+
+
+class StreamingJSONPRendererTest(BaseWebTest):
+
+    def setUp(self):
+        super(StreamingJSONPRendererTest, self).setUp()
+        self.renderer = StreamingJSONP()(None)
+        self.request = testing.DummyRequest()
+
+    def _streamed(self, data):
+        self.assertIsNone(self.renderer(data, {'request': self.request}))
+        return b''.join(self.request.response.app_iter).decode('utf-8')
+
+    def test_iterators_are_streamed_as_arrays(self):
+        records = (r for r in [{'age': 1}, {'age': 2}])
+        body = self._streamed({'records': records, 'other': [1]})
+        self.assertDictEqual(json.loads(body), {'records': [{'age': 1},
+                                                            {'age': 2}],
+                                                'other': [1]})
+
+    def test_empty_iterators_are_streamed_as_empty_arrays(self):
+        body = self._streamed({'records': iter([])})
+        self.assertDictEqual(json.loads(body), {'records': []})
+
+    def test_streamed_response_is_chunked(self):
+        records = ({'name': 'x' * 100} for i in range(2000))
+        self.renderer(dict(records=records), {'request': self.request})
+        chunks = list(self.request.response.app_iter)
+        self.assertTrue(len(chunks) > 1)
+
+    def test_streamed_response_supports_jsonp(self):
+        self.request.GET['callback'] = 'func'
+        body = self._streamed({'records': iter([{'age': 1}])})
+        self.assertTrue(body.startswith('/**/func('))
+        self.assertEqual(self.request.response.content_type,
+                         'application/javascript')
+
+    def test_mappings_without_iterators_are_not_streamed(self):
+        body = self.renderer({'records': [1]}, {'request': self.request})
+        self.assertDictEqual(json.loads(body), {'records': [1]})
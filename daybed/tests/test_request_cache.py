@@ -0,0 +1,121 @@
+import mock
+
+from daybed.backends.exceptions import ModelNotFound, RecordNotFound
+from daybed.backends.id_generators import UUID4Generator
+from daybed.backends.memory import MemoryBackend
+from daybed.backends.request_cache import RequestCache
+from daybed.cache import PermissionsCache
+
+from .support import BaseWebTest, unittest
+from .test_views import MODEL_DEFINITION, MODEL_RECORD
+
+
+class RequestCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = MemoryBackend(UUID4Generator(None))
+        self.backend.put_model({'fields': []}, {'read_definition': ['Remy']},
+                               'modelname')
+        self.backend.put_record('modelname', {'age': 7}, ['Remy'], 'record')
+        self.db = RequestCache(self.backend)
+
+    def test_model_is_read_once(self):
+        with mock.patch.object(self.backend, 'get_model_definition',
+                               wraps=self.backend.get_model_definition) as m:
+            self.db.get_model_definition('modelname')
+            self.db.get_model_definition('modelname')
+        self.assertEqual(m.call_count, 1)
+        self.assertEqual(self.db.avoided_reads, 1)
+
+    def test_record_is_read_once(self):
+        with mock.patch.object(self.backend, 'get_record',
+                               wraps=self.backend.get_record) as m:
+            self.db.get_record('modelname', 'record')
+            self.db.get_record('modelname', 'record')
+        self.assertEqual(m.call_count, 1)
+
+    def test_unknown_objects_are_remembered(self):
+        with mock.patch.object(self.backend, 'get_model_permissions',
+                               wraps=self.backend.get_model_permissions) as m:
+            for i in range(2):
+                self.assertRaises(ModelNotFound,
+                                  self.db.get_model_permissions, 'unknown')
+        self.assertEqual(m.call_count, 1)
+
+    def test_record_writes_invalidate_reads(self):
+        self.db.get_record('modelname', 'record')
+        self.db.get_record_authors('modelname', 'record')
+        self.db.put_record('modelname', {'age': 8}, ['Alexis'], 'record')
+        self.assertEqual(self.db.get_record('modelname', 'record')['age'], 8)
+        self.assertEqual(
+            sorted(self.db.get_record_authors('modelname', 'record')),
+            ['Alexis', 'Remy'])
+        self.db.delete_record('modelname', 'record')
+        self.assertRaises(RecordNotFound,
+                          self.db.get_record, 'modelname', 'record')
+
+    def test_model_writes_invalidate_reads(self):
+        self.db.get_model_definition('modelname')
+        self.db.get_record('modelname', 'record')
+        self.db.put_model({'fields': [{'name': 'a', 'type': 'int'}]},
+                          {'read_definition': ['Remy']}, 'modelname')
+        definition = self.db.get_model_definition('modelname')
+        self.assertEqual(len(definition['fields']), 1)
+        self.db.delete_model('modelname')
+        self.assertRaises(ModelNotFound,
+                          self.db.get_model_definition, 'modelname')
+        self.assertRaises(RecordNotFound,
+                          self.db.get_record, 'modelname', 'record')
+
+    def test_permissions_can_be_kept_between_requests(self):
+        permissions = PermissionsCache(size=10)
+        with mock.patch.object(self.backend, 'get_model_permissions',
+                               wraps=self.backend.get_model_permissions) as m:
+            RequestCache(self.backend, permissions).get_model_permissions(
+                'modelname')
+            db = RequestCache(self.backend, permissions)
+            db.get_model_permissions('modelname')
+            self.assertEqual(m.call_count, 1)
+            db.put_model({'fields': []}, {'read_definition': ['Alexis']},
+                         'modelname')
+            db = RequestCache(self.backend, permissions)
+            self.assertEqual(db.get_model_permissions('modelname'),
+                             {'read_definition': ['Alexis']})
+            db.delete_model('modelname')
+            self.assertRaises(ModelNotFound,
+                              RequestCache(self.backend, permissions)
+                              .get_model_permissions, 'modelname')
+
+    def test_masks_are_read_once_and_kept_between_requests(self):
+        permissions = PermissionsCache(size=10)
+        with mock.patch.object(self.backend, 'get_model_permissions',
+                               wraps=self.backend.get_model_permissions) as m:
+            self.assertEqual(self.db.get_model_masks('modelname'),
+                             self.db.get_model_masks('modelname'))
+            self.assertEqual(m.call_count, 1)
+            RequestCache(self.backend, permissions).get_model_masks(
+                'modelname')
+            db = RequestCache(self.backend, permissions)
+            db.get_model_masks('modelname')
+            self.assertEqual(m.call_count, 2)
+            db.delete_model('modelname')
+            self.assertRaises(ModelNotFound,
+                              RequestCache(self.backend, permissions)
+                              .get_model_masks, 'modelname')
+
+    def test_other_methods_are_passed_through(self):
+        self.assertEqual(len(self.db.get_models(['Remy'])), 1)
+
+
+class RequestCacheViewsTest(BaseWebTest):
+
+    def test_record_update_reads_model_once(self):
+        self.app.put_json('/models/test', MODEL_DEFINITION,
+                          headers=self.headers)
+        self.app.put_json('/models/test/records/1', MODEL_RECORD,
+                          headers=self.headers)
+        with mock.patch.object(self.db, 'get_model_definition',
+                               wraps=self.db.get_model_definition) as m:
+            self.app.put_json('/models/test/records/1', MODEL_RECORD,
+                              headers=self.headers)
+        self.assertEqual(m.call_count, 1)
@@ -1,6 +1,7 @@
 import datetime
 
 import colander
+import mock
 
 from daybed import schemas
 from daybed.tests.support import unittest
@@ -226,6 +227,18 @@ class DateFieldTests(unittest.TestCase):
         defaulted = validator.deserialize('')
         self.assertTrue((datetime.datetime.now() - defaulted).seconds < 1)
 
+    def test_datetime_autonow_is_evaluated_on_each_deserialization(self):
+        schema = schemas.DateTimeField.definition()
+        definition = schema.deserialize(
+            {'name': 'branch',
+             'type': 'datetime',
+             'autonow': True})
+        validator = schemas.DateTimeField.validation(**definition)
+        later = datetime.datetime(2042, 1, 1)
+        with mock.patch('daybed.schemas.base.datetime') as datetime_mock:
+            datetime_mock.datetime.now.return_value = later
+            self.assertEqual(validator.deserialize(None), later)
+
     def test_datetime_optional_autonow(self):
         schema = schemas.DateTimeField.definition()
         definition = schema.deserialize(
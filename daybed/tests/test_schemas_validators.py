@@ -4,6 +4,7 @@ from cornice.errors import Errors
 from pyramid.testing import DummyRequest
 
 from daybed import schemas
+from daybed.cache import LRUCache
 from daybed.schemas import validators
 from daybed.tests.support import unittest, BaseWebTest
 
@@ -46,6 +47,38 @@ class ValidatorTests(unittest.TestCase):
         self.assertIsNone(self.request.data_clean['records'][0].get('name'))
 
 
+class RecordSchemaCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.request = DummyRequest()
+        self.request.registry = mock.Mock()
+        self.request.registry.record_schemas = LRUCache(size=10)
+        self.definition = {'fields': [{'name': 'age', 'type': 'int'}]}
+
+    def test_schema_is_built_once_per_definition(self):
+        schema = validators.get_record_schema(self.request, 'test',
+                                              self.definition)
+        self.assertTrue(isinstance(schema, validators.RecordSchema))
+        cached = validators.get_record_schema(self.request, 'test',
+                                              dict(self.definition))
+        self.assertIs(schema, cached)
+        self.assertEqual(self.request.registry.record_schemas.hits, 1)
+
+    def test_schema_is_rebuilt_if_definition_changed(self):
+        schema = validators.get_record_schema(self.request, 'test',
+                                              self.definition)
+        self.definition['fields'].append({'name': 'name', 'type': 'string'})
+        updated = validators.get_record_schema(self.request, 'test',
+                                               self.definition)
+        self.assertIsNot(schema, updated)
+        self.assertEqual(len(updated.children), 2)
+
+    def test_schemas_are_dropped_on_model_events(self):
+        validators.get_record_schema(self.request, 'test', self.definition)
+        event = mock.Mock(request=self.request)
+        validators.invalidate_record_schemas(event)
+        self.assertEqual(len(self.request.registry.record_schemas), 0)
+
+
 class DefinitionSchemaTest(unittest.TestCase):
     def setUp(self):
         self.schema = schemas.TypeField.definition()
@@ -162,9 +195,10 @@ class DefinitionSchemaTest(unittest.TestCase):
         self.assertNotIn("extra", definition)
 
 
-class ModelSchemaTest(unittest.TestCase):
+class ModelSchemaTest(BaseWebTest):
 
     def setUp(self):
+        super(ModelSchemaTest, self).setUp()
         self.schema = validators.ModelSchema()
         self.definition = {
             'title': u'Flavors',
@@ -0,0 +1,70 @@
+import mock
+
+from daybed.backends.id_generators import UUID4Generator
+from daybed.backends.memory import MemoryBackend
+from daybed.scripts import migrate, reindex
+
+from .support import unittest
+
+
+class ReindexScriptTest(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = MemoryBackend(UUID4Generator(None))
+        self.definition = {'fields': [{'name': 'age', 'type': 'int'}]}
+        for model_id in ('a', 'b'):
+            self.backend.put_model(self.definition, {}, model_id)
+            self.backend.put_record(model_id, {'age': 7}, ['Remy'], 'rec')
+        self.index = mock.MagicMock()
+
+    def _reindexed(self):
+        reindexed = {}
+        for call in self.index.reindex.call_args_list:
+            model_id, definition, records = call[0]
+            reindexed[model_id] = list(records)
+        return reindexed
+
+    def test_all_models_are_reindexed_by_default(self):
+        reindex.reindex(self.backend, self.index)
+        self.assertEqual(self._reindexed(), {'a': [{'age': 7, 'id': 'rec'}],
+                                             'b': [{'age': 7, 'id': 'rec'}]})
+
+    def test_only_specified_models_are_reindexed(self):
+        reindex.reindex(self.backend, self.index, ['b', 'unknown'])
+        self.assertEqual(list(self._reindexed().keys()), ['b'])
+
+    @mock.patch('daybed.scripts.reindex.setup_logging')
+    @mock.patch('daybed.scripts.reindex.bootstrap')
+    def test_main_uses_application_configuration(self, bootstrap_mock,
+                                                 logging_mock):
+        registry = mock.MagicMock(backend=self.backend, index=self.index)
+        closer = mock.MagicMock()
+        bootstrap_mock.return_value = {'registry': registry, 'closer': closer}
+        reindex.main(['daybed-reindex', 'conf/tests.ini', 'a'])
+        bootstrap_mock.assert_called_with('conf/tests.ini')
+        self.assertEqual(list(self._reindexed().keys()), ['a'])
+        self.assertTrue(closer.called)
+
+    def test_main_requires_configuration_file(self):
+        self.assertRaises(SystemExit, reindex.main, ['daybed-reindex'])
+
+
+class MigrateScriptTest(unittest.TestCase):
+
+    def test_backends_are_migrated_if_needed(self):
+        backend = mock.MagicMock()
+        migrate.migrate(backend)
+        self.assertTrue(backend.migrate.called)
+        # Does not fail.
+        migrate.migrate(MemoryBackend(UUID4Generator(None)))
+
+    @mock.patch('daybed.scripts.migrate.setup_logging')
+    @mock.patch('daybed.scripts.migrate.bootstrap')
+    def test_main_uses_application_configuration(self, bootstrap_mock,
+                                                 logging_mock):
+        registry = mock.MagicMock()
+        bootstrap_mock.return_value = {'registry': registry,
+                                       'closer': mock.MagicMock()}
+        migrate.main(['daybed-migrate', 'conf/tests.ini'])
+        bootstrap_mock.assert_called_with('conf/tests.ini')
+        self.assertTrue(registry.backend.migrate.called)
@@ -0,0 +1,136 @@
+import mock
+
+from daybed import events
+from daybed.indexer import NullIndexer, SearchError
+from daybed.indexer.sqlite import SQLiteIndexer
+
+from .support import unittest
+
+
+DEFINITION = {
+    'title': 'movies',
+    'description': 'Movies',
+    'fields': [
+        {'name': 'title', 'type': 'string'},
+        {'name': 'year', 'type': 'int'},
+        {'name': 'genres', 'type': 'list', 'item': {'type': 'string'}},
+        {'type': 'group', 'description': 'Credits',
+         'fields': [{'name': 'director', 'type': 'text'}]},
+    ]
+}
+
+MOVIES = [
+    {'id': '1', 'title': 'The Big Lebowski', 'year': 1998,
+     'genres': ['comedy'], 'director': 'Joel Coen'},
+    {'id': '2', 'title': 'The Big Sleep', 'year': 1946,
+     'genres': ['noir'], 'director': 'Howard Hawks'},
+    {'id': '3', 'title': 'Fargo', 'year': 1996,
+     'genres': ['comedy', 'noir'], 'director': 'Joel Coen'},
+]
+
+
+class SQLiteIndexerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.indexer = SQLiteIndexer()
+        self.request = mock.MagicMock()
+        self.request.db.iter_records_with_authors.return_value = [
+            {'record': movie, 'authors': []} for movie in MOVIES
+        ]
+        self.indexer.on_model_created(events.ModelCreated(
+            'movies', self.request, definition=DEFINITION))
+        self.indexer.on_records_created(events.RecordsCreated(
+            'movies', MOVIES, self.request, definition=DEFINITION))
+
+    def _search(self, query=None, **params):
+        result = self.indexer.search('movies', query or {}, params)
+        return [hit['_id'] for hit in result['hits']['hits']]
+
+    def test_all_records_are_returned_by_default(self):
+        result = self.indexer.search('movies', '', {})
+        self.assertEqual(result['hits']['total'], 3)
+        self.assertEqual(result['hits']['hits'][0]['_source'], MOVIES[0])
+
+    def test_match_searches_words_of_text_fields(self):
+        query = {'query': {'match': {'title': 'big fargo'}}}
+        self.assertEqual(self._search(query), ['1', '2', '3'])
+        query = {'query': {'match': {'title': {'query': 'big sleep',
+                                               'operator': 'and'}}}}
+        self.assertEqual(self._search(query), ['2'])
+
+    def test_match_searches_fields_of_groups_and_all_fields(self):
+        query = {'query': {'match': {'director': 'coen'}}}
+        self.assertEqual(self._search(query), ['1', '3'])
+        query = {'query': {'match': {'_all': 'hawks'}}}
+        self.assertEqual(self._search(query), ['2'])
+
+    def test_term_matches_values_and_list_items(self):
+        self.assertEqual(self._search({'query': {'term': {'year': 1946}}}),
+                         ['2'])
+        query = {'query': {'term': {'genres': 'noir'}}}
+        self.assertEqual(self._search(query), ['2', '3'])
+
+    def test_range_and_bool_queries(self):
+        query = {'query': {'bool': {
+            'must': {'range': {'year': {'gte': 1990}}},
+            'must_not': [{'match': {'title': 'fargo'}}]}}}
+        self.assertEqual(self._search(query), ['1'])
+        query = {'query': {'bool': {'should': [{'term': {'year': 1946}},
+                                               {'term': {'year': 1996}}]}}}
+        self.assertEqual(self._search(query), ['2', '3'])
+
+    def test_results_can_be_sorted_and_paginated(self):
+        query = {'sort': [{'year': {'order': 'desc'}}], 'size': 2}
+        self.assertEqual(self._search(query), ['1', '3'])
+        self.assertEqual(self._search(sort='year:asc', size='1', **{
+            'from': '1'}), ['3'])
+
+    def test_scan_returns_all_hits_by_pages(self):
+        self.indexer.scroll_size = 2
+        with mock.patch.object(self.indexer, 'search',
+                               wraps=self.indexer.search) as search_mock:
+            hits = self.indexer.scan('movies', {'size': 1}, {})
+            self.assertEqual([hit['_id'] for hit in hits], ['1', '2', '3'])
+        self.assertEqual(search_mock.call_count, 2)
+
+    def test_records_events_update_the_index(self):
+        record = dict(MOVIES[2], title='Raising Arizona')
+        self.indexer.on_record_updated(events.RecordUpdated(
+            'movies', '3', self.request, record=record,
+            definition=DEFINITION))
+        query = {'query': {'match': {'title': 'arizona'}}}
+        self.assertEqual(self._search(query), ['3'])
+        self.indexer.on_record_deleted(events.RecordDeleted(
+            'movies', '3', self.request, record=record))
+        self.assertEqual(self._search(query), [])
+
+    def test_all_records_can_be_deleted_at_once(self):
+        self.indexer.on_all_records_deleted(events.AllRecordsDeleted(
+            'movies', MOVIES, self.request, definition=DEFINITION))
+        self.assertEqual(self._search(), [])
+        self.assertEqual(self.indexer.status()['documents'], 0)
+
+    def test_model_update_rebuilds_the_index(self):
+        self.request.db.iter_records_with_authors.return_value = [
+            {'record': MOVIES[0], 'authors': []}]
+        self.indexer.on_model_updated(events.ModelUpdated(
+            'movies', self.request, definition=DEFINITION))
+        self.assertEqual(self._search(), ['1'])
+
+    def test_deleted_model_has_no_results(self):
+        self.indexer.on_model_deleted(events.ModelDeleted(
+            'movies', self.request, definition=DEFINITION))
+        self.assertEqual(self._search(), [])
+
+    def test_invalid_queries_are_refused(self):
+        for query in ('{"query":', {'query': {'fuzzy': {'title': 'x'}}},
+                      {'query': {'match': 'x'}}, {'size': 'ten'},
+                      {'size': -1}):
+            self.assertRaises(SearchError, self.indexer.search,
+                              'movies', query, {})
+
+
+class NullIndexerTest(unittest.TestCase):
+
+    def test_search_is_disabled(self):
+        self.assertRaises(SearchError, NullIndexer().search, 'movies', {}, {})
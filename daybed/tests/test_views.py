@@ -1,11 +1,15 @@
 import copy
 import base64
+import json
 
+import hawkauthlib
 import mock
+from pyramid.interfaces import IAuthenticationPolicy
 from webtest.app import TestRequest
 import elasticsearch
 
-from daybed import __version__ as VERSION, API_VERSION
+from daybed import __version__ as VERSION, API_VERSION, events
+from daybed.cache import SearchCache
 from daybed.permissions import invert_permissions_matrix
 from daybed.backends.exceptions import (
     RecordNotFound, ModelNotFound
@@ -123,6 +127,15 @@ class HelloViewTest(BaseWebTest):
             self.app.RequestClass = original_request_class
 
 
+class StatusViewTest(BaseWebTest):
+
+    def test_returns_indexer_and_caches_status(self):
+        response = self.app.get('/status')
+        status = response.json
+        self.assertEqual(status['indexer']['breaker']['state'], 'closed')
+        self.assertIn('hits', status['caches']['record_schemas'])
+
+
 class BasicAuthRegistrationTest(BaseWebTest):
     model_id = 'simple'
 
@@ -471,6 +484,19 @@ class RecordsViewsTest(BaseWebTest):
         self.assertIn("id", resp.json["records"][0])
         self.assertEqual(resp.json["records"][0]["age"], 42)
 
+    def test_only_records_listing_supports_jsonp(self):
+        self.app.put_json('/models/test', MODEL_DEFINITION,
+                          headers=self.headers)
+        resp = self.app.post_json('/models/test/records?callback=func',
+                                  MODEL_RECORD, headers=self.headers)
+        self.assertEqual(resp.content_type, 'application/json')
+        resp = self.app.get('/models/test/records?callback=func',
+                            headers=self.headers)
+        self.assertTrue(resp.text.startswith('/**/func('))
+        resp = self.app.delete('/models/test/records?callback=func',
+                               headers=self.headers)
+        self.assertEqual(resp.content_type, 'application/json')
+
     def test_delete_unknown_model_records(self):
         resp = self.app.delete('/models/unknown/records', {},
                                headers=self.headers,
@@ -551,6 +577,95 @@ class RecordsViewsTest(BaseWebTest):
         resp = self.app.get('/models/test/records')
         self.assertEqual(len(resp.json["records"]), 1)
 
+    def test_get_model_records_paginated(self):
+        self.app.put_json('/models/test', MODEL_DEFINITION,
+                          headers=self.headers)
+        for i in range(3):
+            self.app.post_json('/models/test/records', MODEL_RECORD,
+                               headers=self.headers)
+
+        resp = self.app.get('/models/test/records', {'limit': 2},
+                            headers=self.headers)
+        self.assertEqual(len(resp.json["records"]), 2)
+        next_url, rel = resp.headers['Link'].split('; ')
+        self.assertEqual(rel, 'rel="next"')
+        next_url = next_url.strip('<>').replace(
+            'http://localhost/%s' % API_VERSION, '')
+
+        resp = self.app.get(next_url, headers=self.headers)
+        self.assertEqual(len(resp.json["records"]), 1)
+        self.assertNotIn('Link', resp.headers)
+
+    def test_own_records_are_paginated_from_authors_index(self):
+        self.db.store_credentials('foo', {'id': 'alexis', 'key': 'bar'})
+        auth = base64.b64encode(u'alexis:bar'.encode('ascii'))
+        headers = {'Authorization': 'Basic %s' % auth.decode('ascii')}
+        self.app.put_json('/models/test', MODEL_DEFINITION,
+                          headers=self.headers)
+        self.app.patch_json('/models/test/permissions',
+                            {"alexis": ["create_record", "read_own_records"]},
+                            headers=self.headers)
+        self.app.post_json('/models/test/records', MODEL_RECORD,
+                           headers=self.headers)
+        for i in range(3):
+            self.app.post_json('/models/test/records', MODEL_RECORD2,
+                               headers=headers)
+
+        with mock.patch.object(self.db, 'get_records_page') as page_mock:
+            resp = self.app.get('/models/test/records', {'limit': 2},
+                                headers=headers)
+        self.assertFalse(page_mock.called)
+        self.assertEqual(len(resp.json["records"]), 2)
+        next_url = resp.headers['Link'].split('; ')[0].strip('<>').replace(
+            'http://localhost/%s' % API_VERSION, '')
+        resp = self.app.get(next_url, headers=headers)
+        self.assertEqual(len(resp.json["records"]), 1)
+        self.assertNotIn('Link', resp.headers)
+
+    def test_get_model_records_rejects_invalid_pagination(self):
+        self.app.put_json('/models/test', MODEL_DEFINITION,
+                          headers=self.headers)
+        self.app.get('/models/test/records', {'limit': 'abc'},
+                     headers=self.headers, status=400)
+        self.app.get('/models/test/records', {'limit': 0},
+                     headers=self.headers, status=400)
+        self.app.get('/models/test/records', {'limit': 2, 'cursor': '@'},
+                     headers=self.headers, status=400)
+
+    def test_bulk_records_creation(self):
+        self.app.put_json('/models/test', MODEL_DEFINITION,
+                          headers=self.headers)
+        resp = self.app.post_json('/models/test/bulk',
+                                  [MODEL_RECORD, {'age': 'abc'},
+                                   MODEL_RECORD2],
+                                  headers=self.headers)
+        statuses = resp.json['records']
+        self.assertEqual([s['status'] for s in statuses], [201, 400, 201])
+        self.assertIn('age', statuses[1]['errors'])
+        self.assertEqual(self.db.get_record('test', statuses[0]['id'])['age'],
+                         42)
+        self.assertEqual(self.db.get_record('test', statuses[2]['id'])['age'],
+                         25)
+
+    def test_bulk_records_creation_accepts_ndjson(self):
+        self.app.put_json('/models/test', MODEL_DEFINITION,
+                          headers=self.headers)
+        headers = dict(self.headers,
+                       **{'Content-Type': 'application/x-ndjson'})
+        resp = self.app.post('/models/test/bulk',
+                             '{"age": 42}\n{"age": 25}\n',
+                             headers=headers)
+        self.assertEqual(len(resp.json['records']), 2)
+        self.assertEqual(len(self.db.get_records('test')), 2)
+
+    def test_bulk_records_creation_rejects_invalid_body(self):
+        self.app.put_json('/models/test', MODEL_DEFINITION,
+                          headers=self.headers)
+        self.app.post_json('/models/test/bulk', MODEL_RECORD,
+                           headers=self.headers, status=400)
+        self.app.post('/models/test/bulk', '[{"age": 4',
+                      headers=self.headers, status=400)
+
     def test_unknown_record_returns_404(self):
         self.app.put_json('/models/test', MODEL_DEFINITION,
                           headers=self.headers)
@@ -661,6 +776,31 @@ class TokenViewTest(BaseWebTest):
         self.assertDictEqual(response.json['credentials'],
                              self.credentials)
 
+    def test_credentials_key_is_not_read_on_every_request(self):
+        with mock.patch.object(self.db, 'get_credentials_key',
+                               wraps=self.db.get_credentials_key) as get_key:
+            self.app.get('/token', headers=self.headers)
+            self.app.get('/token', headers=self.headers)
+        self.assertEqual(get_key.call_count, 1)
+
+    def test_hawk_nonces_are_remembered(self):
+        request = TestRequest.blank('/%s/token' % API_VERSION)
+        hawkauthlib.sign_request(request, self.credentials['id'],
+                                 self.credentials['key'])
+        headers = {'Authorization': request.headers['Authorization']}
+        response = self.app.get('/token', headers=headers)
+        self.assertDictEqual(response.json['credentials'], self.credentials)
+        policy = self.app.app.registry.getUtility(IAuthenticationPolicy)
+        hawk_policy = policy._policies[1]
+        self.assertEqual(len(hawk_policy.nonce_cache), 1)
+
+    def test_created_credentials_are_forgotten_by_the_cache(self):
+        cache = self.app.app.registry.credentials_cache
+        with mock.patch.object(cache, 'invalidate') as invalidate_mock:
+            response = self.app.post('/tokens', status=201)
+        invalidate_mock.assert_called_with(
+            response.json['credentials']['id'])
+
 
 class SearchViewTest(BaseWebTest):
 
@@ -718,6 +858,78 @@ class SearchViewTest(BaseWebTest):
                             status=400)
         self.assertEqual(resp.json['msg']['foo'], 'bar')
 
+    @mock.patch('elasticsearch.client.Elasticsearch.search')
+    def test_search_results_are_cached_until_records_change(self,
+                                                            search_mock):
+        search_mock.return_value = {'hits': {'hits': []}}
+        registry = self.app.app.registry
+        registry.search_cache = SearchCache(10)
+        registry.registerHandler(registry.search_cache.on_model_changed,
+                                 (events.RecordCreated,))
+        for i in range(2):
+            self.app.post('/models/test/search/?size=1', '{"query": {}}',
+                          headers=self.headers)
+        self.assertEqual(search_mock.call_count, 1)
+        self.app.post_json('/models/test/records', MODEL_RECORD,
+                           headers=self.headers)
+        self.app.post('/models/test/search/?size=1', '{"query": {}}',
+                      headers=self.headers)
+        self.assertEqual(search_mock.call_count, 2)
+
+    @mock.patch('elasticsearch.client.Elasticsearch.search')
+    def test_search_results_are_not_cached_while_writes_are_pending(
+            self, search_mock):
+        search_mock.return_value = {'hits': {'hits': []}}
+        self.app.app.registry.search_cache = SearchCache(10)
+        with mock.patch.object(self.indexer, 'settled', return_value=False):
+            for i in range(2):
+                self.app.post('/models/test/search/', '{"query": {}}',
+                              headers=self.headers)
+        self.assertEqual(search_mock.call_count, 2)
+
+    @mock.patch('elasticsearch.client.Elasticsearch.clear_scroll')
+    @mock.patch('elasticsearch.client.Elasticsearch.scroll')
+    @mock.patch('elasticsearch.client.Elasticsearch.search')
+    def test_search_results_can_be_exported_as_ndjson(self, search_mock,
+                                                      scroll_mock,
+                                                      clear_mock):
+        search_mock.return_value = {'_scroll_id': 'a',
+                                    'hits': {'hits': [{'_id': 1}]}}
+        scroll_mock.side_effect = [{'_scroll_id': 'b',
+                                    'hits': {'hits': [{'_id': 2}]}},
+                                   {'_scroll_id': 'b', 'hits': {'hits': []}}]
+        headers = dict(self.headers, Accept='application/x-ndjson')
+        response = self.app.post('/models/test/search/', '{}',
+                                 headers=headers)
+        self.assertEqual(response.content_type, 'application/x-ndjson')
+        self.assertEqual(response.body, b'{"_id": 1}\n{"_id": 2}\n')
+        self.assertEqual(search_mock.call_args[1]['scroll'], '1m')
+        clear_mock.assert_called_with(scroll_id='b')
+
+    @mock.patch('elasticsearch.client.Elasticsearch.clear_scroll')
+    @mock.patch('elasticsearch.client.Elasticsearch.scroll')
+    @mock.patch('elasticsearch.client.Elasticsearch.search')
+    def test_truncated_export_ends_with_an_error(self, search_mock,
+                                                 scroll_mock, clear_mock):
+        search_mock.return_value = {'_scroll_id': 'a',
+                                    'hits': {'hits': [{'_id': 1}]}}
+        scroll_mock.side_effect = elasticsearch.ConnectionError(
+            'N/A', 'timeout', None)
+        headers = dict(self.headers, Accept='application/x-ndjson')
+        response = self.app.post('/models/test/search/', '{}',
+                                 headers=headers)
+        lines = response.body.decode('utf-8').splitlines()
+        self.assertEqual(lines[0], '{"_id": 1}')
+        self.assertIn('incomplete', json.loads(lines[-1])['msg'])
+        clear_mock.assert_called_with(scroll_id='a')
+
+    @mock.patch('elasticsearch.client.Elasticsearch.search')
+    def test_export_returns_original_code_on_bad_request(self, search_mock):
+        badrequest = elasticsearch.RequestError('400', 'error', {'foo': 'bar'})
+        search_mock.side_effect = badrequest
+        headers = dict(self.headers, Accept='application/x-ndjson')
+        self.app.get('/models/test/search/', headers=headers, status=400)
+
     def test_search_view_requires_permission(self):
         self.app.patch_json('/models/test/permissions',
                             {self.credentials['id']: ["-read_all_records"]},
@@ -6,6 +6,7 @@ from daybed.permissions import (
 )
 from daybed.backends.exceptions import ModelNotFound
 from daybed.views.errors import forbidden_view
+from daybed.views.records import readable_records
 from daybed.schemas.validators import (
     model_validator, permissions_validator, definition_validator
 )
@@ -51,9 +52,11 @@ def put_definition(request):
     """Create or update a model definition."""
     model_id = request.matchdict['model_id']
     try:
+        previous = request.db.get_model_definition(model_id)
         permissions = request.db.get_model_permissions(model_id)
         permissions = invert_permissions_matrix(permissions)
     except ModelNotFound:
+        previous = None
         permissions = {}
 
     model = {
@@ -62,7 +65,7 @@ def put_definition(request):
         'records': []  # Won't erase existing records
     }
     request.data_clean = model
-    handle_put_model(request, create=(not permissions))
+    handle_put_model(request, create=(not permissions), previous=previous)
 
     return model['definition']
 
@@ -124,15 +127,14 @@ def post_models(request):
     default_perms = default_model_permissions(credentials_id)
     permissions = merge_permissions(default_perms, specified_perms)
 
-    model_id = request.db.put_model(
-        definition=request.data_clean['definition'],
-        permissions=permissions)
+    definition = request.data_clean['definition']
+    model_id = request.db.put_model(definition=definition,
+                                    permissions=permissions)
 
-    request.notify('ModelCreated', model_id)
+    request.notify('ModelCreated', model_id, definition=definition)
 
-    for record in request.data_clean['records']:
-        record_id = request.db.put_record(model_id, record, [credentials_id])
-        request.notify('RecordCreated', model_id, record_id)
+    notify_records_created(request, model_id, definition,
+                           request.data_clean['records'], credentials_id)
 
     request.response.status = "201 Created"
     location = '%s/models/%s' % (request.application_url, model_id)
@@ -151,7 +153,7 @@ def delete_model(request):
         request.errors.add('path', model_id, "model not found")
         return
 
-    request.notify('ModelDeleted', model_id)
+    request.notify('ModelDeleted', model_id, definition=model['definition'])
 
     model["permissions"] = invert_permissions_matrix(model["permissions"])
     return model
@@ -168,12 +170,7 @@ def get_model(request):
         request.errors.status = "404 Not Found"
         return
 
-    if "read_all_records" not in request.permissions:
-        records = request.db.get_records_with_authors(model_id)
-        records = [r["record"] for r in records
-                   if set(request.principals).intersection(r["authors"])]
-    else:
-        records = request.db.get_records(model_id)
+    records = readable_records(request, model_id)
 
     permissions = request.db.get_model_permissions(model_id)
     return {'definition': definition,
@@ -186,21 +183,33 @@ def put_model(request):
     model_id = request.matchdict['model_id']
 
     try:
-        request.db.get_model_definition(model_id)
+        previous = request.db.get_model_definition(model_id)
 
         if request.has_permission('put_model'):
             try:
                 request.db.delete_model(model_id)
             except ModelNotFound:
                 pass
-            return handle_put_model(request)
+            return handle_put_model(request, previous=previous)
     except ModelNotFound:
         return handle_put_model(request, create=True)
 
     return forbidden_view(request)
 
 
-def handle_put_model(request, create=False):
+def notify_records_created(request, model_id, definition, records,
+                           credentials_id):
+    """Stores the records given with a model definition, and notifies their
+    creation.
+    """
+    records_ids = request.db.put_records(model_id, records, [credentials_id])
+    for record, record_id in zip(records, records_ids):
+        request.notify('RecordCreated', model_id, record_id,
+                       record=dict(record, id=record_id),
+                       definition=definition)
+
+
+def handle_put_model(request, create=False, previous=None):
     model_id = request.matchdict['model_id']
 
     if request.credentials_id:
@@ -212,15 +221,16 @@ def handle_put_model(request, create=False):
     default_perms = default_model_permissions(credentials_id)
     permissions = merge_permissions(default_perms, specified_perms)
 
-    request.db.put_model(request.data_clean['definition'],
-                         permissions,
-                         model_id)
+    definition = request.data_clean['definition']
+    request.db.put_model(definition, permissions, model_id)
 
-    event = 'ModelCreated' if create else 'ModelUpdated'
-    request.notify(event, model_id)
+    if create:
+        request.notify('ModelCreated', model_id, definition=definition)
+    else:
+        request.notify('ModelUpdated', model_id, definition=definition,
+                       previous=previous)
 
-    for record in request.data_clean['records']:
-        record_id = request.db.put_record(model_id, record, [credentials_id])
-        request.notify('RecordCreated', model_id, record_id)
+    notify_records_created(request, model_id, definition,
+                           request.data_clean['records'], credentials_id)
 
     return {"id": model_id}
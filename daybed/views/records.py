@@ -1,11 +1,17 @@
+import base64
+import binascii
 import json
 
+import six
+from six.moves.urllib.parse import urlencode
 from cornice import Service
+from colander import Invalid
 from pyramid.security import Everyone
 
 from daybed.backends.exceptions import RecordNotFound, ModelNotFound
-from daybed.schemas.validators import (RecordSchema, record_validator,
-                                       validate_against_schema)
+from daybed.permissions import PERMISSIONS_BITS
+from daybed.schemas.validators import (get_record_schema, record_validator,
+                                       validate_against_schema, post_serialize)
 
 
 records = Service(name='records',
@@ -18,25 +24,114 @@ record = Service(name='record',
                  description='Single record')
 
 
-@records.get(permission='get_records')
+bulk_records = Service(name='bulk-records',
+                       path='/models/{model_id}/bulk',
+                       description='Bulk creation of records')
+
+
+def encode_cursor(cursor):
+    """Turns a backend cursor into an opaque token for clients."""
+    cursor = base64.urlsafe_b64encode(cursor.encode('utf-8'))
+    return cursor.decode('ascii')
+
+
+def decode_cursor(token):
+    """Turns an opaque token given by a client back into a backend cursor.
+
+    Raises ``ValueError`` if the token was not obtained by ``encode_cursor``.
+    """
+    try:
+        cursor = base64.urlsafe_b64decode(token.encode('ascii'))
+        cursor = cursor.decode('utf-8')
+    except (TypeError, binascii.Error, UnicodeError):
+        raise ValueError(token)
+    # Invalid characters are silently discarded while decoding.
+    if not cursor or encode_cursor(cursor) != token:
+        raise ValueError(token)
+    return cursor
+
+
+def pagination_params(request):
+    """Extracts ``limit`` and ``cursor`` from the querystring, and register
+    errors on the request if they are invalid.
+    """
+    limit = request.GET.get('limit')
+    cursor = request.GET.get('cursor')
+    if limit is not None:
+        try:
+            limit = int(limit)
+            if limit <= 0:
+                raise ValueError(limit)
+        except ValueError:
+            request.errors.add('querystring', 'limit',
+                               'limit should be a positive integer')
+    if cursor is not None:
+        try:
+            cursor = decode_cursor(cursor)
+        except ValueError:
+            request.errors.add('querystring', 'cursor', 'invalid cursor')
+        if limit is None:
+            request.errors.add('querystring', 'limit',
+                               'limit is required with cursor')
+    if request.errors:
+        request.errors.status = "400 Bad Request"
+    return limit, cursor
+
+
+def can_read_all_records(request):
+    return bool(request.permissions & PERMISSIONS_BITS["read_all_records"])
+
+
+def readable_records(request, model_id):
+    """Returns the records of the model that the current user is allowed to
+    read: all of them, or only their own ones, read from the authors index
+    of the backend.
+    """
+    if can_read_all_records(request):
+        # Records are streamed to the client (see ``StreamingJSONP``).
+        records = request.db.iter_records_with_authors(model_id)
+        return (r['record'] for r in records)
+    return request.db.get_records_by_author(model_id, request.principals)
+
+
+@records.get(permission='get_records', renderer='jsonp')
 @records.get(accept='application/vnd.geo+json', renderer='geojson',
              permission='get_records')
 def get_records(request):
-    """Retrieves all model records."""
+    """Retrieves all model records.
+
+    Unless a ``limit`` is specified in querystring, records are streamed.
+    Otherwise they are paginated and the URL of the next page is given in the
+    ``Link`` response header.
+    """
     model_id = request.matchdict['model_id']
+    limit, cursor = pagination_params(request)
+    if request.errors:
+        return
     try:
         request.db.get_model_definition(model_id)
     except ModelNotFound:
         request.errors.add('path', model_id, "model not found")
         request.errors.status = "404 Not Found"
         return
-    # Return array of records
-    if "read_all_records" not in request.permissions:
-        results = request.db.get_records_with_authors(model_id)
-        results = [r['record'] for r in results
-                   if set(request.principals).intersection(r['authors'])]
+
+    next_cursor = None
+    if limit is None:
+        results = readable_records(request, model_id)
+    elif can_read_all_records(request):
+        results, next_cursor = request.db.get_records_page(model_id, limit,
+                                                           cursor)
+        results = [r['record'] for r in results]
     else:
-        results = request.db.get_records(model_id)
+        results, next_cursor = request.db.get_records_by_author_page(
+            model_id, request.principals, limit, cursor)
+
+    if next_cursor is not None:
+        params = dict(request.GET, cursor=encode_cursor(next_cursor))
+        params = dict((k, six.text_type(v).encode('utf-8'))
+                      for k, v in params.items())
+        next_url = '%s?%s' % (request.path_url, urlencode(params))
+        request.response.headers['Link'] = str('<%s>; rel="next"' % next_url)
     return {'records': results}
 
 
@@ -60,7 +155,8 @@ def post_record(request):
     record_id = request.db.put_record(model_id, request.data_clean,
                                       [credentials_id])
 
-    request.notify('RecordCreated', model_id, record_id)
+    request.notify('RecordCreated', model_id, record_id,
+                   record=dict(request.data_clean, id=record_id))
 
     created = u'%s/models/%s/records/%s' % (request.application_url, model_id,
                                             record_id)
@@ -69,14 +165,77 @@ def post_record(request):
     return {'id': record_id}
 
 
+def bulk_body(request):
+    """Returns the list of records given in the request body, either as a JSON
+    array or as newline delimited JSON (``application/x-ndjson``).
+
+    Raises ``ValueError`` if the body is invalid.
+    """
+    body = request.body.decode('utf-8')
+    if request.content_type == 'application/x-ndjson':
+        return [json.loads(line) for line in body.splitlines()
+                if line.strip()]
+    items = json.loads(body)
+    if not isinstance(items, list):
+        raise ValueError('a list of records is expected')
+    return items
+
+
+@bulk_records.post(permission='post_record')
+def post_records(request):
+    """Saves several model records at once.
+
+    Each record is validated against the model definition, and the status of
+    each of them is returned, in the same order. Valid ones are stored even
+    if others are not.
+    """
+    model_id = request.matchdict['model_id']
+    try:
+        definition = request.db.get_model_definition(model_id)
+    except ModelNotFound:
+        request.errors.add('path', model_id, "model not found")
+        request.errors.status = "404 Not Found"
+        return
+
+    try:
+        items = bulk_body(request)
+    except ValueError as e:
+        request.errors.add('body', 'body', six.text_type(e))
+        return
+
+    schema = get_record_schema(request, model_id, definition)
+    statuses = []
+    valid = []
+    for item in items:
+        try:
+            valid.append(post_serialize(schema.deserialize(item)))
+            statuses.append({'status': 201})
+        except Invalid as e:
+            statuses.append({'status': 400, 'errors': e.asdict()})
+
+    if request.credentials_id:
+        credentials_id = request.credentials_id
+    else:
+        credentials_id = Everyone
+    records_ids = request.db.put_records(model_id, valid, [credentials_id])
+
+    created = [status for status in statuses if status['status'] == 201]
+    for status, record, record_id in zip(created, valid, records_ids):
+        status['id'] = record['id'] = record_id
+    if valid:
+        request.notify('RecordsCreated', model_id, valid,
+                       definition=definition)
+
+    return {'records': statuses}
+
+
 @records.delete(permission='delete_records')
 def delete_records(request):
     """Deletes all records of model."""
     model_id = request.matchdict['model_id']
     try:
         records = request.db.delete_records(model_id)
-        for record in records:
-            request.notify('RecordDeleted', model_id, record['id'])
+        request.notify('AllRecordsDeleted', model_id, records)
     except ModelNotFound:
         request.errors.add('path', model_id, "model not found")
         request.errors.status = "404 Not Found"
@@ -107,10 +266,9 @@ def put(request):
     record_id = request.matchdict['record_id']
 
     try:
-        request.db.get_record(model_id, record_id)
-        create = True
+        previous = request.db.get_record(model_id, record_id)
     except RecordNotFound:
-        create = False
+        previous = None
 
     if request.credentials_id:
         credentials_id = request.credentials_id
@@ -119,8 +277,12 @@ def put(request):
 
     record_id = request.db.put_record(model_id, request.data_clean,
                                       [credentials_id], record_id=record_id)
-    event = 'RecordCreated' if create else 'RecordUpdated'
-    request.notify(event, model_id, record_id)
+    record = dict(request.data_clean, id=record_id)
+    if previous is None:
+        request.notify('RecordCreated', model_id, record_id, record=record)
+    else:
+        request.notify('RecordUpdated', model_id, record_id, record=record,
+                       previous=previous)
     return {'id': record_id}
 
 
@@ -142,12 +304,17 @@ def patch(request):
         request.errors.status = "404 Not Found"
         return
 
+    # Records obtained from the backend must not be modified.
+    previous, record = record, dict(record)
     record.update(json.loads(request.body.decode('utf-8')))
     definition = request.db.get_model_definition(model_id)
-    validate_against_schema(request, RecordSchema(definition), record)
+    schema = get_record_schema(request, model_id, definition)
+    validate_against_schema(request, schema, record)
     if not request.errors:
         request.db.put_record(model_id, record, [credentials_id], record_id)
-        request.notify('RecordUpdated', model_id, record_id)
+        request.notify('RecordUpdated', model_id, record_id,
+                       record=dict(record, id=record_id),
+                       definition=definition, previous=previous)
     return {'id': record_id}
 
 
@@ -159,7 +326,8 @@ def delete(request):
 
     try:
         deleted = request.db.delete_record(model_id, record_id)
-        request.notify('RecordDeleted', model_id, record_id)
+        request.notify('RecordDeleted', model_id, record_id,
+                       record=deleted['record'])
     except RecordNotFound:
         request.errors.add('path', record_id, "record not found")
         request.errors.status = "404 Not Found"
@@ -11,28 +11,49 @@ search = Service(name='search',
                  renderer='jsonp')
 
 
-@search.get(permission='get_all_records')
-@search.post(permission='get_all_records')
-def search_records(request):
-    """Search model records."""
+def search_query(request):
+    """Returns the query given in the request body, or ``None`` if the model
+    is unknown.
+    """
     model_id = request.matchdict['model_id']
     try:
         request.db.get_model_definition(model_id)
     except ModelNotFound:
         request.response.status = "404 Not Found"
-        return {"msg": "%s: model not found" % model_id}
+        return None
 
     # So far we just support query from body
     query = request.body
-    # Parameters can come from query string
-    params = request.GET
 
     # In case request body arrives as bytes under python 3
     if isinstance(query, six.binary_type):
         query = query.decode('utf-8')
+    return query
+
+
+@search.get(permission='get_all_records')
+@search.post(permission='get_all_records')
+def search_records(request):
+    """Search model records."""
+    model_id = request.matchdict['model_id']
+    query = search_query(request)
+    if query is None:
+        return {"msg": "%s: model not found" % model_id}
+    # Parameters can come from query string
+    params = request.GET
+
+    # Repeated searches are served from cache until the model is modified.
+    cache = request.registry.search_cache
+    if cache is not None:
+        results = cache.get(model_id, query, params)
+        if results is not None:
+            return results
 
     try:
         results = request.index.search(model_id, query, params=params)
+        # Results may miss writes still pending in the indexer.
+        if cache is not None and request.index.settled():
+            cache.set(model_id, query, params, results)
         return results
     except SearchError as e:
         request.response.status = e.status_code
@@ -40,3 +61,40 @@ def search_records(request):
     except Exception as e:
         request.response.status = "502 Bad Gateway"
         return {"msg": "Could not obtain response from indexing service"}
+
+
+@search.get(accept='application/x-ndjson', renderer='ndjson',
+            permission='get_all_records')
+@search.post(accept='application/x-ndjson', renderer='ndjson',
+             permission='get_all_records')
+def export_records(request):
+    """Streams all the hits of a search, as newline delimited JSON.
+
+    Hits are obtained from the indexer page by page while being sent, so
+    that large results can be exported without deep pagination.
+    """
+    model_id = request.matchdict['model_id']
+    query = search_query(request)
+    if query is None:
+        return [{"msg": "%s: model not found" % model_id}]
+
+    try:
+        hits = request.index.scan(model_id, query, params=request.GET)
+    except SearchError as e:
+        request.response.status = e.status_code
+        return [{"msg": e.info}]
+    except Exception:
+        request.response.status = "502 Bad Gateway"
+        return [{"msg": "Could not obtain response from indexing service"}]
+    return complete_hits(hits)
+
+
+def complete_hits(hits):
+    """Yields the hits, followed by an error message if they could not all
+    be obtained: the response status is already sent by then.
+    """
+    try:
+        for hit in hits:
+            yield hit
+    except Exception:
+        yield {"msg": "Search results are incomplete"}
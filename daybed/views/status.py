@@ -0,0 +1,19 @@
+from cornice import Service
+
+
+status = Service(name="status", path='/status',
+                 description="Status of the services")
+
+
+@status.get()
+def get_status(request):
+    """Returns the state of the indexer and the efficiency of caches."""
+    registry = request.registry
+    caches = {'record_schemas': registry.record_schemas.stats(),
+              'credentials': registry.credentials_cache.stats()}
+    if registry.permissions_cache is not None:
+        caches['permissions'] = registry.permissions_cache.stats()
+    if registry.search_cache is not None:
+        caches['search'] = registry.search_cache.stats()
+    return {'indexer': request.index.status(),
+            'caches': caches}
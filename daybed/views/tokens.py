@@ -27,6 +27,8 @@ def post_tokens(request):
         request.response.status = "200 OK"
     else:
         request.response.status = "201 Created"
+        # Forget that these credentials were unknown.
+        request.registry.credentials_cache.invalidate(credentials['id'])
 
     return {
         'token': token,
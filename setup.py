@@ -58,6 +58,10 @@ DEPENDENCY_LINKS = [
 ENTRY_POINTS = {
     'paste.app_factory': [
         'main = daybed:main',
+    ],
+    'console_scripts': [
+        'daybed-reindex = daybed.scripts.reindex:main',
+        'daybed-migrate = daybed.scripts.migrate:main',
     ]}
 
 